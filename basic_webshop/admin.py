@@ -3,7 +3,12 @@ logger = logging.getLogger(__name__)
 
 from django.utils.translation import ugettext_lazy as _
 from django.contrib import admin
+from django.contrib.admin.filterspecs import FilterSpec, RelatedFilterSpec
+from django.contrib.admin.util import get_model_from_relation, \
+                                     get_fields_from_path
+from django.contrib.admin.views.main import ChangeList
 from django.core.urlresolvers import reverse
+from django.db import models
 
 from shopkit.core.utils.admin import LimitedAdminInlineMixin
 
@@ -25,13 +30,17 @@ from shopkit.core.admin import PricedItemAdminMixin, \
                                OrderStateChangeInline, \
                                OrderItemInlineBase
 
+from basic_webshop.category_tree import get_category_tree
+from basic_webshop.brand_directory import get_brand_choices
+
 
 class OrderItemInline(admin.TabularInline, PricedItemAdminMixin):
     model = OrderItem
 
     fields = ('order_line', 'quantity', 'piece_price',
-              'discount', 'get_price',)
-    readonly_fields = ('get_price', )
+              'discount', 'get_price', 'vat_rate', 'vat_amount',
+              'gross_price')
+    readonly_fields = ('get_price', 'vat_rate', 'vat_amount', 'gross_price')
 
     extra = 0
 
@@ -41,9 +50,10 @@ class OrderAdmin(admin.ModelAdmin, PricedItemAdminMixin):
    inlines = (OrderItemInline, OrderStateChangeInline)
    readonly_fields = ('order_number', 'invoice_number',
                       'get_formatted_address', 'customer', 'get_invoice',
-                      'coupon_code', 'get_price', 'get_total_discounts',)
+                      'coupon_code', 'get_price', 'get_total_discounts',
+                      'vat_amount', 'gross_price')
    list_display = ('order_number', 'date_added', 'state', 'get_price',
-                   'customer', 'get_invoice',
+                   'vat_amount', 'gross_price', 'customer', 'get_invoice',
                    )
    list_filter = ('state', )
    date_hierarchy = 'date_added'
@@ -193,6 +203,117 @@ class ProductMediaInline(admin.TabularInline):
     extra = 1
 
 
+def get_category_choices():
+    """ Category choices in tree order, from the cached category tree. """
+    def walk(nodes):
+        for node in nodes:
+            yield node
+
+            for child in walk(node.children):
+                yield child
+
+    return [(node.pk, node.name) \
+            for node in walk(get_category_tree().roots)]
+
+
+FILTER_CHOICES = (
+    (Product._meta.get_field('brand'), get_brand_choices),
+    (Product._meta.get_field('categories'), get_category_choices),
+    (Category._meta.get_field('parent'), get_category_choices),
+)
+"""
+Related fields for which filter choices are taken from the cache.
+
+Django 1.3 has no per-admin filter classes. Rather than registering
+`CachedRelatedFilterSpec` in Django's global `FilterSpec.filter_specs`, the
+change lists of the admins below create it through
+`CachedFilterChangeListMixin`, so the filters of other admins are left to
+Django.
+"""
+
+
+def get_filter_choices_function(f):
+    for field, function in FILTER_CHOICES:
+        if f is field:
+            return function
+
+    return None
+
+
+class CachedRelatedFilterSpec(RelatedFilterSpec):
+    """
+    Related filter with choices from `FILTER_CHOICES` rather than from a
+    query, and a query per choice for its name, over all related objects.
+    """
+
+    def __init__(self, f, request, params, model, model_admin,
+                 field_path=None):
+        # Skip RelatedFilterSpec.__init__, which queries the choices
+        FilterSpec.__init__(self, f, request, params, model, model_admin,
+                            field_path=field_path)
+
+        other_model = get_model_from_relation(f)
+        if isinstance(f, (models.ManyToManyField,
+                          models.related.RelatedObject)):
+            self.lookup_title = other_model._meta.verbose_name
+        else:
+            self.lookup_title = f.verbose_name
+
+        rel_name = other_model._meta.pk.name
+        self.lookup_kwarg = '%s__%s__exact' % (self.field_path, rel_name)
+        self.lookup_kwarg_isnull = '%s__isnull' % (self.field_path)
+        self.lookup_val = request.GET.get(self.lookup_kwarg, None)
+        self.lookup_val_isnull = request.GET.get(self.lookup_kwarg_isnull,
+                                                 None)
+
+        self.lookup_choices = get_filter_choices_function(f)()
+
+
+class CachedFilterChangeListMixin(object):
+    """
+    Change list mixin using `CachedRelatedFilterSpec` for the fields in
+    `FILTER_CHOICES` and Django's filter specs for all other fields.
+    """
+
+    def get_filters(self, request):
+        filter_specs = []
+
+        for filter_name in self.list_filter:
+            field = get_fields_from_path(self.model, filter_name)[-1]
+
+            if get_filter_choices_function(field):
+                spec_class = CachedRelatedFilterSpec
+            else:
+                spec_class = FilterSpec.create
+
+            spec = spec_class(field, request, self.params, self.model,
+                              self.model_admin, field_path=filter_name)
+
+            if spec and spec.has_output():
+                filter_specs.append(spec)
+
+        return filter_specs, bool(filter_specs)
+
+
+class ProductChangeList(CachedFilterChangeListMixin, ChangeList):
+    """
+    Change list loading names, brand names, categories and images for all
+    products on a page at once.
+    """
+
+    def get_results(self, request):
+        super(ProductChangeList, self).get_results(request)
+
+        # Evaluating the queryset also fills its result cache
+        products = list(self.result_list)
+
+        Product.prefetch_names(products)
+        Brand.prefetch_names([product.brand for product in products \
+                              if product.brand_id])
+        Product.prefetch_category_ids(products)
+        Product.prefetch_default_images(products)
+
+
 class ProductAdmin(InlineButtonsAdminMixin, ImagesProductAdminMixin, \
                    TinyMCELinkListMixin, ExtendibleModelAdminMixin, \
                    admin.ModelAdmin):
@@ -200,7 +321,7 @@ class ProductAdmin(InlineButtonsAdminMixin, ImagesProductAdminMixin, \
 
     fieldsets = (
         (_('Required fields'), {'fields':
-                    ('categories', 'stock', 'price')}),
+                    ('categories', 'stock', 'price', 'vat_class')}),
         (_('Publication attributes'), {
             'fields': ('active', 'date_publish', 'sort_order', ),
             'classes': ('collapse',),}),
@@ -233,25 +354,38 @@ class ProductAdmin(InlineButtonsAdminMixin, ImagesProductAdminMixin, \
                      'categories__translations__name', 'categories__slug',
                      'brand__translations__name', 'brand__slug', )
 
+    def queryset(self, request):
+        qs = super(ProductAdmin, self).queryset(request)
+
+        return qs.select_related('brand')
+
+    def get_changelist(self, request, **kwargs):
+        return ProductChangeList
+
     max_categories_display = 2
     def admin_categories(self, obj):
-        """ TODO: Move this over to django-shopkit's extension. """
-        categories = obj.categories.all()
-        categories_count = categories.count()
+        """
+        Categories of a product, with names from the cached category tree.
+        TODO: Move this over to django-shopkit's extension.
+        """
+        category_ids = obj.get_category_ids()
+        tree = get_category_tree()
 
-        def category_link(obj):
+        def category_link(pk):
+            node = tree.get_node(pk)
             return u'<a href="../category/%d/">%s</a>' % \
-                (obj.pk, obj)
+                (pk, node and node.name or pk)
 
-        if categories_count == 0:
+        if not category_ids:
             return _('None')
         else:
-            category_list = category_link(categories[0])
+            category_list = category_link(category_ids[0])
 
-            for category in categories[1:self.max_categories_display]:
-                category_list += u', %s' % category_link(category)
+            for category_id in \
+                    category_ids[1:self.max_categories_display]:
+                category_list += u', %s' % category_link(category_id)
 
-            if categories_count > self.max_categories_display:
+            if len(category_ids) > self.max_categories_display:
                 category_list += u', ...'
 
             return category_list
@@ -303,15 +437,29 @@ class CategoryAdmin(MPTTModelAdmin):
     search_fields = ('slug', 'translations__name', )
     mptt_indent_field = 'admin_name'
 
+    def get_changelist(self, request, **kwargs):
+        """ Use cached filter choices in MPTT's change list. """
+        changelist_class = super(CategoryAdmin, self).get_changelist(request,
+                                                                     **kwargs)
+
+        return type('CategoryChangeList',
+                    (CachedFilterChangeListMixin, changelist_class), {})
+
     def admin_name(self, obj):
+        """ Name from the cached category tree. """
+        node = get_category_tree().get_node(obj.pk)
+        if node:
+            return node.name
+
         return obj.name
     admin_name.short_description = _('name')
 
     max_products_display = 2
     def admin_products(self, obj):
-        products = obj.product_set.all()
-        products_count = products.count()
-        products_inactive_count = products.filter(active=False).count()
+        """ Render the denormalized product counters. """
+        products_count = obj.active_product_count + \
+                         obj.inactive_product_count
+        products_inactive_count = obj.inactive_product_count
 
         if not products_count:
             value = _('No products')
@@ -355,10 +503,6 @@ class DiscountAdmin(admin.ModelAdmin):
     list_filter = ('start_date', 'end_date', 'use_coupon')
     search_fields = ('name', )
 
-    # Exclude product and category discounts
-    # NOT ONLY are they slow, they're also buggy
-    exclude = ('products', 'categories', )
-
     max_products_display = 2
     def admin_products(self, obj):
         """ TODO: Move this over to django-shopkit's extension. """
@@ -14,13 +14,85 @@ class InlineButtonsAdminMixin(object):
 
 from sorl.thumbnail import get_thumbnail
 
+from django.conf import settings
 from django.conf.urls.defaults import patterns, url
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.hashcompat import md5_constructor
+from django.utils.http import parse_etags, quote_etag
+from django.utils.translation import get_language
 
 from tinymce.widgets import TinyMCE
 from tinymce.views import render_to_image_list, render_to_link_list
 
 
-class TinyMCEImageListMixin(object):
+TINYMCE_LIST_TIMEOUT = getattr(settings, 'SHOPKIT_TINYMCE_LIST_TIMEOUT',
+                               60*60*24)
+
+
+class CachedListMixin(object):
+    """
+    Cache lists rendered for TinyMCE per object and serve them with an
+    ETag, so editors can revalidate them with a conditional request.
+
+    The version of a list is a digest of the related rows, so it changes
+    whenever one of them is added, changed or removed and cached lists never
+    need to be invalidated explicitly.
+    """
+
+    def get_list_version(self, name, obj, related, *extra):
+        """
+        Return a version for a list of related objects, or `None` when the
+        related objects are no queryset.
+        """
+        if not hasattr(related, 'values_list'):
+            return None
+
+        fields = [field.attname for field in related.model._meta.fields]
+        rows = list(related.values_list(*fields))
+
+        key = repr((name, related.model._meta.db_table, obj.pk,
+                    get_language(), extra, rows))
+
+        return md5_constructor(key).hexdigest()
+
+    def render_cached_list(self, request, name, obj, related, render,
+                           *extra):
+        """
+        Return the list rendered by `render(related)`, from the cache when
+        possible, or a 304 response when the client's copy is current.
+        """
+        version = self.get_list_version(name, obj, related, *extra)
+
+        if not version:
+            return render(related)
+
+        etag = quote_etag(version)
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and version in parse_etags(if_none_match):
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+
+        cache_key = 'basic_webshop.tinymce_list.%s' % version
+
+        cached = cache.get(cache_key)
+        if cached is None:
+            rendered = render(related)
+            cached = (rendered.content, rendered['Content-Type'])
+
+            cache.set(cache_key, cached, TINYMCE_LIST_TIMEOUT)
+
+        content, content_type = cached
+
+        response = HttpResponse(content, content_type=content_type)
+        response['ETag'] = etag
+
+        return response
+
+
+class TinyMCEImageListMixin(CachedListMixin):
     """ 
     Example usage::
         related_image_field = 'image'
@@ -62,6 +134,12 @@ class TinyMCEImageListMixin(object):
 
         related_images = self.get_related_images(request, obj)
 
+        return self.render_cached_list(request, 'image_list', obj,
+                                       related_images,
+                                       self.render_image_list,
+                                       self.related_image_size)
+
+    def render_image_list(self, related_images):
         image_list = []
         for obj in related_images:
             image = getattr(obj, self.related_image_field)
@@ -84,7 +162,7 @@ class TinyMCEImageListMixin(object):
         return my_urls + urls
 
 
-class TinyMCELinkListMixin(object):
+class TinyMCELinkListMixin(CachedListMixin):
     """
     Example usage::
 
@@ -113,6 +191,11 @@ class TinyMCELinkListMixin(object):
 
         related_objects = self.get_related_objects(request, obj)
 
+        return self.render_cached_list(request, 'link_list', obj,
+                                       related_objects,
+                                       self.render_link_list)
+
+    def render_link_list(self, related_objects):
         link_list = []
         for obj in related_objects:
             assert hasattr(obj, 'get_absolute_url'), \
@@ -1,3 +1,5 @@
+import re
+
 import logging
 
 logger = logging.getLogger(__name__)
@@ -83,22 +85,53 @@ class AutoSlugMixin(object):
 
 
 class AutoUniqueSlugMixin(AutoSlugMixin):
-    """ Make sure that the generated slug is unique. """
+    """
+    Make sure that the generated slug is unique, within the queryset
+    returned by `get_slug_queryset`.
+    """
+
+    def get_slug_queryset(self):
+        """ Objects among which the slug should be unique. """
+        return self.__class__.objects.all()
 
     def is_unique_slug(self, slug):
-        qs = self.__class__.objects.filter(**{self._slug_field: slug})
+        qs = self.get_slug_queryset().filter(**{self._slug_field: slug})
         return not qs.exists()
 
     def generate_slug(self):
+        """
+        Generate a unique slug, adding the lowest free numeric suffix when
+        the slug is taken. All possibly conflicting slugs are fetched in a
+        single query.
+        """
         original_slug = super(AutoUniqueSlugMixin, self).generate_slug()
-        slug = original_slug
+
+        qs = self.get_slug_queryset().filter(
+            **{'%s__startswith' % self._slug_field: original_slug})
+        existing = qs.values_list(self._slug_field, flat=True)
+
+        pattern = re.compile(r'^%s(?:-(\d+))?$' % re.escape(original_slug))
+
+        taken = False
+        suffixes = set()
+        for slug in existing:
+            match = pattern.match(slug)
+            if not match:
+                continue
+
+            if match.group(1) is None:
+                taken = True
+            else:
+                suffixes.add(int(match.group(1)))
+
+        if not taken:
+            return original_slug
 
         iteration = 1
-        while not self.is_unique_slug(slug):
-            slug = "%s-%d" % (original_slug, iteration)
+        while iteration in suffixes:
             iteration += 1
 
-        return slug
+        return "%s-%d" % (original_slug, iteration)
 
 
 class NonUniqueSlugItemBase(models.Model):
@@ -123,9 +156,47 @@ class NamedItemTranslationMixin(object):
             ...
 
     """
+    _prefetched_name = None
+
     def __unicode__(self):
+        if self._prefetched_name is not None:
+            return self._prefetched_name
+
         return self.unicode_wrapper('name')
 
+    @classmethod
+    def prefetch_names(cls, objects, language_code=None):
+        """
+        Load the translated names for a list of objects in a single query,
+        falling back to the default language, so that rendering them
+        doesn't require a query per object.
+        """
+        from django.conf import settings
+        from django.utils.translation import get_language
+
+        if not language_code:
+            language_code = get_language()
+
+        objects = [obj for obj in objects if obj.pk]
+        if not objects:
+            return
+
+        translation_model = cls.translations.related.model
+        translations = translation_model.objects.filter(
+            parent__in=set(obj.pk for obj in objects))
+
+        names = {}
+        for parent_id, translation_language, name in \
+                translations.values_list('parent', 'language_code', 'name'):
+            names.setdefault(parent_id, {})[translation_language] = name
+
+        for obj in objects:
+            obj_names = names.get(obj.pk)
+            if obj_names:
+                obj._prefetched_name = obj_names.get(language_code) or \
+                    obj_names.get(settings.LANGUAGE_CODE) or \
+                    obj_names.values()[0]
+
 
 # ADDRESS BASE CLASSES
 
@@ -253,6 +324,102 @@ class CountriesShippingMixin(models.Model):
 
         return valid
 
+# Atomic sequences for order and invoice numbers
+from django.db import connections, router, transaction, IntegrityError
+
+
+class SequenceBase(models.Model):
+    """
+    Base class for named counters which are incremented atomically, without
+    scanning the rows they are numbering. Counters are incremented using a
+    single `UPDATE ... RETURNING` statement on PostgreSQL and an `F()`
+    increment and subsequent read within the same transaction elsewhere.
+    """
+
+    class Meta:
+        abstract = True
+
+    name = models.CharField(_('name'), max_length=32, unique=True)
+    value = models.PositiveIntegerField(_('value'), default=0)
+
+    def __unicode__(self):
+        return u'%s: %d' % (self.name, self.value)
+
+    @classmethod
+    def _increment(cls, connection, name):
+        """
+        Increment the counter with the given name and return its new value,
+        or `None` when no such counter exists.
+        """
+        if connection.vendor == 'postgresql':
+            qn = connection.ops.quote_name
+
+            cursor = connection.cursor()
+            cursor.execute('UPDATE %s SET %s = %s + 1 WHERE %s = %%s '
+                           'RETURNING %s' % (qn(cls._meta.db_table),
+                                             qn('value'), qn('value'),
+                                             qn('name'), qn('value')),
+                           [name])
+            transaction.set_dirty(using=connection.alias)
+
+            row = cursor.fetchone()
+            if row:
+                return row[0]
+
+            return None
+
+        qs = cls.objects.using(connection.alias).filter(name=name)
+        if qs.update(value=models.F('value') + 1):
+            # The update keeps the row locked until the transaction ends
+            return qs.values_list('value', flat=True)[0]
+
+        return None
+
+    @classmethod
+    def next_value(cls, name, initial=None):
+        """
+        Return the next value of the counter with the given name. New
+        counters start at 1, or at the value returned by the optional
+        `initial` callable.
+
+        Within a managed transaction, the counter is incremented as part of
+        that transaction, so a rolled back order or invoice doesn't consume
+        a number and the caller's transaction is never committed early.
+        Otherwise the increment is committed right away.
+        """
+        using = router.db_for_write(cls)
+        connection = connections[using]
+
+        def allocate():
+            value = cls._increment(connection, name)
+            if value is not None:
+                return value
+
+            # First value for this counter
+            if initial:
+                value = initial()
+            else:
+                value = 1
+
+            sid = transaction.savepoint(using=using)
+            try:
+                cls.objects.using(using).create(name=name, value=value)
+            except IntegrityError:
+                # Created concurrently, increment that one instead
+                transaction.savepoint_rollback(sid, using=using)
+
+                return cls._increment(connection, name)
+
+            transaction.savepoint_commit(sid, using=using)
+
+            return value
+
+        if transaction.is_managed(using=using):
+            return allocate()
+
+        return transaction.commit_on_success(using=using)(allocate)()
+
+
 # Base classes for orders with invoice numbers and order numbers
 class NumberedOrderBase(models.Model):
     """ Base class for `Order` with invoice and order numbers. """
@@ -0,0 +1,392 @@
+"""
+Query count and latency benchmarks for the public views.
+
+`CatalogGenerator` fills the database with a synthetic catalog of products,
+categories, brands, translations, ratings and variations. `ViewBenchmark`
+then requests every URL in `urls.py` through the test client, recording the
+number of queries, the wall time and the growth of the peak memory usage
+of each request, both with an empty and with a warm cache.
+
+Results are plain dictionaries which can be stored as JSON and compared to
+those of an earlier run with `compare_results`, which reports regressions
+beyond the thresholds configured in `SHOPKIT_BENCHMARK_*`. The
+`benchmark_views` management command does all of this in a throwaway test
+database.
+"""
+
+import resource
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+
+from countries.models import Country
+
+from basic_webshop.models import \
+    Brand, BrandTranslation, Category, CategoryTranslation, Product, \
+    ProductTranslation, ProductVariation, ProductVariationTranslation, \
+    ProductRating, Customer, Address, Order
+
+
+BENCHMARK_QUERY_TOLERANCE = getattr(settings,
+                                    'SHOPKIT_BENCHMARK_QUERY_TOLERANCE', 0)
+""" Number of additional queries per request allowed before failing. """
+
+BENCHMARK_TIME_TOLERANCE = getattr(settings,
+                                   'SHOPKIT_BENCHMARK_TIME_TOLERANCE', 2.0)
+""" Factor by which a request may become slower before failing. """
+
+BENCHMARK_MEMORY_TOLERANCE = getattr(settings,
+                                     'SHOPKIT_BENCHMARK_MEMORY_TOLERANCE',
+                                     10240)
+""" Additional peak memory in kilobytes allowed per request. """
+
+BENCHMARK_PASSWORD = 'benchmark'
+
+CATEGORY_ASPECTS = ('new', 'picks', 'sale', 'all')
+
+
+class CatalogGenerator(object):
+    """
+    Generate a synthetic catalog. Categories are created as a three level
+    tree, products are spread over all brands and categories and every
+    product, category, brand and variation is translated in all languages.
+    """
+
+    def __init__(self, products=100, categories=12, brands=10,
+                 languages=None, ratings=2, variations=2):
+        self.product_count = products
+        self.category_count = max(categories, 3)
+        self.brand_count = max(brands, 1)
+        self.rating_count = ratings
+        self.variation_count = variations
+
+        if not languages:
+            languages = [code for code, name in settings.LANGUAGES]
+        self.languages = languages
+
+    def get_sizes(self):
+        """ Return the catalog dimensions, for storing with results. """
+        return {
+            'products': self.product_count,
+            'categories': self.category_count,
+            'brands': self.brand_count,
+            'languages': len(self.languages),
+            'ratings': self.rating_count,
+            'variations': self.variation_count,
+        }
+
+    def generate(self):
+        """ Generate the catalog, a customer and an order. """
+        start = time.time()
+
+        self.brands = self.generate_brands()
+        self.categories = self.generate_categories()
+        self.customer = self.generate_customer()
+        self.products = self.generate_products()
+        self.order = self.generate_order()
+
+        logger.info(u'Generated catalog %s in %.1f seconds',
+                    self.get_sizes(), time.time() - start)
+
+        return self
+
+    def translate(self, model, parent, name, **kwargs):
+        for language_code in self.languages:
+            translation = model(parent=parent, language_code=language_code,
+                                name=u'%s %s' % (name, language_code),
+                                **kwargs)
+            translation.save()
+
+    def generate_brands(self):
+        brands = []
+        for x in xrange(self.brand_count):
+            brand = Brand(slug='brand-%d' % x, sort_order=x)
+            brand.save()
+
+            self.translate(BrandTranslation, brand, u'Brand %d' % x,
+                           description=u'<p>Description of brand %d</p>' % x)
+
+            brands.append(brand)
+
+        return brands
+
+    def generate_categories(self):
+        """ Categories alternate between the three levels of the tree. """
+        categories = []
+        parents = [None, None, None]
+        for x in xrange(self.category_count):
+            level = x % 3
+
+            category = Category(slug='category-%d' % x, active=True,
+                                parent=parents[level], sort_order=x)
+            category.save()
+
+            self.translate(CategoryTranslation, category, u'Category %d' % x)
+
+            if level < 2:
+                parents[level + 1] = category
+
+            categories.append(category)
+
+        return categories
+
+    def generate_customer(self):
+        customer = Customer(username='benchmark',
+                            email='benchmark@example.com')
+        customer.set_password(BENCHMARK_PASSWORD)
+        customer.save()
+
+        address = Address(customer=customer,
+                          country=Country.objects.all()[0],
+                          postal_address='Benchmark street 1',
+                          zip_code='1234 AB', city='Benchmark')
+        address.save()
+
+        customer.shipping_address = address
+        customer.save()
+
+        return customer
+
+    def generate_products(self):
+        products = []
+        for x in xrange(self.product_count):
+            product = Product(slug='product-%d' % x,
+                              article_number='%06d' % x,
+                              price=Decimal('%d.95' % (x % 100)),
+                              stock=x % 10,
+                              active=True,
+                              sort_order=x,
+                              brand=self.brands[x % len(self.brands)])
+            product.save()
+
+            product.categories.add(self.categories[x % len(self.categories)])
+
+            self.translate(ProductTranslation, product, u'Product %d' % x,
+                           description=u'Description of product %d' % x)
+
+            for y in xrange(self.variation_count):
+                variation = ProductVariation(product=product,
+                                             slug='variation-%d' % y,
+                                             stock=y, sort_order=y)
+                variation.save()
+
+                self.translate(ProductVariationTranslation, variation,
+                               u'Variation %d' % y, product=product)
+
+            for y in xrange(self.rating_count):
+                rating = ProductRating(product=product, user=self.customer,
+                                       language=self.languages[
+                                           y % len(self.languages)],
+                                       rating=y % 6,
+                                       description=u'Rating %d' % y)
+                rating.save()
+
+            products.append(product)
+
+        return products
+
+    def generate_order(self):
+        order = Order(customer=self.customer,
+                      shipping_address=self.customer.shipping_address)
+        order.save()
+
+        return order
+
+
+def get_benchmark_urls(catalog):
+    """
+    Return (name, path) tuples for every URL in `urls.py`, using objects from
+    a generated catalog. Payment provider feedback and the checkout, which
+    require the payment provider, are left out.
+    """
+    product = Product.objects.get(pk=catalog.products[0].pk)
+    brand = Brand.objects.get(pk=catalog.brands[0].pk)
+    order_number = Order.objects.get(pk=catalog.order.pk).order_number
+
+    category, subcategory, subsubcategory = \
+        [Category.objects.get(pk=category.pk) \
+         for category in catalog.categories[:3]]
+
+    urls = [
+        ('product_search', reverse('product_search') + '?q=product'),
+        ('category_detail', category.get_absolute_url()),
+        ('subcategory_detail', subcategory.get_absolute_url()),
+        ('subsubcategory_detail', subsubcategory.get_absolute_url()),
+        ('product_detail', product.get_absolute_url()),
+        ('brand_list', reverse('brand_list')),
+        ('brand_detail', reverse('brand_detail',
+                                 kwargs={'slug': brand.slug})),
+        ('brand_products', reverse('brand_products',
+                                   kwargs={'slug': brand.slug})),
+        ('cart_detail', reverse('cart_detail')),
+        ('order_list', reverse('order_list')),
+        ('order_create', reverse('order_create')),
+    ]
+
+    for aspect in CATEGORY_ASPECTS:
+        urls.append(('category_aspect_detail_%s' % aspect,
+                     reverse('category_aspect_detail',
+                             kwargs={'category_slug': category.slug,
+                                     'aspect': aspect})))
+
+    for name in ('order_detail', 'order_invoice', 'order_shipping'):
+        urls.append((name, reverse(name, kwargs={'slug': order_number})))
+
+    urls.append(('order_checkout_status',
+                 reverse('order_checkout_status',
+                         kwargs={'slug': order_number,
+                                 'status': 'success'})))
+
+    return urls
+
+
+class QueryCounter(object):
+    """ Context manager counting the queries executed within it. """
+
+    def __enter__(self):
+        self.old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+
+        self.start = len(connection.queries)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.count = len(connection.queries) - self.start
+
+        connection.use_debug_cursor = self.old_debug_cursor
+
+
+def get_peak_memory():
+    """ Peak memory usage of this process in kilobytes. """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def median(values):
+    values = sorted(values)
+
+    return values[len(values) // 2]
+
+
+class ViewBenchmark(object):
+    """
+    Request URLs through the test client, as the benchmark customer, and
+    record query counts, timings and memory usage.
+    """
+
+    def __init__(self, catalog, repeat=3):
+        self.catalog = catalog
+        self.repeat = max(repeat, 1)
+
+        self.client = Client()
+        self.client.login(username=catalog.customer.username,
+                          password=BENCHMARK_PASSWORD)
+
+    def request(self, path):
+        """ Return the status, query count, time and memory growth. """
+        memory = get_peak_memory()
+
+        with QueryCounter() as queries:
+            start = time.time()
+            response = self.client.get(path)
+            duration = time.time() - start
+
+        return response.status_code, queries.count, duration, \
+            get_peak_memory() - memory
+
+    def measure(self, path):
+        """
+        Measure a single URL, with an empty cache and with the cache filled
+        by the preceding request. Timings are the median of all repetitions.
+        """
+        times = []
+        cached_times = []
+        memory = 0
+
+        for x in xrange(self.repeat):
+            cache.clear()
+
+            status, queries, duration, growth = self.request(path)
+            times.append(duration)
+            memory = max(memory, growth)
+
+            cached_queries, duration, growth = self.request(path)[1:]
+            cached_times.append(duration)
+            memory = max(memory, growth)
+
+        return {
+            'path': path,
+            'status': status,
+            'queries': queries,
+            'cached_queries': cached_queries,
+            'time': median(times),
+            'cached_time': median(cached_times),
+            'memory': memory,
+        }
+
+    def run(self, urls=None):
+        """ Measure all benchmark URLs, return the results. """
+        if urls is None:
+            urls = get_benchmark_urls(self.catalog)
+
+        views = {}
+        for name, path in urls:
+            views[name] = self.measure(path)
+
+            logger.debug(u'Benchmarked %s: %s', name, views[name])
+
+        return {'catalog': self.catalog.get_sizes(), 'views': views}
+
+
+def compare_results(baseline, results,
+                    query_tolerance=BENCHMARK_QUERY_TOLERANCE,
+                    time_tolerance=BENCHMARK_TIME_TOLERANCE,
+                    memory_tolerance=BENCHMARK_MEMORY_TOLERANCE):
+    """
+    Compare benchmark results with a baseline, returning a list of messages
+    describing regressions. Views missing from either side are ignored.
+    """
+    regressions = []
+
+    if baseline.get('catalog') != results.get('catalog'):
+        regressions.append(u'Catalog %s differs from baseline catalog %s' % \
+                           (results.get('catalog'), baseline.get('catalog')))
+        return regressions
+
+    for name in sorted(results['views']):
+        current = results['views'][name]
+        previous = baseline['views'].get(name)
+
+        if not previous:
+            continue
+
+        if current['status'] != previous['status']:
+            regressions.append(u'%s: status %d, was %d' % \
+                (name, current['status'], previous['status']))
+
+        for key in ('queries', 'cached_queries'):
+            if current[key] > previous[key] + query_tolerance:
+                regressions.append(u'%s: %d %s, was %d' % \
+                    (name, current[key], key.replace('_', ' '),
+                     previous[key]))
+
+        for key in ('time', 'cached_time'):
+            if current[key] > previous[key] * time_tolerance:
+                regressions.append(u'%s: %s %.1f ms, was %.1f ms' % \
+                    (name, key.replace('_', ' '), current[key] * 1000,
+                     previous[key] * 1000))
+
+        if current['memory'] > previous['memory'] + memory_tolerance:
+            regressions.append(u'%s: peak memory grew %d kB, was %d kB' % \
+                (name, current['memory'], previous['memory']))
+
+    return regressions
@@ -0,0 +1,183 @@
+"""
+Cached, per-language alphabetical brand directory.
+
+The directory lists brands by their translated name, grouped by first
+letter, with the URL and a logo thumbnail of every brand. It is built from
+a single query and stored in Django's cache, and invalidated by
+`basic_webshop.listeners.BrandDirectoryInvalidate` whenever a brand or brand
+translation is saved or deleted, and after thumbnails have been rendered.
+Logos without a rendered thumbnail are listed with their original URL.
+
+The brand choices for the admin filters are cached and invalidated along
+with the directory.
+"""
+
+import string
+
+import logging
+logger = logging.getLogger(__name__)
+
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.utils.datastructures import SortedDict
+from django.utils.translation import get_language
+
+from basic_webshop.thumbnails import BRAND_LOGO_SIZE, get_cached_thumbnail
+
+
+BRAND_DIRECTORY_TIMEOUT = getattr(settings,
+                                  'SHOPKIT_BRAND_DIRECTORY_TIMEOUT',
+                                  60*60*24)
+
+
+def get_first_letter(name):
+    """ First ASCII letter of a name, for grouping. """
+    for c in name.upper():
+        if c in string.ascii_uppercase:
+            return c
+
+    # give A if we cant find any letters.
+    return 'A'
+
+
+class BrandEntry(namedtuple('BrandEntry', 'slug name logo url')):
+    """
+    Brand in the directory. Provides the attributes of `Brand` used in
+    brand listings, without database access.
+    """
+
+    __slots__ = ()
+
+    def __unicode__(self):
+        return self.name
+
+    def get_absolute_url(self):
+        return self.url
+
+
+def get_logo_url(logo):
+    """
+    URL of the logo thumbnail rendered by the `generate_thumbnails`
+    command, or of the original logo when it has not been rendered yet.
+    """
+    from django.core.files.storage import default_storage
+
+    geometry, options = BRAND_LOGO_SIZE
+
+    thumbnail = get_cached_thumbnail(logo, geometry, options)
+    if thumbnail:
+        return thumbnail.url
+
+    return default_storage.url(logo)
+
+
+class BrandDirectory(object):
+    """
+    Brands with a translation in a single language, ordered by name and
+    grouped by first letter in `letters`. Iterating over the directory
+    yields all brands in order.
+    """
+
+    def __init__(self, language_code):
+        self.language_code = language_code
+
+        self.brands = []
+        self.letters = SortedDict()
+
+    def __iter__(self):
+        return iter(self.brands)
+
+    def __len__(self):
+        return len(self.brands)
+
+    @classmethod
+    def build(cls, language_code):
+        """ Build the directory for a language from a single query. """
+        from basic_webshop.models import Brand
+
+        directory = cls(language_code)
+
+        rows = Brand.objects.filter(
+            translations__language_code=language_code).values_list(
+            'slug', 'logo', 'translations__name')
+
+        url_template = reverse('brand_detail',
+                               kwargs={'slug': 'brand-slug-placeholder'})
+
+        for slug, logo, name in rows:
+            if logo:
+                logo = get_logo_url(logo)
+
+            url = url_template.replace('brand-slug-placeholder', slug)
+
+            directory.brands.append(BrandEntry(slug, name, logo or None,
+                                               url))
+
+        directory.brands.sort(key=lambda brand: brand.name.lower())
+
+        for brand in directory.brands:
+            letter = get_first_letter(brand.name)
+            directory.letters.setdefault(letter, []).append(brand)
+
+        logger.debug(u'Built brand directory with %d brands for language %s',
+                     len(directory.brands), language_code)
+
+        return directory
+
+
+def _get_cache_key(language_code):
+    return 'basic_webshop.brand_directory.%s' % language_code
+
+
+def _get_choices_cache_key(language_code):
+    return 'basic_webshop.brand_choices.%s' % language_code
+
+
+def get_brand_directory(language_code=None):
+    """ Return the (cached) brand directory for the given or current language. """
+    if not language_code:
+        language_code = get_language()
+
+    cache_key = _get_cache_key(language_code)
+
+    directory = cache.get(cache_key)
+    if directory is None:
+        directory = BrandDirectory.build(language_code)
+        cache.set(cache_key, directory, BRAND_DIRECTORY_TIMEOUT)
+
+    return directory
+
+
+def get_brand_choices(language_code=None):
+    """
+    (pk, name) choices for all brands in the given or current language,
+    including brands without a translation in it.
+    """
+    from basic_webshop.models import Brand
+
+    if not language_code:
+        language_code = get_language()
+
+    cache_key = _get_choices_cache_key(language_code)
+
+    choices = cache.get(cache_key)
+    if choices is None:
+        brands = list(Brand.objects.all())
+        Brand.prefetch_names(brands, language_code)
+
+        choices = [(brand.pk, unicode(brand)) for brand in brands]
+        cache.set(cache_key, choices, BRAND_DIRECTORY_TIMEOUT)
+
+    return choices
+
+
+def invalidate_brand_directory():
+    """ Invalidate the brand directories for all languages. """
+    logger.debug(u'Invalidating brand directories')
+
+    for language_code, language_name in settings.LANGUAGES:
+        cache.delete_many((_get_cache_key(language_code),
+                           _get_choices_cache_key(language_code)))
@@ -0,0 +1,679 @@
+"""
+Bulk import and export of the catalog as CSV or JSON lines.
+
+Every row describes a product in a single language::
+
+    slug, article_number, active, price, stock, unit, brand, categories,
+    variations, language_code, name, description
+
+`brand` is a brand slug and `categories` a list of category paths, like
+`fruit/tropical`. `variations` lists variation slugs with their stock, like
+`small:10`. In CSV files lists are separated by `|`, in JSON lines they are
+plain lists. Only product fields present in a row are updated.
+
+Imports are done in batched transactions, using raw saves and multi-row
+inserts and updates so no per-row signal handlers or custom `save()` methods
+run. Listings, the search index, category product counts and cached pages
+are updated in a single pass at the end.
+"""
+
+import csv
+import datetime
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction, router, connections
+from django.db import models
+from django.utils import simplejson
+
+from basic_webshop.models import Product, ProductTranslation, \
+                                 ProductVariation, ProductListing, Brand, \
+                                 Category
+
+
+PRODUCT_FIELDS = ('slug', 'article_number', 'active', 'price', 'stock',
+                  'unit', 'brand', 'categories', 'variations')
+TRANSLATION_FIELDS = ('language_code', 'name', 'description')
+COLUMNS = PRODUCT_FIELDS + TRANSLATION_FIELDS
+
+LIST_SEPARATOR = '|'
+
+
+class CatalogImportError(Exception):
+    """ Thrown for rows which cannot be imported. """
+    pass
+
+
+def split_list(value):
+    """ Interpret a list or a `|` separated string as a list. """
+    if isinstance(value, (list, tuple)):
+        return list(value)
+
+    if not value:
+        return []
+
+    return [item.strip() for item in value.split(LIST_SEPARATOR) \
+            if item.strip()]
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+
+    return unicode(value).strip().lower() in ('1', 'true', 'yes', 'y')
+
+
+def parse_variations(value):
+    """ Return a list of (slug, stock) tuples. """
+    variations = []
+
+    for variation in split_list(value):
+        if isinstance(variation, dict):
+            slug, stock = variation['slug'], variation.get('stock', 0)
+        else:
+            slug, sep, stock = variation.partition(':')
+
+        variations.append((slug, int(stock or 0)))
+
+    return variations
+
+
+def batched(iterable, size):
+    """ Generate lists of at most `size` items. """
+    batch = []
+
+    for item in iterable:
+        batch.append(item)
+
+        if len(batch) >= size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def read_csv(stream):
+    """ Generate rows from a UTF-8 encoded CSV file with a header. """
+    for row in csv.DictReader(stream):
+        yield dict((key, value.decode('utf-8')) \
+                   for key, value in row.iteritems() if value is not None)
+
+
+def read_jsonl(stream):
+    """ Generate rows from a file with one JSON object per line. """
+    for line in stream:
+        line = line.strip()
+
+        if line:
+            yield simplejson.loads(line)
+
+
+def write_csv(stream, rows):
+    writer = csv.DictWriter(stream, COLUMNS)
+    writer.writerow(dict(zip(COLUMNS, COLUMNS)))
+
+    for row in rows:
+        row = row.copy()
+        row['categories'] = LIST_SEPARATOR.join(row['categories'])
+        row['variations'] = LIST_SEPARATOR.join(
+            [u'%s:%d' % (slug, stock) for slug, stock in row['variations']])
+
+        writer.writerow(dict((key, unicode(value).encode('utf-8')) \
+                             for key, value in row.iteritems()))
+
+
+def write_jsonl(stream, rows):
+    for row in rows:
+        row = row.copy()
+        row['variations'] = [{'slug': slug, 'stock': stock} \
+                             for slug, stock in row['variations']]
+
+        stream.write(simplejson.dumps(row))
+        stream.write('\n')
+
+
+def insert_rows(model, instances, using):
+    """
+    Insert new model instances with a single `executemany`, without
+    sending signals. The instances do not get their pk set.
+    """
+    if not instances:
+        return
+
+    connection = connections[using]
+    qn = connection.ops.quote_name
+
+    fields = [field for field in model._meta.local_fields \
+              if not isinstance(field, models.AutoField)]
+
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        qn(model._meta.db_table),
+        ', '.join([qn(field.column) for field in fields]),
+        ', '.join(['%s'] * len(fields)))
+
+    params = [[field.get_db_prep_save(field.pre_save(instance, True),
+                                      connection=connection) \
+               for field in fields] for instance in instances]
+
+    connection.cursor().executemany(sql, params)
+    transaction.set_dirty(using=using)
+
+
+def update_rows(model, instances, field_names, using):
+    """
+    Update the given fields of existing model instances with a single
+    `executemany`, without sending signals.
+    """
+    if not instances:
+        return
+
+    connection = connections[using]
+    qn = connection.ops.quote_name
+
+    fields = [model._meta.get_field(name) for name in field_names]
+    pk = model._meta.pk
+
+    sql = 'UPDATE %s SET %s WHERE %s = %%s' % (
+        qn(model._meta.db_table),
+        ', '.join(['%s = %%s' % qn(field.column) for field in fields]),
+        qn(pk.column))
+
+    params = [[field.get_db_prep_save(getattr(instance, field.attname),
+                                      connection=connection) \
+               for field in fields] + [instance.pk] \
+              for instance in instances]
+
+    connection.cursor().executemany(sql, params)
+    transaction.set_dirty(using=using)
+
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl}
+WRITERS = {'csv': write_csv, 'jsonl': write_jsonl}
+
+
+class CatalogImporter(object):
+    """
+    Upsert products, translations, categories, variations and stock from
+    rows in batched transactions.
+
+    In a dry run, every batch is rolled back and missing categories are
+    reported rather than created. `progress` is called after each batch with
+    the number of processed rows and the elapsed time.
+
+    Products and categories touched by a batch are only remembered for the
+    final updates once the batch has been committed.
+    """
+
+    def __init__(self, batch_size=500, dry_run=False, progress=None):
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.progress = progress
+
+        self.stats = dict.fromkeys(('rows', 'products_created',
+                                    'products_updated', 'translations',
+                                    'variations', 'categories_created',
+                                    'errors'), 0)
+        self.errors = []
+        self.missing_categories = set()
+
+        # Products and categories of which listings and counts should be
+        # updated
+        self.touched = set()
+        self.touched_categories = set()
+
+    def load_lookups(self):
+        """ Load brands and category paths, one query each. """
+        self.brands = dict(Brand.objects.values_list('slug', 'pk'))
+
+        self.categories = {}
+        paths = {}
+        for pk, parent_id, slug in Category.objects.order_by(
+                'tree_id', 'lft').values_list('pk', 'parent', 'slug'):
+            path = paths.get(parent_id, ()) + (slug, )
+
+            paths[pk] = path
+            self.categories[path] = pk
+
+    def get_category(self, path):
+        """
+        Return the pk of the category for a path like `fruit/tropical`,
+        creating missing categories unless this is a dry run.
+        """
+        path = tuple(slug for slug in path.split('/') if slug)
+
+        if path in self.categories:
+            return self.categories[path]
+
+        if self.dry_run:
+            self.missing_categories.add(path)
+            return None
+
+        parent_id = None
+        for depth in xrange(1, len(path) + 1):
+            if not path[:depth] in self.categories:
+                category = Category(slug=path[depth-1])
+
+                if parent_id:
+                    parent = Category.objects.get(pk=parent_id)
+                else:
+                    parent = None
+
+                # Have MPTT set the tree fields, so the category can be
+                # saved without sending signals for a regular save
+                Category._tree_manager.insert_node(category, parent)
+                category.save_base(raw=True)
+
+                self.categories[path[:depth]] = category.pk
+                self.batch_categories.append(path[:depth])
+                self.stats['categories_created'] += 1
+
+            parent_id = self.categories[path[:depth]]
+
+        return parent_id
+
+    def parse_row(self, row):
+        """ Validate and convert a row, raising `CatalogImportError`. """
+        data = {}
+
+        try:
+            data['slug'] = row['slug'].strip()
+        except (KeyError, AttributeError):
+            raise CatalogImportError('No slug specified')
+
+        if not data['slug']:
+            raise CatalogImportError('No slug specified')
+
+        try:
+            if row.get('price') not in (None, ''):
+                data['price'] = Decimal(unicode(row['price']))
+
+            if row.get('stock') not in (None, ''):
+                data['stock'] = int(row['stock'])
+
+            if 'variations' in row:
+                data['variations'] = parse_variations(row['variations'])
+
+        except (ValueError, InvalidOperation) as e:
+            raise CatalogImportError(unicode(e))
+
+        if row.get('brand'):
+            try:
+                data['brand_id'] = self.brands[row['brand']]
+            except KeyError:
+                raise CatalogImportError('Unknown brand %s' % row['brand'])
+
+        if 'active' in row:
+            data['active'] = parse_bool(row['active'])
+
+        for field in ('article_number', 'unit'):
+            if field in row:
+                data[field] = row[field] or ''
+
+        if 'categories' in row:
+            data['categories'] = split_list(row['categories'])
+
+        if row.get('language_code'):
+            data['language_code'] = row['language_code']
+            data['name'] = row.get('name') or ''
+            data['description'] = row.get('description') or ''
+
+        return data
+
+    def run(self, rows):
+        """ Import all rows and finish with the deferred updates. """
+        self.load_lookups()
+
+        start = time.time()
+
+        for batch in batched(enumerate(rows, 1), self.batch_size):
+            self.import_batch(batch)
+
+            if self.progress:
+                self.progress(self.stats['rows'], time.time() - start)
+
+        if not self.dry_run:
+            self.finish()
+
+        logger.info(u'Imported %d rows in %.1f seconds: %s',
+                    self.stats['rows'], time.time() - start, self.stats)
+
+        return self.stats
+
+    def import_batch(self, batch):
+        """ Import a batch of (line, row) tuples in a single transaction. """
+        self.using = using = router.db_for_write(Product)
+
+        self.batch_touched = set()
+        self.batch_touched_categories = set()
+        self.batch_categories = []
+
+        transaction.enter_transaction_management(using=using)
+        transaction.managed(True, using=using)
+        try:
+            self._import_batch(batch)
+        except:
+            transaction.rollback(using=using)
+            self.forget_batch()
+            raise
+        else:
+            if self.dry_run:
+                transaction.rollback(using=using)
+                self.forget_batch()
+            else:
+                transaction.commit(using=using)
+
+                self.touched.update(self.batch_touched)
+                self.touched_categories.update(
+                    self.batch_touched_categories)
+        finally:
+            transaction.leave_transaction_management(using=using)
+
+    def forget_batch(self):
+        """ Drop the categories created in a rolled back batch. """
+        for path in self.batch_categories:
+            del self.categories[path]
+
+    def add_error(self, line, message):
+        logger.warning(u'Skipping line %d: %s', line, message)
+
+        self.errors.append((line, message))
+        self.stats['errors'] += 1
+
+    def _import_batch(self, batch):
+        parsed = []
+        for line, row in batch:
+            self.stats['rows'] += 1
+
+            try:
+                parsed.append((line, self.parse_row(row)))
+            except CatalogImportError as e:
+                self.add_error(line, unicode(e))
+
+        if not parsed:
+            return
+
+        # Products
+        slugs = set(data['slug'] for line, data in parsed)
+        products = dict((product.slug, product) \
+                        for product in Product.objects.filter(slug__in=slugs))
+
+        created = set()
+        valid = []
+        for line, data in parsed:
+            product = products.get(data['slug'])
+            if not product:
+                missing = [field for field in ('article_number', 'price') \
+                           if not data.get(field)]
+                if missing:
+                    self.add_error(line, 'New product %s requires %s' % \
+                        (data['slug'], ', '.join(missing)))
+                    continue
+
+                product = Product(slug=data['slug'])
+                products[data['slug']] = product
+                created.add(data['slug'])
+
+            valid.append((line, data))
+
+            for field in ('article_number', 'active', 'price', 'stock',
+                          'unit', 'brand_id'):
+                if field in data:
+                    setattr(product, field, data[field])
+
+        # Raw saves keep the current value of auto_now fields
+        now = datetime.datetime.now()
+
+        for slug, product in products.iteritems():
+            product.date_modified = now
+            product.save_base(raw=True)
+            self.batch_touched.add(product.pk)
+
+        self.stats['products_created'] += len(created)
+        self.stats['products_updated'] += len(products) - len(created)
+
+        parsed = valid
+        product_ids = [product.pk for product in products.itervalues()]
+
+        self.import_translations(parsed, products, product_ids)
+        self.import_categories(parsed, products, product_ids)
+        self.import_variations(parsed, products, product_ids)
+
+    def import_translations(self, parsed, products, product_ids):
+        translations = dict(((translation.parent_id,
+                              translation.language_code), translation) \
+            for translation in ProductTranslation.objects.filter(
+                parent__in=product_ids))
+
+        created = {}
+        updated = {}
+        for line, data in parsed:
+            if not 'language_code' in data:
+                continue
+
+            product = products[data['slug']]
+            key = (product.pk, data['language_code'])
+
+            translation = translations.get(key)
+            if translation:
+                updated[key] = translation
+            else:
+                translation = ProductTranslation(
+                    parent=product, language_code=data['language_code'])
+                translations[key] = translation
+                created[key] = translation
+
+            translation.name = data['name']
+            translation.description = data['description']
+
+            self.stats['translations'] += 1
+
+        insert_rows(ProductTranslation, created.values(), self.using)
+        update_rows(ProductTranslation, updated.values(),
+                    ('name', 'description'), self.using)
+
+    def import_categories(self, parsed, products, product_ids):
+        wanted = {}
+        for line, data in parsed:
+            if not 'categories' in data:
+                continue
+
+            category_ids = wanted.setdefault(products[data['slug']].pk, set())
+            for path in data['categories']:
+                category_id = self.get_category(path)
+
+                if category_id:
+                    category_ids.add(category_id)
+
+        if not wanted:
+            return
+
+        through = Product.categories.through
+
+        current = {}
+        for pk, product_id, category_id in through.objects.filter(
+                product__in=wanted.keys()).values_list('pk', 'product',
+                                                       'category'):
+            current.setdefault(product_id, {})[category_id] = pk
+
+        removed = []
+        added = []
+        for product_id, category_ids in wanted.iteritems():
+            existing = current.get(product_id, {})
+
+            for category_id in set(existing) - category_ids:
+                removed.append(existing[category_id])
+                self.batch_touched_categories.add(category_id)
+
+            for category_id in category_ids - set(existing):
+                added.append(through(product_id=product_id,
+                                     category_id=category_id))
+
+            self.batch_touched_categories.update(category_ids)
+
+        if removed:
+            through.objects.filter(pk__in=removed).delete()
+
+        insert_rows(through, added, self.using)
+
+    def import_variations(self, parsed, products, product_ids):
+        variations = {}
+        sort_orders = {}
+        for variation in ProductVariation.objects.filter(
+                product__in=product_ids):
+            variations[(variation.product_id, variation.slug)] = variation
+            sort_orders[variation.product_id] = max(
+                sort_orders.get(variation.product_id, 0),
+                variation.sort_order or 0)
+
+        created = {}
+        updated = {}
+        for line, data in parsed:
+            if not 'variations' in data:
+                continue
+
+            product = products[data['slug']]
+
+            for slug, stock in data['variations']:
+                key = (product.pk, slug)
+                variation = variations.get(key)
+
+                if not variation:
+                    sort_orders[product.pk] = \
+                        sort_orders.get(product.pk, 0) + 10
+
+                    variation = ProductVariation(
+                        product=product, slug=slug,
+                        sort_order=sort_orders[product.pk])
+                    variations[key] = variation
+                    created[key] = variation
+
+                elif variation.stock == stock:
+                    continue
+
+                elif not key in created:
+                    updated[key] = variation
+
+                variation.stock = stock
+
+                self.stats['variations'] += 1
+
+        insert_rows(ProductVariation, created.values(), self.using)
+        update_rows(ProductVariation, updated.values(), ('stock', ),
+                    self.using)
+
+    def finish(self):
+        """
+        Update listings, the search index, category product counts and
+        cached pages for all imported products in a single pass.
+        """
+        from basic_webshop.search import get_search_backend
+        from basic_webshop.page_cache import bump_catalog_version
+        from basic_webshop.category_tree import invalidate_category_tree
+
+        search_backend = get_search_backend()
+
+        category_ids = set(self.touched_categories)
+        through = Product.categories.through
+
+        product_ids = sorted(self.touched)
+        for batch in batched(product_ids, self.batch_size):
+            products = Product.objects.filter(pk__in=batch)
+
+            for product in products:
+                ProductListing.update_for_product(product)
+
+            search_backend.update_products(products)
+
+            # Product changes affect the counts of all their categories
+            category_ids.update(through.objects.filter(
+                product__in=batch).values_list('category', flat=True))
+
+        # Also invalidates the category tree when counts changed
+        Category.update_product_counts(category_ids)
+
+        if self.stats['categories_created']:
+            invalidate_category_tree()
+
+        bump_catalog_version()
+
+
+class CatalogExporter(object):
+    """
+    Generate rows for all products, fetching related data per batch of
+    products rather than per product.
+    """
+
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+
+    def iter_rows(self):
+        brands = dict(Brand.objects.values_list('pk', 'slug'))
+
+        paths = {}
+        for pk, parent_id, slug in Category.objects.order_by(
+                'tree_id', 'lft').values_list('pk', 'parent', 'slug'):
+            paths[pk] = paths.get(parent_id, ()) + (slug, )
+
+        last_pk = 0
+        while True:
+            # Keyset pagination, so we never load the whole catalog
+            products = list(Product.objects.filter(pk__gt=last_pk).order_by(
+                'pk').values_list('pk', 'slug', 'article_number', 'active',
+                                  'price', 'stock', 'unit',
+                                  'brand')[:self.batch_size])
+            if not products:
+                break
+
+            last_pk = products[-1][0]
+            product_ids = [product[0] for product in products]
+
+            translations = {}
+            for parent_id, language_code, name, description in \
+                    ProductTranslation.objects.filter(
+                        parent__in=product_ids).order_by(
+                        'language_code').values_list(
+                        'parent', 'language_code', 'name', 'description'):
+                translations.setdefault(parent_id, []).append(
+                    (language_code, name, description))
+
+            categories = {}
+            for product_id, category_id in \
+                    Product.categories.through.objects.filter(
+                        product__in=product_ids).values_list('product',
+                                                             'category'):
+                categories.setdefault(product_id, []).append(
+                    '/'.join(paths[category_id]))
+
+            variations = {}
+            for product_id, slug, stock in ProductVariation.objects.filter(
+                    product__in=product_ids).order_by(
+                    'sort_order').values_list('product', 'slug', 'stock'):
+                variations.setdefault(product_id, []).append((slug, stock))
+
+            for pk, slug, article_number, active, price, stock, unit, \
+                    brand_id in products:
+                row = {
+                    'slug': slug,
+                    'article_number': article_number,
+                    'active': active,
+                    'price': unicode(price),
+                    'stock': stock,
+                    'unit': unit,
+                    'brand': brands.get(brand_id, ''),
+                    'categories': sorted(categories.get(pk, [])),
+                    'variations': variations.get(pk, []),
+                }
+
+                for language_code, name, description in \
+                        translations.get(pk, [('', '', '')]):
+                    translated = row.copy()
+                    translated.update({'language_code': language_code,
+                                       'name': name,
+                                       'description': description})
+
+                    yield translated
@@ -0,0 +1,198 @@
+"""
+Cached, per-language in-memory category tree for navigation.
+
+The tree is built from a single query over all categories and their
+translations in MPTT order and stored in Django's cache. It is invalidated
+by `basic_webshop.listeners.CategoryTreeInvalidate` whenever a category or
+category translation is saved or deleted.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.utils.translation import get_language
+
+
+CATEGORY_TREE_TIMEOUT = getattr(settings, 'SHOPKIT_CATEGORY_TREE_TIMEOUT',
+                                60*60*24)
+
+URL_NAMES = ('category_detail', 'subcategory_detail', 'subsubcategory_detail')
+URL_KWARGS = ('category_slug', 'subcategory_slug', 'subsubcategory_slug')
+
+
+class CategoryNode(object):
+    """
+    Node in the category tree. Provides the attributes and methods of
+    `Category` used for navigation, without database access.
+    """
+
+    def __init__(self, pk, slug, level, active, product_count=0):
+        self.pk = pk
+        self.slug = slug
+        self.level = level
+        self.active = active
+
+        # Products in the shop in this category or its subcategories
+        self.product_count = product_count
+
+        self.name = slug
+        self.url = None
+        self.parent = None
+        self.children = []
+
+    def __unicode__(self):
+        return self.name
+
+    def __repr__(self):
+        return '<CategoryNode: %d>' % self.pk
+
+    def get_absolute_url(self):
+        return self.url
+
+    def get_subcategories(self):
+        """ Active child nodes. """
+        return [child for child in self.children if child.active]
+
+    def get_ancestors(self, include_self=False):
+        """ Ancestors of this node, starting at the root. """
+        ancestors = []
+
+        node = self
+        if not include_self:
+            node = node.parent
+
+        while node:
+            ancestors.insert(0, node)
+            node = node.parent
+
+        return ancestors
+
+    def is_active(self):
+        """ Whether this node and all of its ancestors are active. """
+        for node in self.get_ancestors(include_self=True):
+            if not node.active:
+                return False
+
+        return True
+
+
+class CategoryTree(object):
+    """ Tree of `CategoryNode` objects for a single language. """
+
+    def __init__(self, language_code):
+        self.language_code = language_code
+
+        self.nodes = {}
+        self.roots = []
+
+    @classmethod
+    def build(cls, language_code):
+        """ Build the tree for a language from a single query. """
+        from basic_webshop.models import Category
+
+        tree = cls(language_code)
+
+        rows = Category.objects.order_by('tree_id', 'lft').values_list(
+            'pk', 'parent', 'slug', 'level', 'active',
+            'in_shop_product_count', 'translations__language_code',
+            'translations__name')
+
+        names = {}
+        for pk, parent_id, slug, level, active, product_count, \
+                name_language, name in rows:
+            if not pk in tree.nodes:
+                node = CategoryNode(pk, slug, level, active, product_count)
+                tree.nodes[pk] = node
+
+                # MPTT order guarantees parents come before children
+                if parent_id:
+                    node.parent = tree.nodes[parent_id]
+                    node.parent.children.append(node)
+                else:
+                    tree.roots.append(node)
+
+            if name:
+                names.setdefault(pk, {})[name_language] = name
+
+        for pk, node in tree.nodes.iteritems():
+            node_names = names.get(pk)
+            if node_names:
+                node.name = node_names.get(language_code) or \
+                            node_names.get(settings.LANGUAGE_CODE) or \
+                            node_names.values()[0]
+
+            node.url = tree._make_url(node)
+
+        logger.debug(u'Built category tree with %d nodes for language %s',
+                     len(tree.nodes), language_code)
+
+        return tree
+
+    def _make_url(self, node):
+        """ Generate the URL for a node based on its ancestors' slugs. """
+        slugs = [ancestor.slug \
+                 for ancestor in node.get_ancestors(include_self=True)]
+
+        # Deeper levels are represented by their last three slugs
+        slugs = slugs[-len(URL_NAMES):]
+
+        return reverse(URL_NAMES[len(slugs)-1],
+                       kwargs=dict(zip(URL_KWARGS, slugs)))
+
+    def get_node(self, pk):
+        """ Return the node for the category with given pk or `None`. """
+        return self.nodes.get(pk)
+
+    def get_main_categories(self):
+        """ Active root nodes. """
+        return [node for node in self.roots if node.active]
+
+    def get_by_slugs(self, *slugs):
+        """
+        Return the active node for the given path of slugs, starting at a
+        main category, or `None` when not found.
+        """
+        children = self.get_main_categories()
+        node = None
+
+        for slug in slugs:
+            for child in children:
+                if child.slug == slug:
+                    node = child
+                    break
+            else:
+                return None
+
+            children = node.get_subcategories()
+
+        return node
+
+
+def _get_cache_key(language_code):
+    return 'basic_webshop.category_tree.%s' % language_code
+
+
+def get_category_tree(language_code=None):
+    """ Return the (cached) category tree for the given or current language. """
+    if not language_code:
+        language_code = get_language()
+
+    cache_key = _get_cache_key(language_code)
+
+    tree = cache.get(cache_key)
+    if tree is None:
+        tree = CategoryTree.build(language_code)
+        cache.set(cache_key, tree, CATEGORY_TREE_TIMEOUT)
+
+    return tree
+
+
+def invalidate_category_tree():
+    """ Invalidate the category trees for all languages. """
+    logger.debug(u'Invalidating category trees')
+
+    for language_code, language_name in settings.LANGUAGES:
+        cache.delete(_get_cache_key(language_code))
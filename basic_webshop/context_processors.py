@@ -0,0 +1,22 @@
+from basic_webshop.category_tree import get_category_tree
+from basic_webshop.page_cache import get_catalog_version
+
+
+def categories(request):
+    """
+    Add the active main categories from the cached category tree to the
+    context as `main_categories`. Enable by adding
+    `basic_webshop.context_processors.categories` to
+    `TEMPLATE_CONTEXT_PROCESSORS`.
+    """
+    tree = get_category_tree()
+
+    return {'main_categories': tree.get_main_categories()}
+
+
+def catalog_version(request):
+    """
+    Add the current catalog version to the context as `catalog_version`,
+    for use as a key in `{% cache %}` template fragments.
+    """
+    return {'catalog_version': get_catalog_version()}
@@ -0,0 +1,248 @@
+"""
+Cached eligibility index for discounts.
+
+The index maps products, categories and coupon codes to the discounts
+which might apply to them, along with the date window of each discount.
+It is built from three queries and stored in Django's cache, so checking
+the discounts for a full cart is a single lookup. The index is invalidated
+by `basic_webshop.listeners.DiscountIndexInvalidate` whenever a discount or
+its product and category restrictions change.
+
+Use counts change whenever an order is confirmed, so they are not part of
+the index: `filter_available` checks the use limits of candidate discounts
+in the query fetching them.
+"""
+
+import datetime
+
+import logging
+logger = logging.getLogger(__name__)
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, Q
+
+
+DISCOUNT_INDEX_TIMEOUT = getattr(settings, 'SHOPKIT_DISCOUNT_INDEX_TIMEOUT',
+                                 60*60*24)
+
+CACHE_KEY = 'basic_webshop.discount_index'
+
+
+class DiscountEntry(object):
+    """ Eligibility conditions for a single discount. """
+
+    def __init__(self, pk, start_date, end_date, coupon_code):
+        self.pk = pk
+        self.start_date = start_date
+        self.end_date = end_date
+        self.coupon_code = coupon_code
+
+        self.products = set()
+        self.categories = set()
+
+    def __repr__(self):
+        return '<DiscountEntry: %d>' % self.pk
+
+    def is_restricted(self):
+        """ Whether this discount only applies to some products. """
+        return bool(self.products or self.categories)
+
+    def is_active(self, now):
+        """ Whether the date window allows this discount. """
+        if self.start_date and _compare_date(self.start_date, now) > 0:
+            return False
+
+        if self.end_date and _compare_date(self.end_date, now) < 0:
+            return False
+
+        return True
+
+    def applies_to(self, product_id, category_ids):
+        """
+        Whether this discount applies to a product within the given
+        categories, including their ancestors.
+        """
+        if not self.is_restricted():
+            return True
+
+        if product_id in self.products:
+            return True
+
+        return bool(self.categories & category_ids)
+
+
+def _compare_date(value, now):
+    """ Compare a date or datetime against the current datetime. """
+    if not isinstance(value, datetime.datetime):
+        now = now.date()
+
+    return cmp(value, now)
+
+
+class DiscountIndex(object):
+    """
+    Index of active discounts by product, category and coupon code.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+        self.general = set()
+        self.by_product = {}
+        self.by_category = {}
+        self.by_coupon = {}
+
+    @classmethod
+    def build(cls):
+        """ Build the index from the discounts in the database. """
+        from basic_webshop.models import Discount
+
+        index = cls()
+
+        rows = Discount.objects.values_list('pk', 'start_date', 'end_date',
+                                            'use_coupon', 'coupon_code')
+
+        for pk, start_date, end_date, use_coupon, coupon_code in rows:
+            if not use_coupon:
+                coupon_code = None
+
+            index.entries[pk] = DiscountEntry(pk, start_date, end_date,
+                                              coupon_code)
+
+        through = Discount.products.through.objects
+        for discount_id, product_id in through.values_list('discount',
+                                                           'product'):
+            index.entries[discount_id].products.add(product_id)
+            index.by_product.setdefault(product_id, set()).add(discount_id)
+
+        through = Discount.categories.through.objects
+        for discount_id, category_id in through.values_list('discount',
+                                                            'category'):
+            index.entries[discount_id].categories.add(category_id)
+            index.by_category.setdefault(category_id, set()).add(discount_id)
+
+        for entry in index.entries.itervalues():
+            if entry.coupon_code:
+                index.by_coupon.setdefault(entry.coupon_code,
+                                           set()).add(entry.pk)
+            elif not entry.is_restricted():
+                index.general.add(entry.pk)
+
+        logger.debug(u'Built discount index with %d discounts',
+                     len(index.entries))
+
+        return index
+
+    def get_entry(self, discount_id):
+        """ Return the `DiscountEntry` for a discount or `None`. """
+        return self.entries.get(discount_id)
+
+    def get_coupon_ids(self, coupon_code, now=None):
+        """ Active discount ids for a coupon code. """
+        if not now:
+            now = datetime.datetime.now()
+
+        return set(pk for pk in self.by_coupon.get(coupon_code, ()) \
+                   if self.entries[pk].is_active(now))
+
+    def get_valid_ids(self, coupon_code=None, products=None, now=None):
+        """
+        Active discount ids for an order or cart.
+
+        `products` maps product ids to the sets of category ids they are
+        in, including ancestors. Restricted discounts are only returned
+        when they apply to at least one of these products.
+        """
+        if not now:
+            now = datetime.datetime.now()
+
+        if not products:
+            products = {}
+
+        candidates = set(self.general)
+
+        if coupon_code:
+            candidates.update(self.by_coupon.get(coupon_code, ()))
+
+        for product_id, category_ids in products.iteritems():
+            candidates.update(self.by_product.get(product_id, ()))
+
+            for category_id in category_ids:
+                candidates.update(self.by_category.get(category_id, ()))
+
+        valid = set()
+        for pk in candidates:
+            entry = self.entries[pk]
+
+            if not entry.is_active(now):
+                continue
+
+            if entry.coupon_code and entry.coupon_code != coupon_code:
+                continue
+
+            if entry.is_restricted():
+                for product_id, category_ids in products.iteritems():
+                    if entry.applies_to(product_id, category_ids):
+                        break
+                else:
+                    continue
+
+            valid.add(pk)
+
+        return valid
+
+
+def get_product_categories(product_ids):
+    """
+    Map the given product ids to the ids of their categories and all
+    ancestors thereof, from a single query and the cached category tree.
+    """
+    from basic_webshop.models import Product
+    from basic_webshop.category_tree import get_category_tree
+
+    products = dict((product_id, set()) for product_id in product_ids)
+    if not products:
+        return products
+
+    tree = get_category_tree()
+
+    through = Product.categories.through.objects
+    for product_id, category_id in through.filter(
+            product__in=products.keys()).values_list('product', 'category'):
+        node = tree.get_node(category_id)
+
+        if node:
+            products[product_id].update(ancestor.pk for ancestor in \
+                node.get_ancestors(include_self=True))
+        else:
+            products[product_id].add(category_id)
+
+    return products
+
+
+def filter_available(discounts):
+    """
+    Restrict a queryset of discounts to those which have not reached their
+    use limit, so use counts are checked within the query fetching them.
+    """
+    return discounts.filter(Q(use_limit__isnull=True) | Q(use_limit=0) | \
+                            Q(used__lt=F('use_limit')))
+
+
+def get_discount_index():
+    """ Return the (cached) discount index. """
+    index = cache.get(CACHE_KEY)
+
+    if index is None:
+        index = DiscountIndex.build()
+        cache.set(CACHE_KEY, index, DISCOUNT_INDEX_TIMEOUT)
+
+    return index
+
+
+def invalidate_discount_index():
+    """ Invalidate the cached discount index. """
+    logger.debug(u'Invalidating discount index')
+
+    cache.delete(CACHE_KEY)
@@ -3,6 +3,15 @@ These settings should be imported in `settings.py` by adding::
 
     from basic_webshop.django_settings import *
 
+Optionally, add the context processors providing the cached main
+categories as `main_categories` and the catalog version for template
+fragment caching as `catalog_version` to `TEMPLATE_CONTEXT_PROCESSORS`::
+
+    'basic_webshop.context_processors.categories',
+    'basic_webshop.context_processors.catalog_version',
+
+The shop's own templates load the main categories with the
+`get_main_categories` tag from `category_tags` instead.
 """
 
 from basic_webshop.order_states import ORDER_STATES
@@ -4,7 +4,10 @@ logger = logging.getLogger(__name__)
 from django import forms
 from django.utils.translation import ugettext_lazy as _
 
-from basic_webshop.models import ProductRating, Address, Cart, CartItem, Discount
+from basic_webshop.models import ProductRating, Address, Cart, CartItem, \
+                                  Product, Discount
+from basic_webshop.discount_index import get_discount_index, \
+                                         filter_available
 
 
 class RatingForm(forms.ModelForm):
@@ -67,7 +70,10 @@ class CartAddForm(forms.Form):
 
         cartitem = self.cart.get_item(product=self.product)
         total_quantity = cartitem.quantity + quantity
-        if not self.product.is_available(total_quantity):
+
+        availability = Product.get_availability([self.product.pk],
+                                                total_quantity)
+        if not availability.get(self.product.pk):
             raise forms.ValidationError(self.quantity_error)
 
         return quantity
@@ -90,13 +96,10 @@ class CartItemForm(forms.ModelForm):
         quantity = self.cleaned_data['quantity']
 
         assert self.instance
-        cartitem = self.instance
-        product = cartitem.product
-
-        cartitem = cartitem.cart.get_item(product=product)
-        total_quantity = quantity
+        product_id = self.instance.product_id
 
-        if not product.is_available(total_quantity):
+        availability = Product.get_availability([product_id], quantity)
+        if not availability.get(product_id):
             raise forms.ValidationError(self.quantity_error)
 
         return quantity
@@ -144,12 +147,10 @@ class CartDiscountCouponForm(forms.ModelForm):
 
         logger.debug('Checking coupong code validity for %s' % coupon_code)
 
-        valid_discounts = Discount.get_valid_discounts(
-                                            coupon_code=coupon_code,
-                                            order_discounts=True,
-                                            item_discounts=True)
+        discount_ids = get_discount_index().get_coupon_ids(coupon_code)
+        discounts = Discount.objects.filter(pk__in=discount_ids)
 
-        if not valid_discounts.exists():
+        if not discount_ids or not filter_available(discounts).exists():
             raise forms.ValidationError(self.coupon_code_error)
 
         return coupon_code
@@ -24,8 +24,13 @@ class Listener(object):
                 pass
 
         funkysignal.connect(MySillyListener.as_view(), weak=False)
+
+    Listeners with `ignore_raw` set are skipped for raw saves, as done when
+    loading fixtures or importing the catalog in bulk.
     """
 
+    ignore_raw = False
+
     def __init__(self, **kwargs):
         """
         Constructor. Called in the URLconf; can contain helpful extra
@@ -43,15 +48,14 @@ class Listener(object):
         """
         # sanitize keyword arguments
         for key in initkwargs:
-            if key in cls.http_method_names:
-                raise TypeError(u"You tried to pass in the %s method name as a "
-                                u"keyword argument to %s(). Don't do that."
-                                % (key, cls.__name__))
             if not hasattr(cls, key):
                 raise TypeError(u"%s() received an invalid keyword %r" % (
                     cls.__name__, key))
 
         def listener(sender, **kwargs):
+            if cls.ignore_raw and kwargs.get('raw'):
+                return
+
             self = cls(**initkwargs)
             return self.dispatch(sender, **kwargs)
 
@@ -70,8 +74,13 @@ from django.core.mail import EmailMessage
 from django.template.loader import render_to_string
 from django.contrib.sites.models import Site
 
+MAIL_QUEUE = getattr(settings, 'SHOPKIT_MAIL_QUEUE', False)
 class EmailingListener(Listener):
-    """ Listener which sends out emails. """
+    """
+    Listener which sends out emails. When `SHOPKIT_MAIL_QUEUE` is `True`,
+    messages are queued and sent by the `send_queued_mail` management
+    command rather than within the signal.
+    """
 
     body_template_name = None
     subject_template_name = None
@@ -151,7 +160,13 @@ class EmailingListener(Listener):
 
         message = self.create_message(context)
 
-        message.send()
+        if MAIL_QUEUE:
+            # Leave delivery to the `send_queued_mail` management command
+            from basic_webshop.models import QueuedMessage
+
+            QueuedMessage.from_message(message)
+        else:
+            message.send()
 
 from django.utils import translation
 
@@ -249,8 +264,29 @@ class OrderClosedNotPaidStatusChange(OrderPaymentListener):
         order.save()
 
 
+PAYMENT_QUEUE = getattr(settings, 'SHOPKIT_PAYMENT_QUEUE', True)
+class PaymentStatusRecord(Listener):
+    """
+    Record payment status changes in the `PaymentStatusEvent` ledger,
+    discarding duplicates. Unless `SHOPKIT_PAYMENT_QUEUE` is `False`,
+    handling the change is left to the `process_payment_events` management
+    command rather than done within the callback request.
+    """
+
+    def dispatch(self, sender, **kwargs):
+        from basic_webshop.models import PaymentStatusEvent
+
+        event = PaymentStatusEvent.record(sender)
+
+        if event and not PAYMENT_QUEUE:
+            event.process()
+
+
 class StatusChangeListener(Listener):
-    """ Listener for order status changes """
+    """
+    Listener for order status changes. Rather than being connected
+    directly, listeners are usually dispatched by `OrderStateMachine`.
+    """
 
     def dispatch(self, sender, **kwargs):
         assert self.state
@@ -271,6 +307,52 @@ class StatusChangeListener(Listener):
         raise NotImplementedError('Better give me some function to fulfill')
 
 
+def build_transition_table(listeners):
+    """
+    Map valid (old_state, new_state) transitions to the
+    `StatusChangeListener` classes which should handle them. Listeners
+    without an `old_state` handle every valid transition into their `state`.
+    """
+    table = {}
+
+    for old_state, new_state in order_states.VALID_TRANSITIONS:
+        for listener in listeners:
+            if listener.state != new_state:
+                continue
+
+            listener_old_state = getattr(listener, 'old_state', None)
+            if not listener_old_state is None and \
+               listener_old_state != old_state:
+                continue
+
+            table.setdefault((old_state, new_state), []).append(listener)
+
+    return table
+
+
+class OrderStateMachine(Listener):
+    """
+    Single listener for `order_state_change`, which looks up the handlers
+    for a transition in a table made by `build_transition_table`.
+    """
+
+    transitions = None
+
+    def dispatch(self, sender, old_state, new_state, **kwargs):
+        listeners = self.transitions.get((old_state, new_state))
+
+        if listeners is None:
+            if not old_state is None and old_state != new_state and \
+               not order_states.is_valid_transition(old_state, new_state):
+                logger.warning(u'Invalid state transition for %s from %s '
+                               u'to %s', sender, old_state, new_state)
+            return
+
+        for listener in listeners:
+            listener().handler(sender, old_state=old_state,
+                               new_state=new_state, **kwargs)
+
+
 class OrderPaidConfirm(StatusChangeListener):
     """ Confirm paid orders. """
 
@@ -404,4 +486,443 @@ class CustomerRegistrationEmail(TranslatedEmailingListener):
 
         context['customer'] = self.customer
 
-        return context
\ No newline at end of file
+        return context
+
+from django.db.models.signals import post_delete, pre_delete
+
+class ProductListingUpdate(Listener):
+    """
+    Update the denormalized listings for a product when the product or one
+    of its translations is saved or deleted.
+    """
+
+    ignore_raw = True
+
+    def dispatch(self, sender, instance, **kwargs):
+        from basic_webshop.models import Product, ProductListing
+
+        if isinstance(instance, Product):
+            product = instance
+        elif kwargs['signal'] is post_delete:
+            # Translation deleted, possibly along with its product
+            listings = ProductListing.objects.filter(
+                product=instance.parent_id,
+                language_code=instance.language_code)
+            listings.delete()
+            return
+        else:
+            product = instance.parent
+
+            if not product.slug:
+                # The translation's `update_slug` saves the product, which
+                # rebuilds the listings once the slug is known.
+                return
+
+            listed_values = [tuple(getattr(instance, field) for field in \
+                ProductTranslationListingTracker.listed_fields)]
+            if getattr(instance, '_listing_values', None) == listed_values:
+                # Nothing that is listed changed
+                return
+
+        logger.debug(u'Updating listings for product %d', product.pk)
+        ProductListing.update_for_product(product)
+
+
+class ProductTranslationListingTracker(Listener):
+    """
+    Remember the listed fields of a product translation before it is saved,
+    so that `ProductListingUpdate` can skip saves which leave the listings
+    unchanged.
+    """
+
+    ignore_raw = True
+
+    listed_fields = ('language_code', 'name')
+
+    def dispatch(self, sender, instance, **kwargs):
+        if instance.pk:
+            qs = sender.objects.filter(pk=instance.pk)
+            instance._listing_values = list(
+                qs.values_list(*self.listed_fields))
+        else:
+            instance._listing_values = None
+
+
+class ProductCategoriesListingUpdate(Listener):
+    """ Rebuild listings when products are added to or removed from categories. """
+
+    def dispatch(self, sender, instance, action, reverse, pk_set, **kwargs):
+        from basic_webshop.models import Product, ProductListing
+
+        if not action in ('post_add', 'post_remove', 'post_clear'):
+            return
+
+        if not reverse:
+            # Categories for a single product changed
+            ProductListing.update_for_product(instance)
+            return
+
+        # Products for a single category changed
+        if pk_set is None:
+            # Cleared: rebuild whatever was listed in this category
+            products = Product.objects.filter(listings__category=instance)
+        else:
+            products = Product.objects.filter(pk__in=pk_set)
+
+        for product in products.distinct():
+            ProductListing.update_for_product(product)
+
+
+class ProductStockListingUpdate(Listener):
+    """ Update the stock flag on listings when a variation changes. """
+
+    ignore_raw = True
+
+    def dispatch(self, sender, instance, **kwargs):
+        from basic_webshop.models import Product, ProductListing
+
+        try:
+            product = Product.objects.get(pk=instance.product_id)
+        except Product.DoesNotExist:
+            # The variation is deleted along with its product
+            return
+
+        listings = ProductListing.objects.filter(product=product)
+        listings.update(in_stock=product.is_available())
+
+
+class ProductImageListingUpdate(Listener):
+    """ Update the default image on listings when product images change. """
+
+    ignore_raw = True
+
+    def dispatch(self, sender, instance, **kwargs):
+        from basic_webshop.models import Product, ProductListing
+
+        try:
+            product = Product.objects.get(pk=instance.product_id)
+        except Product.DoesNotExist:
+            # The image is deleted along with its product
+            return
+
+        listings = ProductListing.objects.filter(product=product)
+        listings.update(image=ProductListing.get_image_path(product))
+
+
+class BrandListingUpdate(Listener):
+    """ Update the brand slug on listings when a brand is saved. """
+
+    def dispatch(self, sender, instance, **kwargs):
+        from basic_webshop.models import ProductListing
+
+        listings = ProductListing.objects.filter(brand=instance)
+        listings.exclude(brand_slug=instance.slug).update(
+            brand_slug=instance.slug)
+
+
+class BrandTranslationListingUpdate(Listener):
+    """ Update the brand name on listings when a brand translation is saved. """
+
+    def dispatch(self, sender, instance, **kwargs):
+        from basic_webshop.models import ProductListing
+
+        listings = ProductListing.objects.filter(
+            brand=instance.parent, language_code=instance.language_code)
+        listings.update(brand_name=instance.name)
+
+
+class CategoryParentListingTracker(Listener):
+    """
+    Remember the parent of a category before it is saved, so that
+    `CategoryParentListingUpdate` knows whether the tree changed.
+    """
+
+    def dispatch(self, sender, instance, **kwargs):
+        if instance.pk:
+            qs = sender.objects.filter(pk=instance.pk)
+            instance._listing_parent_ids = list(
+                qs.values_list('parent', flat=True))
+        else:
+            instance._listing_parent_ids = None
+
+
+class CategoryParentListingUpdate(Listener):
+    """
+    Rebuild the listings for all products within a category when it has
+    been moved to another parent: the set of ancestors changed.
+    """
+
+    def dispatch(self, sender, instance, created, **kwargs):
+        from basic_webshop.models import ProductListing
+
+        if created:
+            return
+
+        old_parent_ids = getattr(instance, '_listing_parent_ids', None)
+        if old_parent_ids == [instance.parent_id]:
+            return
+
+        logger.debug(u'Category %d moved, updating product listings',
+                     instance.pk)
+
+        categories = instance.get_descendants(include_self=True)
+        ProductListing.update_for_categories(categories)
+
+
+class FeaturedProductListingUpdate(Listener):
+    """ Update featured flags on listings when featured products change. """
+
+    def dispatch(self, sender, instance, **kwargs):
+        from basic_webshop.models import ProductListing
+
+        listings = ProductListing.objects.filter(product=instance.product_id,
+                                                 category=instance.category_id)
+
+        if kwargs['signal'] is post_delete:
+            listings.update(featured=False, featured_order=None)
+        else:
+            listings.update(featured=True,
+                            featured_order=instance.featured_order)
+
+
+
+class CategoryTreeInvalidate(Listener):
+    """ Invalidate the cached category trees when categories change. """
+
+    def dispatch(self, sender, instance, **kwargs):
+        from basic_webshop.category_tree import invalidate_category_tree
+
+        invalidate_category_tree()
+
+
+class ProductRatingStatsUpdate(Listener):
+    """ Update rating statistics when a rating is saved or deleted. """
+
+    def dispatch(self, sender, instance, **kwargs):
+        from basic_webshop.models import Product, ProductRatingStats
+
+        # The rating might be deleted along with its product
+        if kwargs['signal'] is post_delete and \
+           not Product.objects.filter(pk=instance.product_id).exists():
+            return
+
+        ProductRatingStats.update_for(instance.product_id, instance.language)
+
+
+class CatalogVersionBump(Listener):
+    """
+    Bump the catalog version, invalidating cached catalog pages. For
+    many-to-many changes the version is bumped once, after the change.
+    """
+
+    ignore_raw = True
+
+    def dispatch(self, sender, **kwargs):
+        from basic_webshop.page_cache import bump_catalog_version
+
+        action = kwargs.get('action')
+        if action and not action in ('post_add', 'post_remove', 'post_clear'):
+            return
+
+        bump_catalog_version()
+
+
+class DiscountIndexInvalidate(Listener):
+    """ Invalidate the cached discount index when discounts change. """
+
+    def dispatch(self, sender, instance, **kwargs):
+        from basic_webshop.discount_index import invalidate_discount_index
+
+        invalidate_discount_index()
+
+
+class ThumbnailEnqueue(Listener):
+    """ Queue the configured thumbnail sizes for saved images. """
+
+    def dispatch(self, sender, instance, **kwargs):
+        from basic_webshop.models import ThumbnailJob
+
+        ThumbnailJob.enqueue(instance)
+
+
+class ProductCategoriesCountUpdate(Listener):
+    """
+    Update category product counters when products are added to or removed
+    from categories.
+    """
+
+    def dispatch(self, sender, instance, action, reverse, pk_set, **kwargs):
+        from basic_webshop.models import Category
+
+        if reverse:
+            # Products for a single category changed
+            if action in ('post_add', 'post_remove', 'post_clear'):
+                Category.update_product_counts([instance.pk])
+
+        elif action == 'pre_clear':
+            instance._counted_category_ids = instance.get_category_ids()
+
+        elif action == 'post_clear':
+            Category.update_product_counts(
+                getattr(instance, '_counted_category_ids', []))
+
+        elif action in ('post_add', 'post_remove'):
+            Category.update_product_counts(pk_set)
+
+
+class ProductCountTracker(Listener):
+    """
+    Remember whether a product was active before it is saved, and its
+    categories before it is deleted, for `ProductCountUpdate`.
+    """
+
+    ignore_raw = True
+
+    def dispatch(self, sender, instance, **kwargs):
+        if not instance.pk:
+            instance._counted_active = None
+        elif kwargs['signal'] is pre_delete:
+            instance._counted_category_ids = instance.get_category_ids()
+        else:
+            qs = sender.objects.filter(pk=instance.pk)
+            instance._counted_active = list(
+                qs.values_list('active', flat=True))
+
+
+class ProductCountUpdate(Listener):
+    """
+    Update category product counters when a product is activated,
+    deactivated or deleted.
+    """
+
+    ignore_raw = True
+
+    def dispatch(self, sender, instance, **kwargs):
+        from basic_webshop.models import Category
+
+        if kwargs['signal'] is post_delete:
+            category_ids = getattr(instance, '_counted_category_ids', [])
+
+        else:
+            # New products are counted once added to categories
+            old_active = getattr(instance, '_counted_active', None)
+            if not old_active or old_active == [instance.active]:
+                return
+
+            category_ids = instance.get_category_ids()
+
+        Category.update_product_counts(category_ids)
+
+
+class CategoryCountUpdate(Listener):
+    """
+    Update the product counters of the former and new ancestors of a
+    category when it is moved or deleted, as they include the products of
+    their descendants.
+    """
+
+    def dispatch(self, sender, instance, **kwargs):
+        if kwargs['signal'] is post_delete:
+            category_ids = [instance.parent_id]
+
+        else:
+            # Remembered by `CategoryParentListingTracker`
+            old_parent_ids = getattr(instance, '_listing_parent_ids', None)
+            if kwargs['created'] or old_parent_ids == [instance.parent_id]:
+                return
+
+            category_ids = (old_parent_ids or []) + [instance.pk]
+
+        sender.update_product_counts(
+            [pk for pk in category_ids if pk])
+
+
+class BrandDirectoryInvalidate(Listener):
+    """ Invalidate the cached brand directories when brands change. """
+
+    def dispatch(self, sender, instance, **kwargs):
+        from basic_webshop.brand_directory import invalidate_brand_directory
+
+        invalidate_brand_directory()
+
+
+class ProductSearchUpdate(Listener):
+    """
+    Update the search index for a product when the product or one of its
+    translations is saved or deleted.
+    """
+
+    ignore_raw = True
+
+    def dispatch(self, sender, instance, **kwargs):
+        from basic_webshop.models import Product
+        from basic_webshop.search import get_search_backend
+
+        search_backend = get_search_backend()
+
+        if isinstance(instance, Product):
+            product = instance
+        elif kwargs['signal'] is post_delete:
+            # Translation deleted, possibly along with its product
+            search_backend.remove_translation(instance.parent_id,
+                                              instance.language_code)
+            return
+        else:
+            product = instance.parent
+
+            if not product.slug:
+                # The translation's `update_slug` saves the product, which
+                # updates the index once more.
+                return
+
+        search_backend.update_product(product)
+
+
+class ProductCategoriesSearchUpdate(Listener):
+    """ Update the search index when product categories change. """
+
+    def dispatch(self, sender, instance, action, reverse, pk_set, **kwargs):
+        from basic_webshop.models import Product
+        from basic_webshop.search import get_search_backend
+
+        if action == 'pre_clear' and reverse:
+            # Remember the products of a category before they are removed
+            instance._search_product_ids = list(
+                instance.product_set.values_list('pk', flat=True))
+            return
+
+        if not action in ('post_add', 'post_remove', 'post_clear'):
+            return
+
+        search_backend = get_search_backend()
+
+        if not reverse:
+            # Categories for a single product changed
+            search_backend.update_product(instance)
+            return
+
+        # Products for a single category changed
+        if pk_set is None:
+            pk_set = getattr(instance, '_search_product_ids', [])
+
+        search_backend.update_products(Product.objects.filter(pk__in=pk_set))
+
+
+class NameSearchUpdate(Listener):
+    """
+    Update the search index for the products of a brand or category when
+    one of its translations is saved or deleted.
+    """
+
+    ignore_raw = True
+
+    def dispatch(self, sender, instance, **kwargs):
+        from basic_webshop.models import Product, BrandTranslation
+        from basic_webshop.search import get_search_backend
+
+        if isinstance(instance, BrandTranslation):
+            products = Product.objects.filter(brand=instance.parent_id)
+        else:
+            products = Product.objects.filter(categories=instance.parent_id)
+
+        get_search_backend().update_products(products.distinct())
@@ -0,0 +1,63 @@
+import time
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.dispatch import Signal
+
+from basic_webshop.models import Order, ORDER_STATE_LISTENERS
+from basic_webshop.listeners import OrderStateMachine, build_transition_table
+from basic_webshop.order_states import VALID_TRANSITIONS
+
+
+def noop_handler(self, sender, **kwargs):
+    pass
+
+
+class Command(NoArgsCommand):
+    help = 'Benchmark the signal dispatch cost per order state change, ' \
+           'comparing per-listener fan-out with the transition table.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--iterations', action='store', type='int',
+                    dest='iterations', default=10000,
+                    help='Number of times each transition is dispatched.'),
+    )
+
+    def benchmark(self, signal, iterations):
+        """ Return the average dispatch time per state change in seconds. """
+        order = Order(order_number='benchmark')
+        transitions = sorted(VALID_TRANSITIONS)
+
+        start = time.time()
+        for x in xrange(iterations):
+            for old_state, new_state in transitions:
+                order.state = new_state
+                signal.send(sender=order, old_state=old_state,
+                            new_state=new_state, state_change=None)
+
+        return (time.time() - start) / (iterations * len(transitions))
+
+    def handle_noargs(self, **options):
+        iterations = options['iterations']
+
+        # Measure dispatch only, without sending mail or confirming orders
+        listeners = [type(listener.__name__, (listener, ),
+                          {'handler': noop_handler}) \
+                     for listener in ORDER_STATE_LISTENERS]
+
+        fanout = Signal()
+        for listener in listeners:
+            fanout.connect(listener.as_listener(), weak=False)
+
+        table = Signal()
+        table.connect(OrderStateMachine.as_listener(
+            transitions=build_transition_table(listeners)), weak=False)
+
+        fanout_time = self.benchmark(fanout, iterations)
+        table_time = self.benchmark(table, iterations)
+
+        return 'Per-listener fan-out: %.2f us per state change\n' \
+               'Transition table: %.2f us per state change\n' \
+               'Speedup: %.1fx\n' % (fanout_time * 1e6, table_time * 1e6,
+                                     fanout_time / table_time)
@@ -0,0 +1,89 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+from django.utils import simplejson
+
+from basic_webshop.benchmark import CatalogGenerator, ViewBenchmark, \
+                                    compare_results
+
+
+class Command(NoArgsCommand):
+    help = 'Benchmark query counts, timings and memory usage of all public ' \
+           'views against a synthetic catalog in a test database. Fails ' \
+           'when results regress compared to a baseline.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--products', action='store', type='int',
+                    dest='products', default=100,
+                    help='Number of products to generate.'),
+        make_option('--categories', action='store', type='int',
+                    dest='categories', default=12,
+                    help='Number of categories to generate.'),
+        make_option('--brands', action='store', type='int',
+                    dest='brands', default=10,
+                    help='Number of brands to generate.'),
+        make_option('--languages', action='store', dest='languages',
+                    help='Comma separated language codes for translations. '
+                         'Defaults to all languages in LANGUAGES.'),
+        make_option('--repeat', action='store', type='int',
+                    dest='repeat', default=3,
+                    help='Number of times each URL is measured.'),
+        make_option('--output', action='store', dest='output',
+                    help='Write results as JSON to this file.'),
+        make_option('--baseline', action='store', dest='baseline',
+                    help='Compare results with this JSON file.'),
+        make_option('--noinput', action='store_false', dest='interactive',
+                    default=True,
+                    help='Do not prompt before destroying an old test '
+                         'database.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        languages = None
+        if options['languages']:
+            languages = options['languages'].split(',')
+
+        baseline = None
+        if options['baseline']:
+            baseline = simplejson.load(open(options['baseline']))
+
+        old_name = settings.DATABASES['default']['NAME']
+        connection.creation.create_test_db(
+            verbosity, autoclobber=not options['interactive'])
+
+        try:
+            catalog = CatalogGenerator(products=options['products'],
+                                       categories=options['categories'],
+                                       brands=options['brands'],
+                                       languages=languages).generate()
+
+            results = ViewBenchmark(catalog, repeat=options['repeat']).run()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity)
+
+        if options['output']:
+            output = open(options['output'], 'w')
+            try:
+                simplejson.dump(results, output, indent=2, sort_keys=True)
+            finally:
+                output.close()
+
+        if baseline:
+            regressions = compare_results(baseline, results)
+            if regressions:
+                raise CommandError('Benchmark regressions:\n%s' % \
+                                   '\n'.join(regressions))
+
+        lines = []
+        for name in sorted(results['views']):
+            view = results['views'][name]
+            lines.append('%-32s %3d %4d queries %7.1f ms, cached %4d '
+                         'queries %7.1f ms' % \
+                (name, view['status'], view['queries'], view['time'] * 1000,
+                 view['cached_queries'], view['cached_time'] * 1000))
+
+        return '\n'.join(lines) + '\n'
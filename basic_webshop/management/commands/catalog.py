@@ -0,0 +1,103 @@
+import sys
+
+import logging
+logger = logging.getLogger(__name__)
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from basic_webshop.catalog_io import CatalogImporter, CatalogExporter, \
+                                     READERS, WRITERS
+
+
+class Command(BaseCommand):
+    help = 'Import or export the catalog as CSV or JSON lines. Use - for ' \
+           'standard input or output.'
+    args = '<import|export> <file>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', action='store', dest='format',
+                    help='File format, csv or jsonl. Defaults to the file '
+                         'extension.'),
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=500,
+                    help='Number of rows per transaction.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Validate and report without changing anything.'),
+    )
+
+    def get_format(self, filename, format):
+        if not format:
+            format = filename.rsplit('.', 1)[-1]
+
+        if not format in READERS:
+            raise CommandError('Unknown format %s, please use --format.' % \
+                               format)
+
+        return format
+
+    def handle(self, *args, **options):
+        if len(args) != 2 or not args[0] in ('import', 'export'):
+            raise CommandError('Usage: catalog %s' % self.args)
+
+        action, filename = args
+        format = self.get_format(filename, options['format'])
+        verbosity = int(options.get('verbosity', 1))
+
+        if action == 'import':
+            return self.handle_import(filename, format, verbosity, **options)
+
+        return self.handle_export(filename, format, verbosity, **options)
+
+    def handle_import(self, filename, format, verbosity, **options):
+        def progress(rows, elapsed):
+            if verbosity > 0:
+                sys.stderr.write('Processed %d rows (%.0f rows/s)\n' % \
+                                 (rows, rows / max(elapsed, 0.001)))
+
+        importer = CatalogImporter(batch_size=options['batch_size'],
+                                   dry_run=options['dry_run'],
+                                   progress=progress)
+
+        if filename == '-':
+            stream = sys.stdin
+        else:
+            stream = open(filename, 'rb')
+
+        try:
+            stats = importer.run(READERS[format](stream))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        if verbosity > 0:
+            for line, message in importer.errors:
+                sys.stderr.write('Line %d: %s\n' % (line, message))
+
+            for path in sorted(importer.missing_categories):
+                sys.stderr.write('Missing category %s\n' % '/'.join(path))
+
+            if options['dry_run']:
+                sys.stderr.write('Dry run, nothing has been changed\n')
+
+            return 'Imported %(rows)d rows: %(products_created)d products ' \
+                   'created, %(products_updated)d updated, ' \
+                   '%(translations)d translations, %(variations)d ' \
+                   'variations, %(categories_created)d categories ' \
+                   'created, %(errors)d errors\n' % stats
+
+    def handle_export(self, filename, format, verbosity, **options):
+        exporter = CatalogExporter(batch_size=options['batch_size'])
+
+        if filename == '-':
+            stream = sys.stdout
+        else:
+            stream = open(filename, 'wb')
+
+        try:
+            WRITERS[format](stream, exporter.iter_rows())
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
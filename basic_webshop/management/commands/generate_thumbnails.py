@@ -0,0 +1,64 @@
+import logging
+logger = logging.getLogger(__name__)
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from basic_webshop.models import ThumbnailJob, ProductImage, BrandImage, \
+                                 Brand, Category
+from basic_webshop.thumbnails import THUMBNAIL_PROCESSES
+from basic_webshop.brand_directory import invalidate_brand_directory
+
+
+class Command(NoArgsCommand):
+    help = 'Render queued thumbnails in a pool of worker processes.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=100,
+                    help='Number of thumbnails rendered per batch.'),
+        make_option('--processes', action='store', type='int',
+                    dest='processes', default=THUMBNAIL_PROCESSES,
+                    help='Number of worker processes.'),
+        make_option('--all', action='store_true', dest='all',
+                    default=False,
+                    help='Queue thumbnails for all existing images first.'),
+    )
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+        processes = options['processes']
+        verbosity = int(options.get('verbosity', 1))
+
+        if options['all']:
+            queued = 0
+            for model in (ProductImage, BrandImage, Brand, Category):
+                for instance in model.objects.all():
+                    queued += ThumbnailJob.enqueue(instance)
+
+            logger.info(u'Queued %d thumbnails for existing images', queued)
+
+        # Jobs failing in this run are retried in the next one
+        failed_jobs = set()
+
+        total_rendered = total_failed = 0
+        while True:
+            rendered, failed = ThumbnailJob.render_queued(
+                batch_size=batch_size, processes=processes,
+                exclude=failed_jobs)
+
+            total_rendered += rendered
+            total_failed += failed
+
+            # Stop when all queued jobs have been tried
+            if not rendered and not failed:
+                break
+
+        # Pick up the rendered logo thumbnails
+        if total_rendered:
+            invalidate_brand_directory()
+
+        if verbosity > 0:
+            return 'Rendered %d thumbnails, %d failed\n' % \
+                (total_rendered, total_failed)
@@ -0,0 +1,29 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from basic_webshop.page_cache import get_page_cache_stats, \
+                                     reset_page_cache_stats
+
+
+class Command(NoArgsCommand):
+    help = 'Show hit and miss statistics for the catalog page cache.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--reset', action='store_true', dest='reset',
+                    default=False, help='Reset the counters afterwards.'),
+    )
+
+    def handle_noargs(self, **options):
+        stats = get_page_cache_stats()
+
+        if stats['ratio'] is None:
+            output = 'No page cache requests recorded\n'
+        else:
+            output = 'Hits: %(hits)d, misses: %(misses)d, ' \
+                     'hit ratio: %(ratio).2f\n' % stats
+
+        if options['reset']:
+            reset_page_cache_stats()
+
+        return output
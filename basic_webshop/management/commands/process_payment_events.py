@@ -0,0 +1,38 @@
+import logging
+logger = logging.getLogger(__name__)
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from basic_webshop.models import PaymentStatusEvent
+
+
+class Command(NoArgsCommand):
+    help = 'Process recorded payment status changes for orders.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=100,
+                    help='Number of events processed per batch.'),
+    )
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+        verbosity = int(options.get('verbosity', 1))
+
+        total_processed = total_failed = 0
+        while True:
+            processed, failed = PaymentStatusEvent.process_queued(
+                batch_size=batch_size)
+
+            total_processed += processed
+            total_failed += failed
+
+            # Stop when the queue is drained or only failures remain
+            if not processed:
+                break
+
+        if verbosity > 0:
+            return 'Processed %d payment status events, %d failed\n' % \
+                (total_processed, total_failed)
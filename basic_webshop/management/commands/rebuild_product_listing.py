@@ -0,0 +1,20 @@
+import logging
+logger = logging.getLogger(__name__)
+
+from django.core.management.base import NoArgsCommand
+
+from basic_webshop.models import ProductListing
+
+
+class Command(NoArgsCommand):
+    help = 'Rebuild the denormalized product listings used by category pages.'
+
+    def handle_noargs(self, **options):
+        logger.info('Rebuilding product listings')
+
+        ProductListing.rebuild()
+
+        count = ProductListing.objects.count()
+        logger.info('Created %d product listings', count)
+
+        return 'Created %d product listings\n' % count
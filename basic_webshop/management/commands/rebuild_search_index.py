@@ -0,0 +1,19 @@
+import logging
+logger = logging.getLogger(__name__)
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from basic_webshop.search import get_search_backend
+
+
+class Command(NoArgsCommand):
+    help = 'Rebuild the product search index of the configured backend.'
+
+    def handle_noargs(self, **options):
+        search_backend = get_search_backend()
+
+        logger.info('Rebuilding search index for %s', search_backend)
+
+        with transaction.commit_on_success():
+            search_backend.rebuild()
@@ -0,0 +1,37 @@
+import logging
+logger = logging.getLogger(__name__)
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from basic_webshop.models import QueuedMessage
+
+
+class Command(NoArgsCommand):
+    help = 'Send queued email messages in batches over a single connection.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=100,
+                    help='Number of messages sent per connection.'),
+    )
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+        verbosity = int(options.get('verbosity', 1))
+
+        total_sent = total_failed = 0
+        while True:
+            sent, failed = QueuedMessage.send_queued(batch_size=batch_size)
+
+            total_sent += sent
+            total_failed += failed
+
+            # Stop when the queue is drained or only failures remain
+            if not sent:
+                break
+
+        if verbosity > 0:
+            return 'Sent %d messages, %d failed\n' % \
+                (total_sent, total_failed)
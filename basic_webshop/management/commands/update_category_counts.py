@@ -0,0 +1,18 @@
+import logging
+logger = logging.getLogger(__name__)
+
+from django.core.management.base import NoArgsCommand
+
+from basic_webshop.models import Category
+
+
+class Command(NoArgsCommand):
+    help = 'Recount the denormalized product counters of all categories.'
+
+    def handle_noargs(self, **options):
+        logger.info('Updating category product counts')
+
+        count = Category.update_product_counts()
+        logger.info('Updated product counts for %d categories', count)
+
+        return 'Updated product counts for %d categories\n' % count
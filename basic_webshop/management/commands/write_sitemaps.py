@@ -0,0 +1,47 @@
+import logging
+logger = logging.getLogger(__name__)
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.contrib.sites.models import Site
+
+from basic_webshop.sitemaps import SitemapWriter, SITEMAP_SHARD_SIZE
+
+
+class Command(NoArgsCommand):
+    help = 'Write static, sharded sitemaps and a sitemap index.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--directory', action='store', dest='directory',
+                    help='Directory to write the sitemap files to.'),
+        make_option('--base-url', action='store', dest='base_url',
+                    help='URL the directory is served at, defaults to the '
+                         'domain of the current site.'),
+        make_option('--shard-size', action='store', type='int',
+                    dest='shard_size', default=SITEMAP_SHARD_SIZE,
+                    help='Maximum number of URLs per sitemap file.'),
+        make_option('--no-gzip', action='store_false', dest='compress',
+                    default=True,
+                    help='Write uncompressed sitemap files.'),
+    )
+
+    def handle_noargs(self, **options):
+        directory = options['directory']
+        if not directory:
+            raise CommandError('Please specify a directory with --directory.')
+
+        base_url = options['base_url']
+        if not base_url:
+            base_url = 'http://%s' % Site.objects.get_current().domain
+
+        verbosity = int(options.get('verbosity', 1))
+
+        writer = SitemapWriter(directory, base_url,
+                               compress=options['compress'],
+                               shard_size=options['shard_size'])
+        filenames = writer.write()
+
+        if verbosity > 0:
+            return 'Wrote %d sitemap files and sitemap.xml to %s\n' % \
+                (len(filenames), directory)
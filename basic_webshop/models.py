@@ -2,8 +2,10 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+from collections import namedtuple
 
 from django.conf import settings
+from django.core.exceptions import ValidationError
 
 from django.db import models
 from django.utils.translation import get_language, ugettext_lazy as _
@@ -63,6 +65,17 @@ from countries.fields import CountryField
 
 from docdata.models import PaymentCluster
 
+from basic_webshop.category_tree import get_category_tree
+from basic_webshop.discount_index import get_discount_index, \
+                                         get_product_categories, \
+                                         filter_available
+from basic_webshop.totals import OrderTotals
+from basic_webshop.thumbnails import CATEGORY_HIGHLIGHT_SIZE, \
+                                     get_cached_thumbnail
+from basic_webshop.vat import VAT_CLASS_CHOICES, DEFAULT_VAT_CLASS
+from basic_webshop.order_states import InvalidTransitionException, \
+                                       is_valid_transition
+
 # Silly optimizations for SQLite
 from django.db import connection
 cursor = connection.cursor()
@@ -75,21 +88,22 @@ if cursor.db.vendor == 'sqlite':
 from docdata.signals import payment_status_changed
 
 from shopkit.core.signals import order_state_change
-from basic_webshop.listeners import OrderPaidConfirm, \
-    OrderPaidStatusChange, OrderClosedNotPaidStatusChange, \
+from basic_webshop.listeners import OrderPaidConfirm, PaymentStatusRecord, \
     OrderPaidEmail, OrderFailedEmail, OrderRejectedEmail, OrderShippedEmail, \
-    CustomerRegistrationEmail
+    CustomerRegistrationEmail, OrderStateMachine, build_transition_table
 
 from registration.signals import user_registered
 
 
-payment_status_changed.connect(OrderPaidStatusChange.as_listener(), weak=False)
-payment_status_changed.connect(OrderClosedNotPaidStatusChange.as_listener(), weak=False)
-order_state_change.connect(OrderPaidConfirm.as_listener(), weak=False)
-order_state_change.connect(OrderPaidEmail.as_listener(), weak=False)
-order_state_change.connect(OrderFailedEmail.as_listener(), weak=False)
-order_state_change.connect(OrderRejectedEmail.as_listener(), weak=False)
-order_state_change.connect(OrderShippedEmail.as_listener(), weak=False)
+# Payment status changes go through the PaymentStatusEvent ledger, which
+# in turn calls OrderPaidStatusChange and OrderClosedNotPaidStatusChange
+payment_status_changed.connect(PaymentStatusRecord.as_listener(), weak=False)
+
+# Order state changes are dispatched from a single transition table
+ORDER_STATE_LISTENERS = (OrderPaidConfirm, OrderPaidEmail, OrderFailedEmail,
+                         OrderRejectedEmail, OrderShippedEmail)
+order_state_change.connect(OrderStateMachine.as_listener(
+    transitions=build_transition_table(ORDER_STATE_LISTENERS)), weak=False)
 
 user_registered.connect(CustomerRegistrationEmail.as_listener(), weak=False)
 
@@ -264,6 +278,10 @@ class Product(MultilingualModel, ActiveItemInShopBase, ProductBase, \
                                      symmetrical=True,
                                      verbose_name=_('variations'))
 
+    vat_class = models.CharField(_('VAT class'), max_length=16,
+                                 choices=VAT_CLASS_CHOICES,
+                                 default=DEFAULT_VAT_CLASS)
+
     class Meta(MultilingualModel.Meta, ActiveItemInShopBase.Meta, \
                ProductBase.Meta, CategorizedItemBase.Meta, \
                OrderedItemBase.Meta):
@@ -280,8 +298,138 @@ class Product(MultilingualModel, ActiveItemInShopBase, ProductBase, \
         return self
     display_name.short_description = _('name')
 
+    @classmethod
+    def annotate_rating(cls, queryset, language_code=None):
+        """
+        Annotate products in queryset with `rating_average` and
+        `rating_count` for the given (or current) language, from
+        `ProductRatingStats` using subqueries rather than extra queries.
+        """
+        from django.db import connection
+        from django.utils.datastructures import SortedDict
+
+        if not language_code:
+            language_code = get_language()
+
+        qn = connection.ops.quote_name
+        stats_table = qn(ProductRatingStats._meta.db_table)
+        product_table = qn(cls._meta.db_table)
+
+        subquery = 'SELECT %%s FROM %s WHERE %s.%s = %s.%s AND %s.%s = %%%%s' % \
+            (stats_table, stats_table, qn('product_id'), product_table,
+             qn(cls._meta.pk.column), stats_table, qn('language'))
+
+        select = SortedDict((
+            ('rating_average', subquery % qn('average')),
+            ('rating_count', 'COALESCE((%s), 0)' % (subquery % qn('count'))),
+        ))
+
+        return queryset.extra(select=select,
+                              select_params=(language_code, language_code))
+
+    @classmethod
+    def annotate_stock(cls, queryset):
+        """
+        Annotate products in queryset with the highest stock of their
+        variations as `variation_stock`, so that `is_available` can be
+        determined without querying the variations per product.
+        """
+        return queryset.annotate(
+            variation_stock=models.Max('productvariation__stock'))
+
+    @classmethod
+    def get_availability(cls, product_ids, quantity=1):
+        """
+        Return a dictionary mapping the given product ids to their
+        availability for quantity, using a single aggregate query.
+        """
+        products = cls.annotate_stock(cls.objects.filter(pk__in=product_ids))
+        products = products.values_list('pk', 'stock', 'variation_stock')
+
+        return dict((pk, cls._check_stock(stock, variation_stock, quantity)) \
+                    for pk, stock, variation_stock in products)
+
+    @staticmethod
+    def _check_stock(stock, variation_stock, quantity):
+        """
+        A product is available when any of its variations is in stock,
+        or otherwise when the product itself is.
+        """
+        if variation_stock is not None and variation_stock >= quantity:
+            return True
+
+        return stock >= quantity
+
+    _prefetched_category_ids = None
+    _prefetched_images = None
+
+    @classmethod
+    def prefetch_category_ids(cls, products):
+        """
+        Load the category ids, in tree order, for a list of products in a
+        single query. They are available as `get_category_ids()`.
+        """
+        products = [product for product in products if product.pk]
+        if not products:
+            return
+
+        through = cls.categories.through
+        rows = through.objects.filter(
+            product__in=[product.pk for product in products]).order_by(
+            'category__tree_id', 'category__lft').values_list('product',
+                                                              'category')
+
+        category_ids = {}
+        for product_id, category_id in rows:
+            category_ids.setdefault(product_id, []).append(category_id)
+
+        for product in products:
+            product._prefetched_category_ids = category_ids.get(product.pk,
+                                                                [])
+
+    def get_category_ids(self):
+        """ Ids of the categories of this product, in tree order. """
+        if self._prefetched_category_ids is not None:
+            return self._prefetched_category_ids
+
+        return list(self.categories.order_by(
+            'tree_id', 'lft').values_list('pk', flat=True))
+
+    @classmethod
+    def prefetch_default_images(cls, products):
+        """
+        Load the images for a list of products in a single query, so that
+        `get_default_image` doesn't require a query per product.
+        """
+        products = [product for product in products if product.pk]
+        if not products:
+            return
+
+        images = {}
+        for image in ProductImage.objects.filter(
+                product__in=[product.pk for product in products]):
+            images.setdefault(image.product_id, []).append(image)
+
+        for product in products:
+            product._prefetched_images = images.get(product.pk, [])
+
+    def get_default_image(self):
+        """ Use prefetched images when available. """
+        if self._prefetched_images is not None:
+            if self._prefetched_images:
+                return self._prefetched_images[0]
+
+            return None
+
+        return super(Product, self).get_default_image()
+
     def is_available(self, quantity=1):
         """ Make sure we also check for variations. """
+        if hasattr(self, 'variation_stock'):
+            # Annotated by `annotate_stock`
+            return self._check_stock(self.stock, self.variation_stock,
+                                     quantity)
+
         variations = self.productvariation_set.all()
         if variations.exists():
             for variation in variations:
@@ -334,6 +482,96 @@ class ProductRating(DatedItemBase, models.Model):
         return '%s#' % self.product.get_absolute_url()
 
 
+class ProductRatingStats(models.Model):
+    """
+    Denormalized rating statistics for a product in a single language,
+    updated whenever a `ProductRating` is saved or deleted.
+    """
+
+    class Meta:
+        verbose_name = _('rating statistics')
+        verbose_name_plural = _('rating statistics')
+        unique_together = (('product', 'language'), )
+
+    product = models.ForeignKey(Product, related_name='rating_stats')
+    language = models.CharField(_('language'), max_length=5)
+
+    count = models.PositiveIntegerField(_('count'), default=0)
+    total = models.PositiveIntegerField(_('total'), default=0)
+    average = models.DecimalField(_('average'), max_digits=3,
+                                  decimal_places=2, null=True, blank=True)
+
+    # Histogram of ratings
+    rating_0 = models.PositiveIntegerField(default=0)
+    rating_1 = models.PositiveIntegerField(default=0)
+    rating_2 = models.PositiveIntegerField(default=0)
+    rating_3 = models.PositiveIntegerField(default=0)
+    rating_4 = models.PositiveIntegerField(default=0)
+    rating_5 = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return _(u'%(count)d ratings for %(product)s') % \
+            {'count': self.count,
+             'product': self.product}
+
+    def get_histogram(self):
+        """ List of (rating, count) tuples. """
+        return [(rating, getattr(self, 'rating_%d' % rating)) \
+                for rating, label in ProductRating.RATING_CHOICES]
+
+    @classmethod
+    def get_for(cls, product, language=None):
+        """
+        Return the statistics for a product in the given (or current)
+        language; an empty unsaved instance when there are no ratings.
+        """
+        if not language:
+            language = get_language()
+
+        try:
+            return cls.objects.get(product=product, language=language)
+        except cls.DoesNotExist:
+            return cls(product=product, language=language)
+
+    @classmethod
+    def update_for(cls, product_id, language):
+        """ Recalculate the statistics from the ratings in one query. """
+        from decimal import Decimal
+
+        ratings = ProductRating.objects.filter(product=product_id,
+                                               language=language)
+        ratings = ratings.values_list('rating').annotate(models.Count('pk'))
+        histogram = dict(ratings.order_by())
+
+        try:
+            stats = cls.objects.get(product=product_id, language=language)
+        except cls.DoesNotExist:
+            stats = cls(product_id=product_id, language=language)
+
+        stats.count = sum(histogram.values())
+        stats.total = sum(rating * count \
+                          for rating, count in histogram.iteritems())
+
+        if stats.count:
+            stats.average = (Decimal(stats.total) / stats.count).quantize(
+                Decimal('0.01'))
+        else:
+            stats.average = None
+
+        for rating, label in ProductRating.RATING_CHOICES:
+            setattr(stats, 'rating_%d' % rating, histogram.get(rating, 0))
+
+        stats.save()
+
+        # Keep the product listings in sync
+        listings = ProductListing.objects.filter(product=product_id,
+                                                 language_code=language)
+        listings.update(rating_count=stats.count,
+                        rating_average=stats.average)
+
+        return stats
+
+
 class ProductTranslation(MultilingualTranslation, NamedItemBase):
     class Meta(MultilingualTranslation.Meta, NamedItemBase.Meta):
         unique_together = (('language_code', 'parent',), )
@@ -354,6 +592,26 @@ class ProductTranslation(MultilingualTranslation, NamedItemBase):
         self.parent.update_slug()
 
 
+class ProductSearchToken(models.Model):
+    """
+    Token in the inverted product search index maintained by
+    `basic_webshop.search.IndexSearchBackend`.
+    """
+
+    class Meta:
+        verbose_name = _('search token')
+        verbose_name_plural = _('search tokens')
+        unique_together = (('language_code', 'token', 'product'), )
+
+    language_code = models.CharField(_('language'), max_length=5)
+    token = models.CharField(_('token'), max_length=64)
+    product = models.ForeignKey(Product, related_name='search_tokens')
+    weight = models.PositiveIntegerField(_('weight'), default=1)
+
+    def __unicode__(self):
+        return self.token
+
+
 class ProductVariation(MultilingualModel, OrderedProductVariationBase, \
                        StockedItemMixin, NonUniqueSlugItemBase):
     class Meta(MultilingualModel.Meta, OrderedProductVariationBase.Meta):
@@ -424,9 +682,98 @@ class Cart(ShippedCartMixin,
            CartBase):
     """ Basic shopping cart model. """
 
+    @classmethod
+    def from_request(cls, request):
+        """ Cache the cart on the request, so it is only loaded once. """
+        if not hasattr(request, '_basic_webshop_cart'):
+            request._basic_webshop_cart = \
+                super(Cart, cls).from_request(request)
+
+        return request._basic_webshop_cart
+
+    def to_request(self, request):
+        """ Make sure the cart cached on the request is this one. """
+        super(Cart, self).to_request(request)
+
+        request._basic_webshop_cart = self
+
+    def get_prefetched_items(self):
+        """
+        Return the items in this cart as a list, with their products,
+        brands, variations and translated names loaded in a fixed number
+        of queries. The list is cached on the cart until items are added
+        or removed.
+        """
+        items = getattr(self, '_prefetched_items', None)
+
+        if items is None:
+            items = super(Cart, self).get_items()
+            items = items.select_related(*CartItem.related_fields)
+            items = list(items)
+
+            CartItem.prefetch_related_names(items)
+
+            for item in items:
+                item.cart = self
+
+            self._prefetched_items = items
+
+        return items
+
+    def get_discount_candidates(self):
+        """
+        Return the discount index, the categories of the products in this
+        cart and the valid discounts for them, looked up in the discount
+        eligibility index and loaded in a single query. The result is
+        cached on the cart until items are added or removed or the coupon
+        code changes.
+        """
+        candidates = getattr(self, '_discount_candidates', None)
+
+        if candidates is None or candidates[0] != self.coupon_code:
+            index = get_discount_index()
+
+            product_ids = set(super(Cart, self).get_items().values_list(
+                'product', flat=True))
+            products = get_product_categories(product_ids)
+
+            discount_ids = index.get_valid_ids(coupon_code=self.coupon_code,
+                                               products=products)
+            if discount_ids:
+                discounts = list(filter_available(
+                    Discount.objects.filter(pk__in=discount_ids)))
+            else:
+                discounts = []
+
+            candidates = (self.coupon_code, index, products, discounts)
+            self._discount_candidates = candidates
+
+        return candidates[1:]
+
+    def get_items(self):
+        """
+        While an order is created from this cart, return the prefetched
+        items, so that copying them into order items needs no queries per
+        item.
+        """
+        if getattr(self, '_copying_items', False):
+            return self.get_prefetched_items()
+
+        return super(Cart, self).get_items()
+
+    def remove_item(self, *args, **kwargs):
+        """ Clear the prefetched items and discounts. """
+        self._prefetched_items = None
+        self._discount_candidates = None
+
+        return super(Cart, self).remove_item(*args, **kwargs)
+
     def add_item(self, product, quantity=1, **kwargs):
         """ Make sure we store the variation, if applicable. """
 
+        self._prefetched_items = None
+        self._discount_candidates = None
+
         cartitem = super(Cart, self).add_item(product, quantity, **kwargs)
 
         assert not cartitem.product.productvariation_set.exists() \
@@ -455,6 +802,51 @@ class CartItem(ShippedCartItemMixin,
     Item in a shopping cart.
     """
 
+    related_fields = ('product__brand', 'variation')
+    """ Relations to follow when loading cart items. """
+
+    @classmethod
+    def prefetch_related_names(cls, items):
+        """ Load product and brand names for a list of items at once. """
+        products = [item.product for item in items]
+
+        Product.prefetch_names(products)
+        Brand.prefetch_names([product.brand for product in products])
+
+    def get_valid_discounts(self, order_discounts=False, item_discounts=False,
+                            **kwargs):
+        """
+        Valid discounts for this item, taken from the discounts loaded for
+        the whole cart by `Cart.get_discount_candidates` rather than
+        queried for every item.
+        """
+        index, products, candidates = self.cart.get_discount_candidates()
+        categories = products.get(self.product_id, set())
+
+        discounts = []
+        for discount in candidates:
+            entry = index.get_entry(discount.pk)
+            if not entry or not entry.applies_to(self.product_id, categories):
+                continue
+
+            is_order = bool(discount.order_amount or \
+                            discount.order_percentage)
+            is_item = bool(discount.item_amount or discount.item_percentage)
+
+            if order_discounts or item_discounts:
+                if not (order_discounts and is_order) and \
+                   not (item_discounts and is_item):
+                    continue
+
+            discounts.append(discount)
+
+        # Return a queryset for shopkit, with the results filled in so
+        # evaluating it does not hit the database again
+        valid = Discount.objects.filter(pk__in=[d.pk for d in discounts])
+        valid._result_cache = discounts
+
+        return valid
+
     def get_stocked_item(self):
         """ Return the relevant item for which the stock is kept. """
         if self.variation:
@@ -468,6 +860,26 @@ class OrderStateChange(OrderStateChangeBase):
     #note = models.CharField(blank=True, max_length=255)
 
 
+class OrderNumberSequence(SequenceBase):
+    """ Per-day sequence for order numbers, named by date as YYYYMMDD. """
+
+    class Meta:
+        verbose_name = _('order number sequence')
+        verbose_name_plural = _('order number sequences')
+
+
+class InvoiceNumberSequence(SequenceBase):
+    """ Per-year sequence for invoice numbers, named by year. """
+
+    class Meta:
+        verbose_name = _('invoice number sequence')
+        verbose_name_plural = _('invoice number sequences')
+
+
+ORDER_NUMBER_DIGITS = getattr(settings, 'SHOPKIT_ORDER_NUMBER_DIGITS', 3)
+INVOICE_NUMBER_START = getattr(settings, 'SHOPKIT_INVOICE_NUMBER_START', 1)
+INVOICE_NUMBER_DIGITS = getattr(settings, 'SHOPKIT_INVOICE_NUMBER_DIGITS',
+                                len(str(INVOICE_NUMBER_START)))
 class Order(ShippedOrderMixin,
             StockedOrderMixin,
             DiscountedOrderMixin,
@@ -476,9 +888,48 @@ class Order(ShippedOrderMixin,
             OrderBase):
     """ Basic order model. """
 
+    def __init__(self, *args, **kwargs):
+        super(Order, self).__init__(*args, **kwargs)
+
+        # Keep track of the stored state to validate transitions
+        if self.pk:
+            self._stored_state = self.state
+        else:
+            self._stored_state = None
+
     def __unicode__(self):
         return self.order_number
 
+    def is_valid_transition(self):
+        """ Whether the stored state can change into the current state. """
+        if self._stored_state is None:
+            return True
+
+        return is_valid_transition(self._stored_state, self.state)
+
+    def clean(self):
+        """ Reject invalid state transitions. """
+        super(Order, self).clean()
+
+        if not self.is_valid_transition():
+            raise ValidationError(unicode(InvalidTransitionException(
+                self._stored_state, self.state)))
+
+    def save(self, *args, **kwargs):
+        """
+        Save the order, logging invalid state transitions. These are only
+        rejected by `clean`, so corrections made in the admin and state
+        changes from payment feedback are never lost.
+        """
+        if not self.is_valid_transition():
+            logger.warning(u'Saving %s with invalid state transition: %s',
+                           self, InvalidTransitionException(
+                               self._stored_state, self.state))
+
+        super(Order, self).save(*args, **kwargs)
+
+        self._stored_state = self.state
+
     def get_formatted_address(self):
         """ Formatted shipping address. """
         return self.shipping_address.formatted_address()
@@ -496,9 +947,37 @@ class Order(ShippedOrderMixin,
 
         return ('order_detail', (), {'slug': self.order_number})
 
+    def get_latest_invoice_number(self, year):
+        """
+        Return the number part of the latest invoice number for the given
+        year, or `None` when there are none. Only used to initialize the
+        invoice number sequence for a year.
+        """
+        prefix = str(year)
+
+        invoice_qs = self.__class__.objects.filter(
+            invoice_number__startswith=prefix)
+        invoice_numbers = invoice_qs.values_list('invoice_number', flat=True)
+
+        numbers = [int(invoice_number[len(prefix):]) \
+                   for invoice_number in invoice_numbers \
+                   if invoice_number[len(prefix):].isdigit()]
+
+        if numbers:
+            return max(numbers)
+
+        return None
+
     def generate_invoice_number(self):
         """
-        Generate consequent invoice numbers.
+        Generate consequent invoice numbers according to:
+        YYYYNNN
+
+        NNN is allocated from a per-year `InvoiceNumberSequence`, starting
+        at `SHOPKIT_INVOICE_NUMBER_START`. When called from within a
+        managed transaction (e.g. while confirming an order from a payment
+        status update) the allocation is part of that transaction, so a
+        rolled back confirmation does not consume an invoice number.
         """
 
         assert not self.invoice_number, 'Invoice number already generated.'
@@ -510,30 +989,48 @@ class Order(ShippedOrderMixin,
             from datetime import date
             date = date.today()
 
-        # Query the highest invoice number
-        qs = self.__class__.objects.filter(invoice_number__isnull=False)
-        max_query = qs.aggregate(models.Max('invoice_number'))
-        max_number = max_query['invoice_number__max']
+        def initial():
+            """ Continue after invoices from before the sequence existed. """
+            latest = self.get_latest_invoice_number(date.year)
+
+            if latest is None or latest < INVOICE_NUMBER_START:
+                return INVOICE_NUMBER_START
+
+            return latest + 1
+
+        number = InvoiceNumberSequence.next_value(str(date.year),
+                                                  initial=initial)
+
+        return '%d%0*d' % (date.year, INVOICE_NUMBER_DIGITS, number)
+
+    def get_latest_order_number(self, date):
+        """
+        Return the number part of the latest order number for the given
+        date, or 0 when there are none. Only used to initialize the order
+        number sequence for a day.
+        """
+        datestr = date.isoformat().replace('-','')
 
-        # Make sure we're an cast into int
-        if max_number:
-            max_number = int(max_number)
+        order_qs = self.__class__.objects.all()
+        order_qs = order_qs.filter(order_number__startswith='cos%s' % datestr)
 
-        # Get the starting number from the settings file
-        from django.conf import settings
-        start_number = getattr(settings, 'SHOPKIT_INVOICE_NUMBER_START', 1)
+        try:
+            latest_order = order_qs.order_by('-order_number')[0]
+        except IndexError:
+            return 0
 
-        # When start > max: return start
-        # Otherwise, return max
-        if start_number > max_number:
-            return '%d%d' % (date.year, start_number)
+        order_number = latest_order.order_number[len(datestr)+3:]
+        logger.debug('Current latest order number: %s', order_number)
 
-        return max_number + 1
+        return int(order_number)
 
     def generate_order_number(self):
         """
         Generate order numbers according to:
         cosYYYYMMDDNNN
+
+        NNN is allocated from a per-day `OrderNumberSequence` and has at least
+        `SHOPKIT_ORDER_NUMBER_DIGITS` digits.
         """
         assert not self.invoice_number, 'Invoice number already generated.'
 
@@ -546,51 +1043,43 @@ class Order(ShippedOrderMixin,
 
         datestr = date.isoformat().replace('-','')
 
-        order_qs = self.__class__.objects.all()
-        order_qs = order_qs.filter(date_added__year=date.year)
-        order_qs = order_qs.filter(date_added__month=date.month)
-        order_qs = order_qs.filter(date_added__day=date.day)
-
-        try:
-            # Get today's latest order number
-            latest_order = order_qs.order_by('-order_number')[0]
-
-            # Take last three digits
-            order_number = latest_order.order_number[-3:]
-
-            logger.debug('Current latest order number: %s', order_number)
+        number = OrderNumberSequence.next_value(datestr,
+            initial=lambda: self.get_latest_order_number(date) + 1)
 
-            # Convert to int and add one
-            number = int(order_number) + 1
-
-        except IndexError:
-            number = 1
-
-        order_number = 'cos%s%03d' % (datestr, number)
+        order_number = 'cos%s%0*d' % (datestr, ORDER_NUMBER_DIGITS, number)
         logger.debug('Generated order number: %s', order_number)
 
-        assert not Order.objects.filter(order_number=order_number).exists(), \
-            'Order number not unique'
-
         return order_number
 
     def update(self):
         """
-        Update discounts and shipping costs.
-
-        Note: we might want to integrate this functionality right into
-        the shipping/discounts code. Should be more elegant.
+        Update discounts and shipping costs using `OrderTotals`, which
+        calculates these in a single pass and stores them right away.
+        Returns the `OrderTotals` instance.
         """
         assert self.pk, 'Order should be saved before updating'
 
-        self.update_shipping()
-        self.update_discount()
-        # self.save()
+        totals = OrderTotals(self)
+        totals.update()
+
+        return totals
 
     @classmethod
     def from_cart(self, cart):
-        """ Set coupon code and shipping address """
-        order = super(Order, self).from_cart(cart)
+        """
+        Set coupon code and shipping address. Items are copied from the
+        prefetched cart items.
+        """
+        # Reload, as item quantities may have changed since loading
+        cart._prefetched_items = None
+        assert cart.get_prefetched_items(), 'No items in Cart'
+
+        cart._copying_items = True
+        try:
+            order = super(Order, self).from_cart(cart)
+        finally:
+            cart._copying_items = False
+
         order.coupon_code = cart.coupon_code
 
         # Get default shipping address from customer
@@ -608,6 +1097,31 @@ class Order(ShippedOrderMixin,
                                          verbose_name=_('payment'),
                                          editable=False)
 
+    # Calculated by `OrderTotals`, including shipping and discounts
+    net_price = models.DecimalField(_('net price'), max_digits=10,
+                                    decimal_places=2, default=0,
+                                    editable=False)
+    vat_amount = models.DecimalField(_('VAT'), max_digits=10,
+                                     decimal_places=2, default=0,
+                                     editable=False)
+    gross_price = models.DecimalField(_('gross price'), max_digits=10,
+                                      decimal_places=2, default=0,
+                                      editable=False)
+
+    def get_vat_breakdown(self):
+        """
+        Net, VAT and gross amounts of the items per VAT rate, as
+        dictionaries with `vat_rate`, `total_net`, `total_vat` and
+        `total_gross`, summed in a single query. These exclude the order
+        discount and shipping costs.
+        """
+        items = self.orderitem_set.values('vat_rate').annotate(
+            total_net=models.Sum('net_price'),
+            total_vat=models.Sum('vat_amount'),
+            total_gross=models.Sum('gross_price'))
+
+        return items.order_by('vat_rate')
+
 class OrderItem(ShippedOrderItemMixin,
                 StockedOrderItemMixin,
                 DiscountedOrderItemMixin,
@@ -631,6 +1145,20 @@ class OrderItem(ShippedOrderItemMixin,
 
     """
 
+    # Calculated by `OrderTotals`, after item discounts
+    vat_rate = models.DecimalField(_('VAT rate'), max_digits=5,
+                                   decimal_places=2, default=0,
+                                   editable=False)
+    net_price = models.DecimalField(_('net price'), max_digits=10,
+                                    decimal_places=2, default=0,
+                                    editable=False)
+    vat_amount = models.DecimalField(_('VAT'), max_digits=10,
+                                     decimal_places=2, default=0,
+                                     editable=False)
+    gross_price = models.DecimalField(_('gross price'), max_digits=10,
+                                      decimal_places=2, default=0,
+                                      editable=False)
+
     def get_stocked_item(self):
         """ Return the relevant item for which the stock is kept. """
         if self.variation:
@@ -671,16 +1199,30 @@ class Category(MPTTCategoryBase, MultilingualModel, NonUniqueSlugItemBase, \
     highlight_text = models.TextField(verbose_name=('highlight text'),
                                       blank=True)
 
+    def get_highlight_url(self):
+        """
+        URL of the highlight image, scaled to `SHOPKIT_CATEGORY_HIGHLIGHT_SIZE`
+        once the `generate_thumbnails` command has rendered it.
+        """
+        geometry, options = CATEGORY_HIGHLIGHT_SIZE
+
+        thumbnail = get_cached_thumbnail(self.highlight_image.name,
+                                         geometry, options)
+        if thumbnail:
+            return thumbnail.url
+
+        return self.highlight_image.url
+
     def highlight_html(self):
         """
         HTML to show for the category highlight part. This is displayed in the
         admin as well as on the website and....
-        TODO: !SHOULD USE PROPER SCALING!
         """
         if self.pk:
             if self.highlight_image:
                 return u'<a href="%s"><img src="%s" alt="%s" /></a>' % \
-                    (self.highlight_link, self.highlight_image.url, self.highlight_text)
+                    (self.highlight_link, self.get_highlight_url(),
+                     self.highlight_text)
             else:
                 return 'No hightlight has been defined for this category.'
 
@@ -688,19 +1230,142 @@ class Category(MPTTCategoryBase, MultilingualModel, NonUniqueSlugItemBase, \
     highlight_html.allow_tags = True
     highlight_html.short_description = ''
 
+    # Denormalized product counters, see `update_product_counts`
+    active_product_count = models.PositiveIntegerField(
+        _('active products'), default=0, editable=False)
+    inactive_product_count = models.PositiveIntegerField(
+        _('inactive products'), default=0, editable=False)
+    in_shop_product_count = models.PositiveIntegerField(
+        _('products in shop'), default=0, editable=False,
+        help_text=_('Products in the shop in this category or any of its \
+                    subcategories.'))
+
+    @classmethod
+    def update_product_counts(cls, category_ids=None):
+        """
+        Update the denormalized product counters for the given categories
+        and their ancestors, or for all categories. Returns the number of
+        categories of which the counters changed.
+
+        The counters are calculated in a fixed number of queries, regardless
+        of the number of categories.
+        """
+        from basic_webshop.category_tree import invalidate_category_tree
+
+        through = Product.categories.through
+
+        categories = cls.objects.all()
+        memberships = through.objects.all()
+        in_shop = Product.in_shop.all()
+
+        if category_ids is not None:
+            # Ancestors count the products of their descendants, their
+            # pks are taken from the cached category tree
+            tree = get_category_tree()
+
+            affected = set()
+            for pk in category_ids:
+                node = tree.get_node(pk)
+
+                if node:
+                    ancestors = node.get_ancestors(include_self=True)
+                else:
+                    # Category added after the tree was cached
+                    ancestors = []
+                    for category in cls.objects.filter(pk=pk):
+                        ancestors = category.get_ancestors(include_self=True)
+
+                affected.update(ancestor.pk for ancestor in ancestors)
+
+            if not affected:
+                return 0
+
+            # The affected categories include the roots of their trees, so
+            # the in shop counts only concern products within these trees
+            tree_ids = set(cls.objects.filter(pk__in=affected).values_list(
+                'tree_id', flat=True))
+
+            categories = categories.filter(tree_id__in=tree_ids)
+            memberships = memberships.filter(category__in=affected)
+            in_shop = in_shop.filter(categories__tree_id__in=tree_ids)
+        else:
+            affected = None
+
+        counts = {}
+        for row in memberships.values('category', 'product__active').annotate(
+                count=models.Count('product')):
+            counts[(row['category'], bool(row['product__active']))] = \
+                row['count']
+
+        rows = list(categories.values_list('pk', 'parent',
+                                           'active_product_count',
+                                           'inactive_product_count',
+                                           'in_shop_product_count'))
+        parents = dict((row[0], row[1]) for row in rows)
+
+        # Products in the shop count for their categories and all ancestors,
+        # but only once per category. As a product can be in several
+        # subcategories, collect the products rather than summing counts.
+        in_shop_products = {}
+        for product_id, category_id in in_shop.values_list('pk',
+                                                           'categories'):
+            while category_id:
+                in_shop_products.setdefault(category_id,
+                                            set()).add(product_id)
+                category_id = parents.get(category_id)
+
+        changed = 0
+        for pk, parent_id, active_count, inactive_count, in_shop_count \
+                in rows:
+            if affected is not None and pk not in affected:
+                continue
+
+            new_counts = {
+                'active_product_count': counts.get((pk, True), 0),
+                'inactive_product_count': counts.get((pk, False), 0),
+                'in_shop_product_count': len(in_shop_products.get(pk, ())),
+            }
+
+            if (active_count, inactive_count, in_shop_count) != \
+                    (new_counts['active_product_count'],
+                     new_counts['inactive_product_count'],
+                     new_counts['in_shop_product_count']):
+                cls.objects.filter(pk=pk).update(**new_counts)
+                changed += 1
+
+        logger.debug(u'Updated product counts for %d categories', changed)
+
+        if changed:
+            # Category tree nodes carry the counts
+            invalidate_category_tree()
+
+        return changed
+
 
     class Meta(MPTTCategoryBase.Meta, NamedItemBase.Meta, OrderedItemBase.Meta):
         unique_together = ('parent', 'slug')
 
-    def is_unique_slug(self, slug):
-        return not self.__class__.objects.filter(slug=slug, parent=self.parent).exists()
+    def get_slug_queryset(self):
+        """ Slugs should be unique among siblings only. """
+        return self.__class__.objects.filter(parent=self.parent)
 
     def display_name(self):
         return self
     display_name.short_description = _('name')
 
-    @models.permalink
     def get_absolute_url(self):
+        """
+        Take the URL from the cached category tree, so we don't need to
+        walk the parents.
+        """
+        node = get_category_tree().get_node(self.pk)
+        if node:
+            return node.get_absolute_url()
+
+        return self._get_absolute_url()
+
+    @models.permalink
+    def _get_absolute_url(self):
         level = self.get_level()
 
         if level == 0:
@@ -748,6 +1413,382 @@ class CategoryFeaturedProduct(models.Model):
         return _(u'Featured product \'%s\'') % unicode(self.product)
 
 
+MAIL_QUEUE_MAX_ATTEMPTS = getattr(settings, 'SHOPKIT_MAIL_QUEUE_MAX_ATTEMPTS', 5)
+MAIL_QUEUE_RETRY_DELAY = getattr(settings, 'SHOPKIT_MAIL_QUEUE_RETRY_DELAY', 60)
+class QueuedMessage(models.Model):
+    """
+    Outgoing email message stored for delivery by the `send_queued_mail`
+    management command, so no SMTP traffic happens within requests.
+    """
+
+    class Meta:
+        verbose_name = _('queued message')
+        verbose_name_plural = _('queued messages')
+        ordering = ('date_added', )
+
+    date_added = models.DateTimeField(_('date added'), auto_now_add=True)
+    subject = models.CharField(_('subject'), max_length=255)
+    body = models.TextField(_('body'))
+    from_email = models.CharField(_('from'), max_length=255, blank=True)
+    recipients = models.TextField(_('recipients'),
+                                  help_text=_('One address per line.'))
+
+    # The pickled message, keeping its class, to, cc and bcc recipients,
+    # headers, attachments and alternatives
+    message_data = models.TextField(_('message data'), editable=False)
+
+    # Delivery administration
+    sent = models.BooleanField(_('sent'), default=False, db_index=True)
+    date_sent = models.DateTimeField(_('date sent'), null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(_('attempts'), default=0)
+    next_attempt = models.DateTimeField(_('next attempt'), db_index=True,
+                                        null=True, blank=True)
+    last_error = models.TextField(_('last error'), blank=True)
+
+    def __unicode__(self):
+        return self.subject
+
+    @classmethod
+    def from_message(cls, message):
+        """ Queue an `EmailMessage`, or a subclass thereof, for delivery. """
+        import copy
+        import cPickle
+
+        # Connections can't be pickled, the queue uses its own
+        message = copy.copy(message)
+        message.connection = None
+
+        queued = cls(subject=message.subject,
+                     body=message.body,
+                     from_email=message.from_email or '',
+                     recipients='\n'.join(message.recipients()),
+                     message_data=cPickle.dumps(
+                        message, cPickle.HIGHEST_PROTOCOL).encode('base64'))
+        queued.save()
+
+        logger.debug(u'Queued message %s for %s', queued, queued.recipients)
+
+        return queued
+
+    def to_message(self, connection=None):
+        """ Return the queued message, to be sent over `connection`. """
+        import cPickle
+
+        message = cPickle.loads(self.message_data.decode('base64'))
+        message.connection = connection
+
+        return message
+
+    @classmethod
+    def get_due(cls):
+        """ Unsent messages which are due for a (re)try. """
+        from datetime import datetime
+
+        due = cls.objects.filter(sent=False,
+                                 attempts__lt=MAIL_QUEUE_MAX_ATTEMPTS)
+        due = due.filter(models.Q(next_attempt__isnull=True) | \
+                         models.Q(next_attempt__lte=datetime.now()))
+
+        return due
+
+    @classmethod
+    def send_queued(cls, batch_size=100, connection=None):
+        """
+        Send a batch of due messages over a single connection. Failed
+        messages are retried with an exponential backoff until
+        `SHOPKIT_MAIL_QUEUE_MAX_ATTEMPTS` has been reached.
+
+        Returns a tuple with the number of sent and failed messages.
+        """
+        from datetime import datetime, timedelta
+        from django.core.mail import get_connection
+
+        messages = list(cls.get_due()[:batch_size])
+        if not messages:
+            return 0, 0
+
+        if not connection:
+            connection = get_connection()
+
+        sent = failed = 0
+
+        connection.open()
+        try:
+            for queued in messages:
+                queued.attempts += 1
+
+                try:
+                    connection.send_messages([queued.to_message(connection)])
+                except Exception as e:
+                    logger.warning(u'Sending message %d failed: %s',
+                                   queued.pk, e)
+
+                    delay = MAIL_QUEUE_RETRY_DELAY * 2 ** (queued.attempts - 1)
+                    queued.next_attempt = datetime.now() + \
+                                          timedelta(seconds=delay)
+                    queued.last_error = unicode(e)
+                    failed += 1
+                else:
+                    queued.sent = True
+                    queued.date_sent = datetime.now()
+                    sent += 1
+
+                queued.save()
+        finally:
+            connection.close()
+
+        logger.info(u'Sent %d queued messages, %d failed', sent, failed)
+
+        return sent, failed
+
+
+PAYMENT_QUEUE_MAX_ATTEMPTS = getattr(settings,
+                                     'SHOPKIT_PAYMENT_QUEUE_MAX_ATTEMPTS', 5)
+class PaymentStatusEvent(models.Model):
+    """
+    Ledger of payment status changes. Every (payment cluster, status)
+    combination is recorded only once, so duplicate or retried callbacks
+    from the payment provider are discarded before any order is loaded.
+    Recorded events are handled by the `process_payment_events` management
+    command.
+    """
+
+    class Meta:
+        verbose_name = _('payment status event')
+        verbose_name_plural = _('payment status events')
+        unique_together = (('payment_cluster', 'paid', 'closed'), )
+        ordering = ('date_added', )
+
+    payment_cluster = models.ForeignKey(PaymentCluster,
+                                        related_name='status_events')
+    paid = models.BooleanField(_('paid'))
+    closed = models.BooleanField(_('closed'))
+    date_added = models.DateTimeField(_('date added'), auto_now_add=True)
+
+    # Processing administration
+    processed = models.BooleanField(_('processed'), default=False,
+                                    db_index=True)
+    date_processed = models.DateTimeField(_('date processed'), null=True,
+                                          blank=True)
+    attempts = models.PositiveSmallIntegerField(_('attempts'), default=0)
+    last_error = models.TextField(_('last error'), blank=True)
+
+    def __unicode__(self):
+        return u'%s (paid: %s, closed: %s)' % \
+            (self.payment_cluster_id, self.paid, self.closed)
+
+    @classmethod
+    def record(cls, payment_cluster):
+        """
+        Record the current status of a payment cluster. Returns the new
+        event or `None` when this status has been recorded before.
+        """
+        from django.db import transaction, router, IntegrityError
+
+        using = router.db_for_write(cls)
+
+        sid = transaction.savepoint(using=using)
+        try:
+            event = cls.objects.using(using).create(
+                payment_cluster=payment_cluster,
+                paid=payment_cluster.paid,
+                closed=payment_cluster.closed)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid, using=using)
+
+            logger.info(u'Discarding duplicate status change for %s',
+                        payment_cluster)
+            return None
+
+        transaction.savepoint_commit(sid, using=using)
+
+        logger.debug(u'Recorded payment status event %s', event)
+
+        return event
+
+    def process(self):
+        """
+        Pass this event on to the order state listeners and mark it as
+        processed. Errors in listeners are raised.
+        """
+        from datetime import datetime
+        from basic_webshop.listeners import OrderPaidStatusChange, \
+            OrderClosedNotPaidStatusChange
+
+        payment_cluster = self.payment_cluster
+
+        # Listeners should act on the status of this event
+        payment_cluster.paid = self.paid
+        payment_cluster.closed = self.closed
+
+        for listener in (OrderPaidStatusChange,
+                         OrderClosedNotPaidStatusChange):
+            listener.as_listener()(sender=payment_cluster,
+                                   signal=payment_status_changed)
+
+        self.processed = True
+        self.date_processed = datetime.now()
+        self.save()
+
+    @classmethod
+    def process_queued(cls, batch_size=100):
+        """
+        Process a batch of unprocessed events in the order they were
+        recorded. Failed events are retried until
+        `SHOPKIT_PAYMENT_QUEUE_MAX_ATTEMPTS` has been reached.
+
+        Returns a tuple with the number of processed and failed events.
+        """
+        events = cls.objects.filter(processed=False,
+                                    attempts__lt=PAYMENT_QUEUE_MAX_ATTEMPTS)
+        events = list(events.select_related('payment_cluster')[:batch_size])
+
+        processed = failed = 0
+
+        for event in events:
+            event.attempts += 1
+
+            try:
+                event.process()
+            except Exception as e:
+                logger.warning(u'Processing payment status event %d '
+                               u'failed: %s', event.pk, e)
+
+                event.last_error = unicode(e)
+                event.save()
+                failed += 1
+            else:
+                processed += 1
+
+        logger.info(u'Processed %d payment status events, %d failed',
+                    processed, failed)
+
+        return processed, failed
+
+
+THUMBNAIL_QUEUE_MAX_ATTEMPTS = getattr(settings,
+                                       'SHOPKIT_THUMBNAIL_QUEUE_MAX_ATTEMPTS', 3)
+
+
+class ThumbnailJob(models.Model):
+    """
+    Thumbnail of an image queued for rendering by the `generate_thumbnails`
+    management command. Jobs are removed once rendered.
+    """
+
+    class Meta:
+        verbose_name = _('thumbnail job')
+        verbose_name_plural = _('thumbnail jobs')
+        unique_together = (('image', 'geometry', 'options'), )
+        ordering = ('date_added', )
+
+    image = models.CharField(_('image'), max_length=255)
+    geometry = models.CharField(_('geometry'), max_length=64)
+    options = models.CharField(_('options'), max_length=255, blank=True)
+    date_added = models.DateTimeField(_('date added'), auto_now_add=True)
+
+    attempts = models.PositiveSmallIntegerField(_('attempts'), default=0)
+    last_error = models.TextField(_('last error'), blank=True)
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.image, self.geometry)
+
+    @classmethod
+    def enqueue(cls, instance):
+        """
+        Queue all configured thumbnail sizes for the images of a model
+        instance. Returns the number of jobs added.
+        """
+        from django.db import transaction, router, IntegrityError
+        from basic_webshop.thumbnails import get_image_sizes, encode_options
+
+        using = router.db_for_write(cls)
+
+        added = 0
+        for image, geometry, options in get_image_sizes(instance):
+            options = encode_options(options)
+
+            sid = transaction.savepoint(using=using)
+            try:
+                cls.objects.using(using).create(image=image,
+                                                geometry=geometry,
+                                                options=options)
+            except IntegrityError:
+                # Already queued
+                transaction.savepoint_rollback(sid, using=using)
+            else:
+                transaction.savepoint_commit(sid, using=using)
+                added += 1
+
+        logger.debug(u'Queued %d thumbnails for %s', added, instance)
+
+        return added
+
+    @classmethod
+    def render_queued(cls, batch_size=100, processes=1, exclude=None):
+        """
+        Render a batch of queued thumbnails, in a pool of `processes` worker
+        processes. Failed jobs are retried until
+        `SHOPKIT_THUMBNAIL_QUEUE_MAX_ATTEMPTS` has been reached.
+
+        Jobs with their pk in the set `exclude` are skipped, and failed jobs
+        are added to it, so that rendering several batches in a row does not
+        retry the same failures over and over.
+
+        Returns a tuple with the number of rendered and failed thumbnails.
+        """
+        from basic_webshop.thumbnails import render_thumbnail
+
+        jobs = cls.objects.filter(attempts__lt=THUMBNAIL_QUEUE_MAX_ATTEMPTS)
+        if exclude:
+            jobs = jobs.exclude(pk__in=exclude)
+        jobs = list(jobs[:batch_size])
+        if not jobs:
+            return 0, 0
+
+        arguments = [(job.image, job.geometry, job.options) for job in jobs]
+
+        if processes > 1:
+            from multiprocessing import Pool
+            from django.db import connection
+
+            # Workers should not share the database connection
+            connection.close()
+
+            pool = Pool(processes)
+            try:
+                errors = pool.map(render_thumbnail, arguments)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            errors = map(render_thumbnail, arguments)
+
+        rendered = []
+        failed = 0
+        for job, error in zip(jobs, errors):
+            if error:
+                logger.warning(u'Rendering thumbnail %s failed: %s',
+                               job, error)
+
+                job.attempts += 1
+                job.last_error = error
+                job.save()
+                failed += 1
+
+                if exclude is not None:
+                    exclude.add(job.pk)
+            else:
+                rendered.append(job.pk)
+
+        cls.objects.filter(pk__in=rendered).delete()
+
+        logger.info(u'Rendered %d thumbnails, %d failed',
+                    len(rendered), failed)
+
+        return len(rendered), failed
+
+
 class Discount(NamedItemBase, ManyCategoryDiscountMixin, CouponDiscountMixin, \
                LimitedUseDiscountMixin, ManyProductDiscountMixin, \
                DateRangeDiscountMixin, OrderDiscountAmountMixin, \
@@ -758,3 +1799,390 @@ class Discount(NamedItemBase, ManyCategoryDiscountMixin, CouponDiscountMixin, \
             return self.name
 
         return unicode(self.pk)
+
+
+class ListingImage(namedtuple('ListingImage', 'image')):
+    """ Default image of a `ProductListing`, holding only the image path. """
+
+    __slots__ = ()
+
+
+class ProductListing(models.Model):
+    """
+    Denormalized listing of a product within a category for a single
+    language. A product is listed in each of its categories as well as in
+    all of their ancestors, so category pages can be rendered from a single
+    indexed query without joining translations, brands or featured products.
+
+    Listings are kept up to date by the listeners in
+    `basic_webshop.listeners` and can be rebuilt from scratch with the
+    `rebuild_product_listing` management command.
+    """
+
+    class Meta:
+        verbose_name = _('product listing')
+        verbose_name_plural = _('product listings')
+        unique_together = (('category', 'language_code', 'product'), )
+        ordering = ('sort_order', )
+
+    product = models.ForeignKey(Product, related_name='listings')
+    category = models.ForeignKey(Category, related_name='product_listings')
+    language_code = models.CharField(_('language'), max_length=5)
+
+    # Denormalized product data
+    slug = models.SlugField(_('slug'), max_length=255)
+    name = models.CharField(_('name'), max_length=255)
+    price = models.DecimalField(_('price'), max_digits=10, decimal_places=2)
+    sort_order = models.IntegerField(_('sort order'), default=0)
+    date_publish = models.DateTimeField(_('publication date'),
+                                        null=True, blank=True)
+    in_stock = models.BooleanField(_('in stock'), default=False)
+    image = models.CharField(_('default image'), max_length=255, blank=True)
+
+    # Denormalized brand data
+    brand = models.ForeignKey(Brand, related_name='product_listings')
+    brand_name = models.CharField(_('brand name'), max_length=255)
+    brand_slug = models.SlugField(_('brand slug'), max_length=255)
+
+    # Denormalized rating data
+    rating_count = models.PositiveIntegerField(_('rating count'), default=0)
+    rating_average = models.DecimalField(_('average rating'), max_digits=3,
+                                         decimal_places=2,
+                                         null=True, blank=True)
+
+    # Denormalized featured product data
+    featured = models.BooleanField(_('featured'), default=False)
+    featured_order = models.PositiveSmallIntegerField(_('featured order'),
+                                                      blank=True, null=True)
+
+    def __unicode__(self):
+        return u'%s %s' % (self.brand_name, self.name)
+
+    @models.permalink
+    def get_absolute_url(self):
+        return 'product_detail', None, \
+            {'slug': self.slug}
+
+    def get_price(self):
+        """ Price of the listed product. """
+        return self.price
+
+    def get_default_image(self):
+        """
+        Default image of the listed product, with the denormalized image
+        path as its `image` attribute.
+        """
+        if self.image:
+            return ListingImage(self.image)
+
+        return None
+
+    def is_available(self, quantity=1):
+        """
+        Whether the listed product is available, using the denormalized
+        stock flag for single items.
+        """
+        if quantity == 1:
+            return self.in_stock
+
+        return self.product.is_available(quantity)
+
+    @classmethod
+    def get_for_category(cls, category, language_code=None):
+        """
+        Return the listings for products in the given category and its
+        descendants for the given (or current) language.
+        """
+        if not language_code:
+            language_code = get_language()
+
+        return cls.objects.filter(category=category,
+                                  language_code=language_code)
+
+    @classmethod
+    def update_for_product(cls, product):
+        """
+        Bring the listings for a single product up to date. Existing
+        listings are updated in place when their values changed, listings
+        for categories or languages the product is no longer in are
+        deleted and missing ones are created.
+        """
+
+        existing = dict(((listing.category_id, listing.language_code),
+                         listing) \
+                        for listing in cls.objects.filter(product=product))
+
+        rows = cls.get_rows_for_product(product)
+
+        # Group changed listings by their values, for as few queries as
+        # possible
+        changed = {}
+        for key, values in rows.iteritems():
+            listing = existing.pop(key, None)
+
+            if not listing:
+                cls.objects.create(product=product, category_id=key[0],
+                                   language_code=key[1], **values)
+                continue
+
+            if [field for field, value in values.iteritems() \
+                    if getattr(listing, field) != value]:
+                changed.setdefault(tuple(sorted(values.items())),
+                                   []).append(listing.pk)
+
+        for values, listing_ids in changed.iteritems():
+            values = dict(values)
+
+            # Updates refer to foreign keys by their field name
+            values['brand'] = values.pop('brand_id')
+
+            cls.objects.filter(pk__in=listing_ids).update(**values)
+
+        if existing:
+            cls.objects.filter(pk__in=[listing.pk for listing in \
+                                       existing.itervalues()]).delete()
+
+    @classmethod
+    def get_rows_for_product(cls, product):
+        """
+        Listing values for a product, by (category id, language code) of
+        the listing.
+        """
+        rows = {}
+
+        if not product.pk or not product.active:
+            return rows
+
+        translations = list(product.translations.all())
+        if not translations:
+            logger.debug(u'No translations for product %d, not listing',
+                         product.pk)
+            return rows
+
+        # Products are listed in their categories and all ancestors thereof
+        categories = set()
+        for category in product.categories.all():
+            for ancestor in category.get_ancestors(include_self=True):
+                categories.add(ancestor.pk)
+
+        if not categories:
+            return rows
+
+        brand = product.brand
+        brand_names = dict(
+            brand.translations.values_list('language_code', 'name'))
+
+        featured = dict(CategoryFeaturedProduct.objects.filter(
+            product=product).values_list('category', 'featured_order'))
+
+        in_stock = product.is_available()
+        image = cls.get_image_path(product)
+
+        ratings = dict((stats.language, stats) \
+                       for stats in product.rating_stats.all())
+
+        for translation in translations:
+            language_code = translation.language_code
+
+            brand_name = brand_names.get(language_code) or \
+                         brand_names.get(settings.LANGUAGE_CODE) or \
+                         brand.slug
+
+            stats = ratings.get(language_code)
+            if stats:
+                rating_count, rating_average = stats.count, stats.average
+            else:
+                rating_count, rating_average = 0, None
+
+            for category_id in categories:
+                rows[(category_id, language_code)] = {
+                    'slug': product.slug,
+                    'name': translation.name,
+                    'price': product.price,
+                    'sort_order': product.sort_order,
+                    'date_publish': product.date_publish,
+                    'in_stock': in_stock,
+                    'image': image,
+                    'brand_id': brand.pk,
+                    'brand_name': brand_name,
+                    'brand_slug': brand.slug,
+                    'rating_count': rating_count,
+                    'rating_average': rating_average,
+                    'featured': category_id in featured,
+                    'featured_order': featured.get(category_id),
+                }
+
+        return rows
+
+    @staticmethod
+    def get_image_path(product):
+        """ Path of the default image of a product, or an empty string. """
+        image = product.get_default_image()
+
+        if image:
+            return image.image.name
+
+        return ''
+
+    @classmethod
+    def update_for_categories(cls, categories):
+        """ Rebuild the listings for all products in the given categories. """
+
+        products = Product.objects.filter(categories__in=categories)
+
+        for product in products.distinct():
+            cls.update_for_product(product)
+
+    @classmethod
+    def rebuild(cls):
+        """ Rebuild the complete listing table. """
+
+        cls.objects.all().delete()
+
+        for product in Product.objects.all():
+            cls.update_for_product(product)
+
+
+# Signal handling for the denormalized product listing
+from django.db.models.signals import post_save, post_delete, pre_save, \
+                                     m2m_changed
+
+from basic_webshop.listeners import ProductListingUpdate, \
+    ProductTranslationListingTracker, ProductCategoriesListingUpdate, ProductStockListingUpdate, \
+    ProductImageListingUpdate, \
+    BrandListingUpdate, BrandTranslationListingUpdate, \
+    CategoryParentListingTracker, CategoryParentListingUpdate, \
+    FeaturedProductListingUpdate
+
+post_save.connect(ProductListingUpdate.as_listener(), sender=Product,
+                  weak=False)
+pre_save.connect(ProductTranslationListingTracker.as_listener(),
+                 sender=ProductTranslation, weak=False)
+post_save.connect(ProductListingUpdate.as_listener(),
+                  sender=ProductTranslation, weak=False)
+post_delete.connect(ProductListingUpdate.as_listener(),
+                    sender=ProductTranslation, weak=False)
+m2m_changed.connect(ProductCategoriesListingUpdate.as_listener(),
+                    sender=Product.categories.through, weak=False)
+post_save.connect(ProductStockListingUpdate.as_listener(),
+                  sender=ProductVariation, weak=False)
+post_delete.connect(ProductStockListingUpdate.as_listener(),
+                    sender=ProductVariation, weak=False)
+post_save.connect(ProductImageListingUpdate.as_listener(),
+                  sender=ProductImage, weak=False)
+post_delete.connect(ProductImageListingUpdate.as_listener(),
+                    sender=ProductImage, weak=False)
+post_save.connect(BrandListingUpdate.as_listener(), sender=Brand, weak=False)
+post_save.connect(BrandTranslationListingUpdate.as_listener(),
+                  sender=BrandTranslation, weak=False)
+pre_save.connect(CategoryParentListingTracker.as_listener(),
+                 sender=Category, weak=False)
+post_save.connect(CategoryParentListingUpdate.as_listener(),
+                  sender=Category, weak=False)
+post_save.connect(FeaturedProductListingUpdate.as_listener(),
+                  sender=CategoryFeaturedProduct, weak=False)
+post_delete.connect(FeaturedProductListingUpdate.as_listener(),
+                    sender=CategoryFeaturedProduct, weak=False)
+
+
+# Signal handling for the cached category tree
+from basic_webshop.listeners import CategoryTreeInvalidate
+
+for sender in (Category, CategoryTranslation):
+    post_save.connect(CategoryTreeInvalidate.as_listener(), sender=sender,
+                      weak=False)
+    post_delete.connect(CategoryTreeInvalidate.as_listener(), sender=sender,
+                        weak=False)
+
+
+# Signal handling for rating statistics
+from basic_webshop.listeners import ProductRatingStatsUpdate
+
+post_save.connect(ProductRatingStatsUpdate.as_listener(),
+                  sender=ProductRating, weak=False)
+post_delete.connect(ProductRatingStatsUpdate.as_listener(),
+                    sender=ProductRating, weak=False)
+
+# Signal handling for the catalog page cache
+from basic_webshop.listeners import CatalogVersionBump
+
+for sender in (Product, ProductTranslation, ProductVariation, ProductImage,
+               ProductMedia, ProductRating, Category, CategoryTranslation,
+               CategoryFeaturedProduct, Brand, BrandTranslation, BrandImage):
+    post_save.connect(CatalogVersionBump.as_listener(), sender=sender,
+                      weak=False)
+    post_delete.connect(CatalogVersionBump.as_listener(), sender=sender,
+                        weak=False)
+m2m_changed.connect(CatalogVersionBump.as_listener(),
+                    sender=Product.categories.through, weak=False)
+
+
+# Signal handling for the discount eligibility index
+from basic_webshop.listeners import DiscountIndexInvalidate
+
+post_save.connect(DiscountIndexInvalidate.as_listener(), sender=Discount,
+                  weak=False)
+post_delete.connect(DiscountIndexInvalidate.as_listener(), sender=Discount,
+                    weak=False)
+for sender in (Discount.products.through, Discount.categories.through):
+    m2m_changed.connect(DiscountIndexInvalidate.as_listener(), sender=sender,
+                        weak=False)
+
+
+# Signal handling for thumbnail pre-generation
+from basic_webshop.listeners import ThumbnailEnqueue
+
+for sender in (ProductImage, BrandImage, Brand, Category):
+    post_save.connect(ThumbnailEnqueue.as_listener(), sender=sender,
+                      weak=False)
+
+
+# Signal handling for the category product counters
+from django.db.models.signals import pre_delete
+
+from basic_webshop.listeners import ProductCategoriesCountUpdate, \
+    ProductCountTracker, ProductCountUpdate, CategoryCountUpdate
+
+m2m_changed.connect(ProductCategoriesCountUpdate.as_listener(),
+                    sender=Product.categories.through, weak=False)
+pre_save.connect(ProductCountTracker.as_listener(), sender=Product,
+                 weak=False)
+pre_delete.connect(ProductCountTracker.as_listener(), sender=Product,
+                   weak=False)
+post_save.connect(ProductCountUpdate.as_listener(), sender=Product,
+                  weak=False)
+post_delete.connect(ProductCountUpdate.as_listener(), sender=Product,
+                    weak=False)
+post_save.connect(CategoryCountUpdate.as_listener(), sender=Category,
+                  weak=False)
+post_delete.connect(CategoryCountUpdate.as_listener(), sender=Category,
+                    weak=False)
+
+
+# Signal handling for the cached brand directory
+from basic_webshop.listeners import BrandDirectoryInvalidate
+
+for sender in (Brand, BrandTranslation):
+    post_save.connect(BrandDirectoryInvalidate.as_listener(), sender=sender,
+                      weak=False)
+    post_delete.connect(BrandDirectoryInvalidate.as_listener(), sender=sender,
+                        weak=False)
+
+
+# Signal handling for the product search index
+from basic_webshop.listeners import ProductSearchUpdate, \
+    ProductCategoriesSearchUpdate, NameSearchUpdate
+
+post_save.connect(ProductSearchUpdate.as_listener(), sender=Product,
+                  weak=False)
+post_save.connect(ProductSearchUpdate.as_listener(),
+                  sender=ProductTranslation, weak=False)
+post_delete.connect(ProductSearchUpdate.as_listener(),
+                    sender=ProductTranslation, weak=False)
+m2m_changed.connect(ProductCategoriesSearchUpdate.as_listener(),
+                    sender=Product.categories.through, weak=False)
+for sender in (BrandTranslation, CategoryTranslation):
+    post_save.connect(NameSearchUpdate.as_listener(), sender=sender,
+                      weak=False)
+    post_delete.connect(NameSearchUpdate.as_listener(), sender=sender,
+                        weak=False)
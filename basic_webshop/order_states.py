@@ -30,4 +30,56 @@ ORDER_STATES = \
         (ORDER_STATE_REJECTED, _('Rejected')),
         (ORDER_STATE_PROCESSED, _('Being processed')),
         (ORDER_STATE_SHIPPED, _('Shipped')),
-    )
\ No newline at end of file
+    )
+
+"""
+Allowed transitions, mapping each state to the states it can change into.
+Canceled, rejected and shipped orders are final.
+"""
+ORDER_TRANSITIONS = \
+    {
+        ORDER_STATE_NEW: (ORDER_STATE_PENDING, ORDER_STATE_CANCELED,
+                          ORDER_STATE_REJECTED),
+        ORDER_STATE_PENDING: (ORDER_STATE_PAID, ORDER_STATE_FAILED,
+                              ORDER_STATE_CANCELED),
+        ORDER_STATE_PAID: (ORDER_STATE_PROCESSED, ORDER_STATE_SHIPPED,
+                           ORDER_STATE_REJECTED, ORDER_STATE_CANCELED),
+        ORDER_STATE_FAILED: (ORDER_STATE_PENDING, ORDER_STATE_CANCELED),
+        ORDER_STATE_CANCELED: (),
+        ORDER_STATE_REJECTED: (),
+        ORDER_STATE_PROCESSED: (ORDER_STATE_SHIPPED, ORDER_STATE_REJECTED),
+        ORDER_STATE_SHIPPED: (),
+    }
+
+STATE_NAMES = dict(ORDER_STATES)
+
+assert set(ORDER_TRANSITIONS.keys()) == set(STATE_NAMES.keys()), \
+    'Transitions should be specified for all order states.'
+
+VALID_TRANSITIONS = frozenset((old_state, new_state) \
+    for old_state, new_states in ORDER_TRANSITIONS.iteritems() \
+        for new_state in new_states)
+
+
+class InvalidTransitionException(Exception):
+    """ Thrown when an order changes into a state it cannot reach. """
+
+    def __init__(self, old_state, new_state):
+        self.old_state = old_state
+        self.new_state = new_state
+
+    def __str__(self):
+        return 'Order cannot change from state %s to state %s' % \
+            (self.old_state, self.new_state)
+
+    def __unicode__(self):
+        return _(u'Order cannot change from state \'%(old)s\' '
+                 u'to \'%(new)s\'.') % \
+            {'old': STATE_NAMES.get(self.old_state, self.old_state),
+             'new': STATE_NAMES.get(self.new_state, self.new_state)}
+
+
+def is_valid_transition(old_state, new_state):
+    """ Whether an order can change from `old_state` into `new_state`. """
+    return old_state == new_state or \
+           (old_state, new_state) in VALID_TRANSITIONS
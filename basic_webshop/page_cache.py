@@ -0,0 +1,188 @@
+"""
+Full-page and template fragment caching for the anonymous catalog.
+
+Cache keys contain a catalog version which is bumped by
+`basic_webshop.listeners.CatalogVersionBump` whenever products, categories,
+brands or their translations change, so cached pages never need to be
+invalidated explicitly. The version is stored with a long, explicit timeout
+and starts from the current time, so it never falls back to a version for
+which pages are still cached. Template fragments can use the `catalog_version`
+context variable with Django's `{% cache %}` tag to the same effect.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.hashcompat import md5_constructor
+from django.utils.translation import get_language
+
+
+PAGE_CACHE_TIMEOUT = getattr(settings, 'SHOPKIT_PAGE_CACHE_TIMEOUT', 60*60)
+
+CATALOG_VERSION_TIMEOUT = getattr(settings,
+                                  'SHOPKIT_CATALOG_VERSION_TIMEOUT',
+                                  PAGE_CACHE_TIMEOUT * 24)
+
+CATALOG_VERSION_KEY = 'basic_webshop.catalog_version'
+HITS_KEY = 'basic_webshop.page_cache.hits'
+MISSES_KEY = 'basic_webshop.page_cache.misses'
+
+
+def _incr(key, initial=1):
+    """
+    Increment a counter in the cache, creating it when necessary.
+
+    A timeout of 0 does not mean 'forever' in Django 1.3: the locmem backend
+    expires such keys immediately and memcached uses its default timeout.
+    Counters are therefore stored with an explicit `CATALOG_VERSION_TIMEOUT`.
+    """
+    try:
+        return cache.incr(key)
+    except ValueError:
+        if cache.add(key, initial, CATALOG_VERSION_TIMEOUT):
+            return initial
+
+        # Created by another process in the meantime
+        return cache.incr(key)
+
+
+def _get_initial_version():
+    """
+    Versions start from the current time, so a version which expired from
+    the cache is never reused for pages cached under it.
+    """
+    return int(time.time())
+
+
+def get_catalog_version():
+    """ Return the current catalog version. """
+    version = cache.get(CATALOG_VERSION_KEY)
+
+    if version is None:
+        version = _get_initial_version()
+
+        if not cache.add(CATALOG_VERSION_KEY, version,
+                         CATALOG_VERSION_TIMEOUT):
+            version = cache.get(CATALOG_VERSION_KEY, version)
+
+    return version
+
+
+def bump_catalog_version():
+    """ Increase the catalog version, invalidating cached pages. """
+    version = _incr(CATALOG_VERSION_KEY, _get_initial_version())
+
+    logger.debug(u'Bumped catalog version to %d', version)
+
+    return version
+
+
+def get_page_cache_stats():
+    """ Return page cache hits, misses and hit ratio. """
+    hits = cache.get(HITS_KEY) or 0
+    misses = cache.get(MISSES_KEY) or 0
+
+    if hits or misses:
+        ratio = float(hits) / (hits + misses)
+    else:
+        ratio = None
+
+    return {'hits': hits, 'misses': misses, 'ratio': ratio}
+
+
+def reset_page_cache_stats():
+    """ Reset the page cache hit and miss counters. """
+    cache.delete_many((HITS_KEY, MISSES_KEY))
+
+
+def is_cacheable_request(request):
+    """
+    Only GET requests without a session or pending messages can be served
+    from the cache, as the output for these is the same for everyone.
+    """
+    if request.method != 'GET':
+        return False
+
+    if hasattr(request, 'user') and request.user.is_authenticated():
+        return False
+
+    for cookie in (settings.SESSION_COOKIE_NAME, 'messages'):
+        if cookie in request.COOKIES:
+            return False
+
+    return True
+
+
+def get_page_cache_key(request):
+    """ Cache key by catalog version, language and URL. """
+    url = request.build_absolute_uri()
+
+    key = '%d:%s:%s' % (get_catalog_version(), get_language(), url)
+    key = md5_constructor(key.encode('utf-8')).hexdigest()
+
+    return 'basic_webshop.page.%s' % key
+
+
+class CachedPageMixin(object):
+    """
+    View mixin serving anonymous GET requests from the page cache.
+
+    Responses setting cookies, including pages containing a CSRF token,
+    are not stored. Parts of these can be cached using the
+    `catalog_version` variable added to the context.
+    """
+
+    page_cache_timeout = PAGE_CACHE_TIMEOUT
+
+    def dispatch(self, request, *args, **kwargs):
+        superclass = super(CachedPageMixin, self)
+
+        if not is_cacheable_request(request):
+            return superclass.dispatch(request, *args, **kwargs)
+
+        key = get_page_cache_key(request)
+
+        cached = cache.get(key)
+        if cached is not None:
+            _incr(HITS_KEY)
+            logger.debug(u'Page cache hit for %s', request.path)
+
+            content, content_type = cached
+            return HttpResponse(content, content_type=content_type)
+
+        _incr(MISSES_KEY)
+        logger.debug(u'Page cache miss for %s', request.path)
+
+        response = superclass.dispatch(request, *args, **kwargs)
+
+        if response.status_code != 200:
+            return response
+
+        def store(response):
+            """ Cache the rendered response unless it is user specific. """
+            if response.cookies or request.META.get('CSRF_COOKIE_USED'):
+                logger.debug(u'Not caching %s, it sets cookies',
+                             request.path)
+                return
+
+            cache.set(key, (response.content, response['Content-Type']),
+                      self.page_cache_timeout)
+
+        if getattr(response, 'is_rendered', True):
+            store(response)
+        else:
+            response.add_post_render_callback(store)
+
+        return response
+
+    def render_to_response(self, context, **kwargs):
+        """ Add the catalog version for template fragment caching. """
+        context['catalog_version'] = get_catalog_version()
+
+        return super(CachedPageMixin, self).render_to_response(context,
+                                                               **kwargs)
@@ -0,0 +1,338 @@
+"""
+Pooled payment gateway client for Docdata.
+
+`PaymentGatewayClient` talks to the payment provider over a pool of
+keep-alive connections with a per-call timeout, and limits the number of
+concurrent calls to the provider. `create_payment_cluster` runs the remote
+call on a thread pool, so the requesting view merely waits for the result
+with a bounded timeout. A call which timed out is picked up again when
+the payment cluster for the same transaction is requested once more.
+"""
+
+import httplib
+import select
+import socket
+import threading
+import urlparse
+
+import logging
+logger = logging.getLogger(__name__)
+
+from Queue import Queue, Empty, Full
+from multiprocessing.pool import ThreadPool
+from xml.dom import minidom
+
+from django.conf import settings
+from django.utils.http import urlencode
+
+from docdata.interface import PaymentInterface, yntobool
+from docdata.exceptions import PaymentStatusException
+from docdata.settings import DEBUG
+
+
+PAYMENT_URL = getattr(settings, 'SHOPKIT_PAYMENT_URL', None)
+""" Override for the provider URL, ie. for testing. """
+
+PAYMENT_POOL_SIZE = getattr(settings, 'SHOPKIT_PAYMENT_POOL_SIZE', 4)
+""" Number of keep-alive connections kept open to the provider. """
+
+PAYMENT_MAX_CONCURRENCY = getattr(settings,
+                                  'SHOPKIT_PAYMENT_MAX_CONCURRENCY', 4)
+""" Maximum number of concurrent calls to the provider. """
+
+PAYMENT_TIMEOUT = getattr(settings, 'SHOPKIT_PAYMENT_TIMEOUT', 10)
+""" Timeout in seconds for a single call to the provider. """
+
+
+class ConnectionPool(object):
+    """ Pool of keep-alive HTTP(S) connections to a single host. """
+
+    def __init__(self, url, size, timeout):
+        parsed = urlparse.urlparse(url)
+
+        if parsed.scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+
+        self.host = parsed.netloc
+        self.timeout = timeout
+
+        self.connections = Queue(size)
+
+    def get(self):
+        """
+        Return a pooled connection, or a new one when none are available.
+        Pooled connections which the provider has closed are discarded.
+        The second return value tells whether the connection was reused.
+        """
+        while True:
+            try:
+                connection = self.connections.get_nowait()
+            except Empty:
+                return self.connect(), False
+
+            if not is_connection_dropped(connection):
+                return connection, True
+
+            logger.debug(u'Discarding pooled connection closed by provider')
+            connection.close()
+
+    def connect(self):
+        """ Return a new, unpooled connection. """
+        return self.connection_class(self.host, timeout=self.timeout)
+
+    def put(self, connection):
+        """ Return a connection to the pool, or close it when full. """
+        try:
+            self.connections.put_nowait(connection)
+        except Full:
+            connection.close()
+
+    def close(self):
+        """ Close all pooled connections. """
+        while True:
+            try:
+                self.connections.get_nowait().close()
+            except Empty:
+                break
+
+
+def is_connection_dropped(connection):
+    """
+    Whether an idle connection has been closed by the other side: its
+    socket is then readable, as no response is pending.
+    """
+    sock = connection.sock
+    if sock is None:
+        return True
+
+    try:
+        return bool(select.select([sock], [], [], 0)[0])
+    except (select.error, socket.error):
+        return True
+
+
+class PaymentGatewayClient(PaymentInterface):
+    """
+    Docdata payment interface using pooled keep-alive connections, per-call
+    timeouts and a bounded number of concurrent calls.
+    """
+
+    def __init__(self, url=None, debug=DEBUG, pool_size=PAYMENT_POOL_SIZE,
+                 max_concurrency=PAYMENT_MAX_CONCURRENCY,
+                 timeout=PAYMENT_TIMEOUT):
+        super(PaymentGatewayClient, self).__init__(debug=debug)
+
+        if url:
+            self.url = url
+
+        self.path = urlparse.urlparse(self.url).path or '/'
+
+        self.pool = ConnectionPool(self.url, pool_size, timeout)
+        self.limiter = threading.BoundedSemaphore(max_concurrency)
+
+    def request(self, idempotent=False, **kwargs):
+        """
+        Perform a GET request to the provider, return the body.
+
+        When a reused connection fails, the call is retried on a new
+        connection only when sending the request failed, so it never
+        reached the provider in full, or when the call is `idempotent`.
+        Otherwise the provider might have acted on it already, ie. created
+        a payment cluster, and the error is raised.
+        """
+        path = '%s?%s' % (self.path, urlencode(kwargs))
+
+        self.limiter.acquire()
+        try:
+            connection, reused = self.pool.get()
+            sent = False
+
+            try:
+                self._send(connection, path)
+                sent = True
+
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+
+                if not reused or (sent and not idempotent):
+                    raise
+
+                logger.debug(u'Pooled connection failed, retrying')
+
+                connection = self.pool.connect()
+                try:
+                    self._send(connection, path)
+                    response = connection.getresponse()
+                except:
+                    connection.close()
+                    raise
+
+            data = response.read()
+
+            if response.will_close:
+                connection.close()
+            else:
+                self.pool.put(connection)
+
+        finally:
+            self.limiter.release()
+
+        if response.status != 200:
+            raise httplib.HTTPException('Unexpected status %d from provider' \
+                                        % response.status)
+
+        return data
+
+    def _send(self, connection, path):
+        connection.request('GET', path, headers={'Connection': 'keep-alive'})
+
+    def new_payment_cluster(self, **kwargs):
+        """
+        Wrapper around the new_payment_cluster command.
+
+        Returns:
+            Dictionary with `payment_cluster_id` and `payment_cluster_key`.
+        """
+        kwargs['command'] = 'new_payment_cluster'
+
+        resultdom = minidom.parseString(self.request(**kwargs))
+
+        self._check_errors(resultdom)
+
+        id = resultdom.getElementsByTagName('id')[0].getAttribute('value')
+        key = resultdom.getElementsByTagName('key')[0].getAttribute('value')
+
+        return {'payment_cluster_id': id, 'payment_cluster_key': key}
+
+    def status_payment_cluster(self, **kwargs):
+        """
+        Get the status for a payment cluster. Only the simple text reports
+        go through the pool, XML reports are left to `PaymentInterface`.
+        """
+        report_type = kwargs['report_type']
+
+        if not report_type in ('txt_simple', 'txt_simple2'):
+            return super(PaymentGatewayClient, self).status_payment_cluster(
+                **kwargs)
+
+        kwargs['command'] = 'status_payment_cluster'
+
+        # Status reports don't change anything, so may be retried
+        data = self.request(idempotent=True, **kwargs)
+
+        if data.startswith('<?xml'):
+            self._check_errors(minidom.parseString(data))
+
+        try:
+            if report_type == 'txt_simple':
+                return yntobool(data)
+
+            return {'paid': yntobool(data[0]),
+                    'closed': yntobool(data[1])}
+        except Exception:
+            raise PaymentStatusException('Unknown status received',
+                                         report_type=report_type,
+                                         data=data)
+
+
+_client = None
+_executor = None
+_lock = threading.Lock()
+
+
+def get_payment_client():
+    """ Return the shared payment gateway client. """
+    global _client
+
+    with _lock:
+        if _client is None:
+            _client = PaymentGatewayClient(url=PAYMENT_URL)
+
+    return _client
+
+
+def get_payment_executor():
+    """ Return the shared thread pool for payment calls. """
+    global _executor
+
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPool(PAYMENT_MAX_CONCURRENCY)
+
+    return _executor
+
+
+class TimeoutInterface(object):
+    """
+    Payment interface running `new_payment_cluster` calls on the payment
+    thread pool, waiting at most `timeout` seconds for their result.
+
+    Calls which timed out keep running. Their results are kept by
+    transaction id, so a retry for the same transaction picks up the result
+    of the earlier call rather than creating a second payment cluster. Other
+    attributes are taken from the wrapped client.
+    """
+
+    _pending = {}
+    _pending_lock = threading.Lock()
+
+    def __init__(self, client, timeout=PAYMENT_TIMEOUT):
+        self.client = client
+        self.timeout = timeout
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def new_payment_cluster(self, **kwargs):
+        """
+        Raises `multiprocessing.TimeoutError` when the provider is too slow.
+        """
+        transaction_id = kwargs['merchant_transaction_id']
+
+        with self._pending_lock:
+            future = self._pending.get(transaction_id)
+
+            if future and future.ready() and not future.successful():
+                # The earlier call failed, it may safely be made again
+                future = None
+
+            if future:
+                logger.info(u'Using earlier call for payment cluster %s',
+                            transaction_id)
+            else:
+                future = get_payment_executor().apply_async(
+                    self.client.new_payment_cluster, kwds=kwargs)
+                self._pending[transaction_id] = future
+
+        result = future.get(self.timeout)
+
+        with self._pending_lock:
+            if self._pending.get(transaction_id) is future:
+                del self._pending[transaction_id]
+
+        return result
+
+
+def create_payment_cluster(client=None, timeout=PAYMENT_TIMEOUT, **kwargs):
+    """
+    Create a new, saved `PaymentCluster` at Docdata, using docdata's own
+    `create_cluster` with a `TimeoutInterface`.
+
+    Only the remote call runs on the payment thread pool, the calling thread
+    waits for its result at most `timeout` seconds and raises
+    `multiprocessing.TimeoutError` otherwise. Saving happens in the calling
+    thread, so it takes part in its database transaction.
+    """
+    from docdata.models import PaymentCluster
+
+    if not client:
+        client = get_payment_client()
+
+    payment = PaymentCluster()
+    payment.interface = TimeoutInterface(client, timeout)
+    payment.create_cluster(**kwargs)
+
+    return payment
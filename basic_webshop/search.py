@@ -0,0 +1,282 @@
+"""
+Pluggable product search.
+
+The backend is configured with the `SHOPKIT_SEARCH_BACKEND` setting and
+defaults to `IndexSearchBackend`, which keeps an inverted index per language
+of product, brand and category names and product descriptions in the
+`ProductSearchToken` model. The index is updated incrementally by the
+search listeners in `basic_webshop.listeners`, within the transaction of
+the change that triggered them.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import re
+import unicodedata
+
+from django.conf import settings
+from django.db.models import Q
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.html import strip_tags
+from django.utils.importlib import import_module
+from django.utils.translation import get_language
+
+
+SEARCH_BACKEND = getattr(settings, 'SHOPKIT_SEARCH_BACKEND',
+                         'basic_webshop.search.IndexSearchBackend')
+
+TOKEN_MAX_LENGTH = 64
+TOKEN_SPLIT_RE = re.compile(r'\W+', re.UNICODE)
+
+# Stay below the 999 query parameters SQLite allows
+SEARCH_BATCH_SIZE = getattr(settings, 'SHOPKIT_SEARCH_BATCH_SIZE', 500)
+
+
+def fold(text):
+    """ Lowercase the given text and strip accents from it. """
+    text = unicodedata.normalize('NFKD', unicode(text).lower())
+
+    return u''.join(c for c in text if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    """ Return a list of accent-folded, lowercase tokens for text. """
+    tokens = TOKEN_SPLIT_RE.split(fold(text))
+
+    return [token[:TOKEN_MAX_LENGTH] for token in tokens if token]
+
+
+class SearchResults(object):
+    """
+    Ranked search results, behaving as a list of products. Only the ids
+    of all results are kept: products are fetched for the requested slice,
+    so paginating the results loads a single page of products.
+    """
+
+    def __init__(self, queryset, product_ids, batch_size=SEARCH_BATCH_SIZE):
+        self.queryset = queryset
+        self.batch_size = batch_size
+
+        # Drop results not in the queryset, in batches of ids
+        found = set()
+        for start in xrange(0, len(product_ids), batch_size):
+            batch = product_ids[start:start + batch_size]
+            found.update(queryset.filter(pk__in=batch).values_list(
+                'pk', flat=True))
+
+        self.product_ids = [pk for pk in product_ids if pk in found]
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    def count(self):
+        return len(self.product_ids)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self.queryset.get(pk=self.product_ids[index])
+
+        product_ids = self.product_ids[index]
+
+        products = {}
+        for start in xrange(0, len(product_ids), self.batch_size):
+            batch = product_ids[start:start + self.batch_size]
+            products.update(self.queryset.in_bulk(batch))
+
+        return [products[pk] for pk in product_ids if pk in products]
+
+    def __iter__(self):
+        for start in xrange(0, len(self.product_ids), self.batch_size):
+            for product in self[start:start + self.batch_size]:
+                yield product
+
+
+class SearchBackend(object):
+    """ Base class for search backends. """
+
+    def search(self, query, language_code=None):
+        """
+        Return a list of product ids matching all terms in query, best
+        matches first.
+        """
+        raise NotImplementedError
+
+    def update_product(self, product):
+        """ Update the search data for a single product. """
+        pass
+
+    def update_products(self, products):
+        """ Update the search data for a list of products. """
+        for product in products:
+            self.update_product(product)
+
+    def remove_translation(self, product_id, language_code):
+        """ Remove the search data for a deleted product translation. """
+        pass
+
+    def rebuild(self):
+        """ Rebuild the search data for all products. """
+        pass
+
+
+class SimpleSearchBackend(SearchBackend):
+    """
+    Search backend performing case insensitive matching against the
+    translation tables directly. Does not require an index but scans
+    the translations for every term.
+    """
+
+    def search(self, query, language_code=None):
+        from basic_webshop.models import Product
+
+        if not language_code:
+            language_code = get_language()
+
+        products = Product.objects.all()
+        for term in query.split():
+            products = products.filter(
+                Q(translations__language_code=language_code,
+                  translations__name__icontains=term) | \
+                Q(brand__translations__language_code=language_code,
+                  brand__translations__name__icontains=term) | \
+                Q(categories__translations__language_code=language_code,
+                  categories__translations__name__icontains=term))
+
+        return list(products.distinct().values_list('pk', flat=True))
+
+
+class IndexSearchBackend(SearchBackend):
+    """
+    Search backend using an inverted index of accent-folded tokens per
+    language. Terms match tokens by prefix and products are ranked by the
+    summed weight of the fields their matching tokens stem from.
+    """
+
+    name_weight = 10
+    brand_weight = 5
+    category_weight = 3
+    description_weight = 1
+
+    def get_product_tokens(self, product):
+        """
+        Return a dictionary mapping language codes to dictionaries of
+        token weights for the given product.
+        """
+        brand_names = dict(
+            product.brand.translations.values_list('language_code', 'name'))
+
+        category_names = {}
+        for category in product.categories.all():
+            for language_code, name in \
+                    category.translations.values_list('language_code', 'name'):
+                category_names.setdefault(language_code, []).append(name)
+
+        product_tokens = {}
+        for translation in product.translations.all():
+            language_code = translation.language_code
+
+            fields = [(translation.name, self.name_weight),
+                      (strip_tags(translation.description),
+                       self.description_weight)]
+
+            if language_code in brand_names:
+                fields.append((brand_names[language_code],
+                               self.brand_weight))
+
+            for name in category_names.get(language_code, []):
+                fields.append((name, self.category_weight))
+
+            weights = product_tokens.setdefault(language_code, {})
+            for text, weight in fields:
+                for token in set(tokenize(text)):
+                    weights[token] = weights.get(token, 0) + weight
+
+        return product_tokens
+
+    def update_product(self, product):
+        from basic_webshop.models import ProductSearchToken
+
+        ProductSearchToken.objects.filter(product=product).delete()
+
+        product_tokens = self.get_product_tokens(product)
+        for language_code, weights in product_tokens.iteritems():
+            for token, weight in weights.iteritems():
+                ProductSearchToken.objects.create(product=product,
+                                                  language_code=language_code,
+                                                  token=token,
+                                                  weight=weight)
+
+        logger.debug(u'Indexed %d languages for product %d',
+                     len(product_tokens), product.pk)
+
+    def remove_translation(self, product_id, language_code):
+        from basic_webshop.models import ProductSearchToken
+
+        # Tokens for a language stem only from that language's translation
+        ProductSearchToken.objects.filter(product=product_id,
+                                          language_code=language_code).delete()
+
+    def rebuild(self):
+        from basic_webshop.models import Product, ProductSearchToken
+
+        ProductSearchToken.objects.all().delete()
+
+        self.update_products(Product.objects.all())
+
+    def search(self, query, language_code=None):
+        from basic_webshop.models import ProductSearchToken
+
+        if not language_code:
+            language_code = get_language()
+
+        terms = list(set(tokenize(query)))
+        if not terms:
+            return []
+
+        # Prefix matching as a range query, so the index on token is used
+        prefix_filter = Q()
+        for term in terms:
+            prefix_filter |= Q(token__gte=term,
+                               token__lt=term + u'\uffff')
+
+        tokens = ProductSearchToken.objects.filter(language_code=language_code)
+        tokens = tokens.filter(prefix_filter)
+        tokens = tokens.values_list('product', 'token', 'weight')
+
+        # Products should match all terms
+        scores = {}
+        matched_terms = {}
+        for product_id, token, weight in tokens:
+            for term in terms:
+                if token.startswith(term):
+                    matched_terms.setdefault(product_id, set()).add(term)
+
+            scores[product_id] = scores.get(product_id, 0) + weight
+
+        product_ids = [product_id for product_id, matched \
+                       in matched_terms.iteritems() \
+                       if len(matched) == len(terms)]
+        product_ids.sort(key=lambda product_id: -scores[product_id])
+
+        return product_ids
+
+
+_search_backend = None
+
+def get_search_backend():
+    """ Return an instance of the configured search backend. """
+    global _search_backend
+
+    if not _search_backend:
+        module_name, class_name = SEARCH_BACKEND.rsplit('.', 1)
+
+        try:
+            backend_class = getattr(import_module(module_name), class_name)
+        except (ImportError, AttributeError) as e:
+            raise ImproperlyConfigured(
+                'Error loading search backend %s: %s' % (SEARCH_BACKEND, e))
+
+        _search_backend = backend_class()
+
+    return _search_backend
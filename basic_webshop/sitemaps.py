@@ -1,24 +1,217 @@
+"""
+Sitemaps for products, brands and categories.
+
+Items are plain `values_list` rows or category tree nodes rather than
+model instances, and URLs are filled into a URL reversed once per sitemap.
+Besides being used with Django's sitemap views, sitemaps can be written as
+static (gzipped) shards of at most `SHOPKIT_SITEMAP_SHARD_SIZE` URLs with
+a sitemap index, by `SitemapWriter` or the `write_sitemaps` management
+command.
+"""
+
+import datetime
+import gzip
+import os
+
+import logging
+logger = logging.getLogger(__name__)
+
+from xml.sax.saxutils import escape
+
+from django.conf import settings
 from django.contrib.sitemaps import Sitemap
-from basic_webshop.models import Brand, Category, Product
+from django.core.urlresolvers import reverse
+
+from basic_webshop.models import Brand, Product
+from basic_webshop.category_tree import get_category_tree
+
+
+SITEMAP_SHARD_SIZE = getattr(settings, 'SHOPKIT_SITEMAP_SHARD_SIZE', 50000)
+
+SLUG_PLACEHOLDER = 'sitemap-slug-placeholder'
+
+
+class SlugSitemap(Sitemap):
+    """
+    Sitemap for items with a URL determined by their slug only. Items are
+    rows of which the first value is the slug.
+    """
+    url_name = None
+
+    def get_url_template(self):
+        if not hasattr(self, '_url_template'):
+            self._url_template = reverse(self.url_name,
+                                         kwargs={'slug': SLUG_PLACEHOLDER})
+
+        return self._url_template
+
+    def location(self, item):
+        return self.get_url_template().replace(SLUG_PLACEHOLDER, item[0])
 
-class ProductSitemap(Sitemap):
+
+class ProductSitemap(SlugSitemap):
     changefreq = "always"
+    url_name = 'product_detail'
 
     def items(self):
-        return Product.in_shop.all()
+        return Product.in_shop.order_by('pk').values_list('slug',
+                                                          'date_modified')
+
+    def lastmod(self, item):
+        return item[1]
 
-    def lastmod(self, obj):
-        return obj.date_modified
 
-class BrandSitemap(Sitemap):
+class BrandSitemap(SlugSitemap):
     changefreq = "always"
+    url_name = 'brand_detail'
 
     def items(self):
-        return Brand.objects.all()
+        return Brand.objects.order_by('pk').values_list('slug')
+
 
 class CategorySitemap(Sitemap):
     changefreq = "always"
 
     def items(self):
-        return Category.objects.all()
+        """ Active nodes from the cached category tree. """
+        tree = get_category_tree()
+
+        nodes = [node for node in tree.nodes.itervalues() if node.is_active()]
+        nodes.sort(key=lambda node: node.pk)
+
+        return nodes
+
+    def location(self, node):
+        return node.get_absolute_url()
+
+
+SITEMAPS = {
+    'products': ProductSitemap,
+    'brands': BrandSitemap,
+    'categories': CategorySitemap,
+}
+
+
+def iter_urls(sitemap):
+    """ Generate (location, lastmod, changefreq) tuples for a sitemap. """
+    items = sitemap.items()
+
+    # Stream querysets rather than caching them
+    if hasattr(items, 'iterator'):
+        items = items.iterator()
+
+    lastmod = getattr(sitemap, 'lastmod', None)
+    changefreq = getattr(sitemap, 'changefreq', None)
+
+    for item in items:
+        if callable(lastmod):
+            item_lastmod = lastmod(item)
+        else:
+            item_lastmod = lastmod
+
+        yield sitemap.location(item), item_lastmod, changefreq
+
+
+class SitemapWriter(object):
+    """
+    Write sitemaps as static files: one or more shards per section and a
+    `sitemap.xml` index referring to them.
+    """
+
+    def __init__(self, directory, base_url, compress=True,
+                 shard_size=SITEMAP_SHARD_SIZE):
+        self.directory = directory
+        self.base_url = base_url.rstrip('/')
+        self.compress = compress
+        self.shard_size = shard_size
+
+    def _open(self, filename):
+        path = os.path.join(self.directory, filename)
+
+        if self.compress:
+            return gzip.open(path, 'wb')
+
+        return open(path, 'wb')
+
+    def _get_shard_name(self, section, number):
+        filename = 'sitemap-%s-%d.xml' % (section, number)
+
+        if self.compress:
+            filename += '.gz'
+
+        return filename
+
+    def write_section(self, section, sitemap):
+        """ Write the shards for a sitemap, return their file names. """
+        filenames = []
+        shard = None
+        count = 0
+
+        for location, lastmod, changefreq in iter_urls(sitemap):
+            if count % self.shard_size == 0:
+                if shard:
+                    self._close_shard(shard)
+
+                filename = self._get_shard_name(section, len(filenames) + 1)
+                filenames.append(filename)
+
+                shard = self._open(filename)
+                shard.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                            '<urlset xmlns="http://www.sitemaps.org/'
+                            'schemas/sitemap/0.9">\n')
+
+            entry = u'<url><loc>%s%s</loc>' % (self.base_url,
+                                               escape(location))
+            if lastmod:
+                entry += u'<lastmod>%s</lastmod>' % \
+                    lastmod.strftime('%Y-%m-%d')
+            if changefreq:
+                entry += u'<changefreq>%s</changefreq>' % changefreq
+            entry += u'</url>\n'
+
+            shard.write(entry.encode('utf-8'))
+            count += 1
+
+        if shard:
+            self._close_shard(shard)
+
+        logger.debug(u'Wrote %d URLs in %d shards for sitemap %s',
+                     count, len(filenames), section)
+
+        return filenames
+
+    def _close_shard(self, shard):
+        shard.write('</urlset>\n')
+        shard.close()
+
+    def write(self, sitemaps=SITEMAPS):
+        """
+        Write shards for all sitemaps and the index. Returns the file names
+        of the shards.
+        """
+        filenames = []
+        for section in sorted(sitemaps.keys()):
+            sitemap = sitemaps[section]
+            if callable(sitemap):
+                sitemap = sitemap()
+
+            filenames.extend(self.write_section(section, sitemap))
+
+        today = datetime.date.today().strftime('%Y-%m-%d')
+
+        index = open(os.path.join(self.directory, 'sitemap.xml'), 'wb')
+        try:
+            index.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                        '<sitemapindex xmlns="http://www.sitemaps.org/'
+                        'schemas/sitemap/0.9">\n')
+
+            for filename in filenames:
+                index.write('<sitemap><loc>%s/%s</loc>'
+                            '<lastmod>%s</lastmod></sitemap>\n' % \
+                            (self.base_url, filename, today))
+
+            index.write('</sitemapindex>\n')
+        finally:
+            index.close()
 
+        return filenames
@@ -3,31 +3,30 @@ from templatetag_sugar.parser import *
 
 from django import template
 from django.utils.datastructures import SortedDict
-import string
 
-register = template.Library()
+from basic_webshop.brand_directory import BrandDirectory, get_first_letter
 
-def firstletter(brand):
-    for c in brand.upper():
-        if c in string.ascii_uppercase:
-            return c
+register = template.Library()
 
-    # give A if we cant find any letters.
-    return 'A'
+# Backwards compatibility
+firstletter = get_first_letter
 
 @tag(register, [Variable(), Constant("as"), Name(), Constant("and"), Name()])
 def brand_alphabetize(context, brands, asvar1, asvar2):
-    brands = list(brands)
+    if isinstance(brands, BrandDirectory):
+        # Grouped in advance
+        letter_brands = brands.letters
 
-    letter_brands = SortedDict()
+    else:
+        letter_brands = SortedDict()
 
-    for brand in brands:
-        first_letter = firstletter(brand.name)
+        for brand in brands:
+            first_letter = firstletter(brand.name)
 
-        try:
-            letter_brands[first_letter].append(brand)
-        except KeyError:
-            letter_brands[first_letter] = [brand, ]
+            try:
+                letter_brands[first_letter].append(brand)
+            except KeyError:
+                letter_brands[first_letter] = [brand, ]
 
     half = len(letter_brands) / 2
     context[asvar1] = letter_brands.items()[:half]
@@ -0,0 +1,20 @@
+from templatetag_sugar.register import tag
+from templatetag_sugar.parser import *
+
+from django import template
+
+from basic_webshop.category_tree import get_category_tree
+
+register = template.Library()
+
+
+@tag(register, [Constant("as"), Name()])
+def get_main_categories(context, asvar):
+    """
+    Store the active main categories from the cached category tree in the
+    context. Their subcategories are available through
+    `get_subcategories` without database access.
+    """
+    context[asvar] = get_category_tree().get_main_categories()
+
+    return ""
@@ -1,30 +1,34 @@
+"""
+Display filters for amounts without stored VAT, like product prices. Orders
+store their VAT, so use `vat_amount`, `net_price` and `gross_price` of
+orders and order items instead. The VAT class defaults to
+`SHOPKIT_DEFAULT_VAT_CLASS`, ie. `{{ price|vat_inclusive:"low" }}`.
+"""
+
 from decimal import Decimal
 
 from django import template
-from django.conf import settings
-
-register = template.Library()
 
-VAT_PERCENTAGE = getattr(settings, 'SHOPKIT_VAT_PERCENTAGE', 19)
+from basic_webshop.vat import quantize, get_vat_rate, calculate_vat
 
-vat_factor = VAT_PERCENTAGE/100.0
+register = template.Library()
 
+def to_decimal(value):
+    return Decimal(str(value))
 
 @register.filter
-def vat_amount(value):
+def vat_amount(value, vat_class=None):
     """ Total amount of VAT for amount. """
-    amount = float(value)
-    return amount*vat_factor
+    return calculate_vat(to_decimal(value), get_vat_rate(vat_class))
 
 @register.filter
-def vat_inclusive(value):
+def vat_inclusive(value, vat_class=None):
     """ Amount inlcuding VAT. """
-    amount = float(value)
-    return amount*(1+vat_factor)
+    amount = to_decimal(value)
+    return quantize(amount) + calculate_vat(amount, get_vat_rate(vat_class))
 
 @register.filter
-def vat_exclusive(value):
-    """ Amount inlcuding VAT. """
-    amount = float(value)
-    return amount*(1-vat_factor)
-
+def vat_exclusive(value, vat_class=None):
+    """ Amount excluding VAT, for an amount including VAT. """
+    rate = get_vat_rate(vat_class)
+    return quantize(to_decimal(value) * 100 / (100 + rate))
@@ -4,11 +4,25 @@ from basic_webshop.tests.base import WebshopTestCase
 from shopkit.core.tests import CoreTestMixin
 from shopkit.category.simple.tests import CategoryTestMixin
 
-from basic_webshop.models import Product
+from basic_webshop.models import Product, Category
 from basic_webshop.tests.discounts import DiscountTest
 from basic_webshop.tests.shipping import ShippingTest
 from basic_webshop.tests.stock import StockTest
 from basic_webshop.tests.orders import OrderTest
+from basic_webshop.tests.listing import ListingTest
+from basic_webshop.tests.search import SearchTest
+from basic_webshop.tests.mailqueue import MailQueueTest
+from basic_webshop.tests.category_tree import CategoryTreeTest
+from basic_webshop.tests.page_cache import PageCacheTest
+from basic_webshop.tests.ratings import RatingTest
+from basic_webshop.tests.payment import PaymentTest
+from basic_webshop.tests.thumbnails import ThumbnailTest
+from basic_webshop.tests.sitemaps import SitemapTest
+from basic_webshop.tests.catalog import CatalogTest
+from basic_webshop.tests.benchmark import BenchmarkTest
+from basic_webshop.tests.admin import AdminTest
+from basic_webshop.tests.brand_directory import BrandDirectoryTest
+from basic_webshop.tests.vat import VatTest
 
 
 class SimpleTest(WebshopTestCase, CategoryTestMixin, CoreTestMixin):
@@ -32,3 +46,30 @@ class SimpleTest(WebshopTestCase, CategoryTestMixin, CoreTestMixin):
         self.assertEqual(p.price, Decimal("15.00"))
         self.assertEqual(p.description, \
             'A nice piece of fruit for the whole family to enjoy.')
+
+    def test_unique_slug(self):
+        """ Generated slugs get the lowest free numeric suffix. """
+        for slug in ('banana', 'banana-1', 'banana-3', 'banana-split'):
+            p = self.make_test_product(slug=slug)
+            p.save()
+
+        p = self.make_test_product(slug='')
+        p.save()
+
+        pt = self.make_test_producttranslation(p)
+        pt.save()
+
+        p = Product.objects.get(pk=p.pk)
+        self.assertEqual(p.slug, 'banana-2')
+
+        # Category slugs are unique among siblings only
+        parent = self.make_test_category()
+        parent.save()
+
+        child = Category(parent=parent)
+        child.name = 'Test'
+        self.assertEqual(child.generate_slug(), 'test')
+
+        root = Category()
+        root.name = 'Test'
+        self.assertEqual(root.generate_slug(), 'test-1')
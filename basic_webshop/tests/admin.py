@@ -0,0 +1,165 @@
+from django.contrib.admin.sites import AdminSite
+from django.contrib.admin.filterspecs import FilterSpec
+from django.contrib.auth.models import User
+from django.test.client import RequestFactory
+
+from basic_webshop.tests.base import WebshopTestCase
+from basic_webshop.models import Product, Category, BrandTranslation, \
+                                 ProductMedia
+from basic_webshop.admin import ProductAdmin, CategoryAdmin, \
+                                CachedRelatedFilterSpec, get_brand_choices, \
+                                get_category_choices
+from basic_webshop.category_tree import get_category_tree
+
+
+class AdminTest(WebshopTestCase):
+    """ Test the query counts of admin change lists. """
+
+    def setUp(self):
+        super(AdminTest, self).setUp()
+
+        self.admin = ProductAdmin(Product, AdminSite())
+
+        self.request = RequestFactory().get('/')
+        self.request.user = User(username='admin', is_staff=True,
+                                 is_superuser=True)
+
+    def make_changelist(self):
+        admin = self.admin
+        changelist_class = admin.get_changelist(self.request)
+
+        return changelist_class(self.request, Product, admin.list_display,
+                                admin.list_display_links, admin.list_filter,
+                                admin.date_hierarchy, admin.search_fields,
+                                admin.list_select_related,
+                                admin.list_per_page, admin.list_editable,
+                                admin)
+
+    def test_product_changelist(self):
+        """ Rows are rendered without additional queries. """
+        b = self.make_test_brand()
+        b.save()
+
+        BrandTranslation(parent=b, language_code='en', name='Brand',
+                         description='A brand').save()
+
+        c1 = self.make_test_category()
+        c1.save()
+
+        c2 = Category(slug='test2')
+        c2.save()
+
+        for slug in ('p1', 'p2', 'p3'):
+            p = self.make_test_product(slug=slug)
+            p.save()
+            p.categories.add(c1, c2)
+
+            self.make_test_producttranslation(p).save()
+
+        changelist = self.make_changelist()
+        self.assertEqual(len(changelist.result_list), 3)
+
+        # Warm up the category tree
+        get_category_tree()
+
+        def render_rows():
+            for product in changelist.result_list:
+                unicode(product.display_name())
+                self.admin.admin_categories(product)
+                product.get_default_image()
+
+        self.assertNumQueries(0, render_rows)
+
+        self.assertEqual(changelist.result_list[0].get_category_ids(),
+                         [c1.pk, c2.pk])
+
+    def test_category_changelist(self):
+        """ Category rows render from the counters and the cached tree. """
+        parent = self.make_test_category()
+        parent.save()
+
+        child = Category(slug='child', parent=parent)
+        child.save()
+
+        p = self.make_test_product()
+        p.save()
+        p.categories.add(child)
+
+        category_admin = CategoryAdmin(Category, AdminSite())
+        categories = list(Category.objects.all())
+
+        # Warm up the category tree
+        get_category_tree()
+
+        def render_rows():
+            for category in categories:
+                category_admin.admin_name(category)
+                category_admin.admin_products(category)
+
+        self.assertNumQueries(0, render_rows)
+
+    def test_filter_choices(self):
+        """ Filter choices come from the cache. """
+        b = self.make_test_brand()
+        b.save()
+
+        c = self.make_test_category()
+        c.save()
+
+        self.assertEqual(get_brand_choices(), [(b.pk, unicode(b))])
+        self.assertNumQueries(0, get_brand_choices)
+
+        # Brand changes refresh the choices
+        b2 = self.make_test_brand()
+        b2.slug = 'other'
+        b2.save()
+        self.assertEqual(len(get_brand_choices()), 2)
+
+        self.assertEqual([pk for pk, name in get_category_choices()], [c.pk])
+        self.assertNumQueries(0, get_category_choices)
+
+    def test_filter_specs(self):
+        """ Cached filters are only used by the shop's change lists. """
+        for slug in ('brand1', 'brand2'):
+            b = self.make_test_brand()
+            b.slug = slug
+            b.save()
+
+        changelist = self.make_changelist()
+        specs = dict((spec.field.name, spec) \
+                     for spec in changelist.get_filters(self.request)[0])
+
+        self.assertTrue(isinstance(specs['brand'], CachedRelatedFilterSpec))
+        self.assertFalse([spec for test, spec in FilterSpec.filter_specs \
+                          if spec is CachedRelatedFilterSpec])
+
+    def test_link_list(self):
+        """ Link lists are cached and validated by their ETag. """
+        p = self.make_test_product()
+        p.save()
+
+        m = ProductMedia(product=p, name='Manual',
+                         mediafile='product_media/manual.pdf')
+        m.save()
+
+        response = self.admin.get_link_list(self.request, str(p.pk))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('manual.pdf' in response.content)
+
+        etag = response['ETag']
+
+        # Unchanged lists are not rendered again
+        request = RequestFactory().get('/', HTTP_IF_NONE_MATCH=etag)
+        request.user = self.request.user
+
+        response = self.admin.get_link_list(request, str(p.pk))
+        self.assertEqual(response.status_code, 304)
+
+        # Changing the related rows changes the ETag
+        m.name = 'Leaflet'
+        m.save()
+
+        response = self.admin.get_link_list(request, str(p.pk))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertTrue('Leaflet' in response.content)
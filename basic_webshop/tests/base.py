@@ -1,5 +1,6 @@
 from decimal import Decimal
 
+from django.core.cache import cache
 from django.test import TestCase
 
 from countries.models import Country
@@ -11,6 +12,10 @@ from basic_webshop.models import \
 class WebshopTestCase(TestCase):
     """ Base class with helper function for actual tests. """
 
+    def setUp(self):
+        # Cached indexes and trees should not leak between tests
+        cache.clear()
+
     def make_test_shippingmethod(self, order_cost=Decimal('10.00')):
         """ Make a shipping method for testing. """
         s = ShippingMethod()
@@ -0,0 +1,49 @@
+from basic_webshop.tests.base import WebshopTestCase
+from basic_webshop.models import Product, Category, ProductRating
+from basic_webshop.benchmark import CatalogGenerator, QueryCounter, \
+                                    compare_results
+
+
+class BenchmarkTest(WebshopTestCase):
+    """ Test the synthetic catalog and the comparison of results. """
+
+    def test_catalog(self):
+        """ Generate a small catalog. """
+        catalog = CatalogGenerator(products=4, categories=3, brands=2,
+                                   languages=['en', 'nl'], ratings=1,
+                                   variations=1).generate()
+
+        self.assertEqual(Product.objects.count(), 4)
+        self.assertEqual(ProductRating.objects.count(), 4)
+        self.assertEqual(
+            Product.objects.filter(brand=catalog.brands[1]).count(), 2)
+
+        # Categories form a three level tree
+        self.assertEqual(Category.objects.get(slug='category-2').get_level(),
+                         2)
+
+        product = Product.objects.get(slug='product-0')
+        self.assertEqual(product.translations.count(), 2)
+
+        with QueryCounter() as queries:
+            list(Product.objects.all())
+        self.assertEqual(queries.count, 1)
+
+    def test_compare(self):
+        """ Regressions beyond the tolerances are reported. """
+        view = {'status': 200, 'queries': 10, 'cached_queries': 0,
+                'time': 0.1, 'cached_time': 0.01, 'memory': 0}
+        tolerances = {'query_tolerance': 0, 'time_tolerance': 2.0,
+                      'memory_tolerance': 1024}
+
+        baseline = {'catalog': {'products': 10}, 'views': {'test': view}}
+
+        results = {'catalog': {'products': 10},
+                   'views': {'test': dict(view, time=0.15)}}
+        self.assertEqual(compare_results(baseline, results, **tolerances), [])
+
+        results['views']['test'].update({'queries': 11, 'time': 0.3})
+        self.assertEqual(len(compare_results(baseline, results, **tolerances)), 2)
+
+        results['catalog'] = {'products': 20}
+        self.assertEqual(len(compare_results(baseline, results, **tolerances)), 1)
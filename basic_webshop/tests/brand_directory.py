@@ -0,0 +1,54 @@
+from django.core.files.storage import default_storage
+
+from basic_webshop.tests.base import WebshopTestCase
+from basic_webshop.models import Brand, BrandTranslation
+from basic_webshop.brand_directory import get_brand_directory
+
+
+class BrandDirectoryTest(WebshopTestCase):
+    """ Test the cached brand directory. """
+
+    def make_brand(self, slug, name, language_code='en'):
+        b = Brand(slug=slug)
+        b.save()
+
+        bt = BrandTranslation(parent=b, name=name, description=name,
+                              language_code=language_code)
+        bt.save()
+
+        return b, bt
+
+    def test_directory(self):
+        """ Brands are grouped by the first letter of their name. """
+        self.make_brand('zebra', 'Zebra')
+        b, bt = self.make_brand('apple', 'apple')
+        self.make_brand('ananas', 'Ananas')
+        self.make_brand('dutch', 'Nederlands', language_code='nl')
+
+        directory = get_brand_directory('en')
+
+        self.assertEqual([brand.slug for brand in directory],
+                         ['ananas', 'apple', 'zebra'])
+        self.assertEqual(directory.letters.keys(), ['A', 'Z'])
+        self.assertEqual(directory.letters['A'][1].get_absolute_url(),
+                         b.get_absolute_url())
+
+        self.assertNumQueries(0, lambda: get_brand_directory('en'))
+
+        # Changes should invalidate the directory
+        bt.name = 'Banana'
+        bt.save()
+
+        directory = get_brand_directory('en')
+        self.assertEqual(directory.letters.keys(), ['A', 'B', 'Z'])
+        self.assertEqual(unicode(directory.letters['B'][0]), 'Banana')
+
+    def test_logo(self):
+        """ Logos without a rendered thumbnail use the original image. """
+        b, bt = self.make_brand('apple', 'Apple')
+        b.logo = 'brand_logos/missing.png'
+        b.save()
+
+        directory = get_brand_directory('en')
+        self.assertEqual(directory.brands[0].logo,
+                         default_storage.url('brand_logos/missing.png'))
@@ -0,0 +1,127 @@
+import datetime
+
+from decimal import Decimal
+from StringIO import StringIO
+
+from django.utils import simplejson
+
+from basic_webshop.tests.base import WebshopTestCase
+from basic_webshop.models import Product, ProductVariation, Category
+from basic_webshop.catalog_io import CatalogImporter, CatalogExporter, \
+                                     read_jsonl, read_csv, write_csv
+
+
+class CatalogTest(WebshopTestCase):
+    """ Test bulk catalog import and export. """
+
+    def setUp(self):
+        super(CatalogTest, self).setUp()
+
+        self.make_test_brand().save()
+
+    def make_rows(self, *rows):
+        return StringIO('\n'.join(simplejson.dumps(row) for row in rows))
+
+    def test_import(self):
+        """ Import products with translations, categories and stock. """
+        rows = self.make_rows(
+            {'slug': 'banana', 'article_number': 'B01', 'price': '1.50',
+             'stock': 10, 'active': True, 'brand': 'test',
+             'categories': ['fruit/tropical'],
+             'variations': [{'slug': 'small', 'stock': 5}],
+             'language_code': 'en', 'name': 'Banana'},
+            {'slug': 'banana', 'language_code': 'nl', 'name': 'Banaan'},
+            {'slug': 'apple', 'name': 'No article number'},
+            {'slug': 'kiwi', 'article_number': 'K01', 'price': '2.00',
+             'brand': 'unknown'},
+        )
+
+        importer = CatalogImporter(batch_size=2)
+        stats = importer.run(read_jsonl(rows))
+
+        self.assertEqual(stats['rows'], 4)
+        self.assertEqual(stats['products_created'], 1)
+        self.assertEqual(stats['translations'], 2)
+        self.assertEqual(stats['categories_created'], 2)
+        self.assertEqual([line for line, message in importer.errors], [3, 4])
+
+        p = Product.objects.get(slug='banana')
+        self.assertEqual(p.price, Decimal('1.50'))
+        self.assertEqual(p.stock, 10)
+        self.assertEqual(p.translations.get(language_code='nl').name,
+                         'Banaan')
+        self.assertEqual(list(p.categories.values_list('slug', flat=True)),
+                         ['tropical'])
+        self.assertEqual(ProductVariation.objects.get(product=p,
+                                                  slug='small').stock, 5)
+
+        # Categories are created as a proper tree, and counted
+        tropical = Category.objects.get(slug='tropical')
+        self.assertEqual([c.slug for c in tropical.get_ancestors()],
+                         ['fruit'])
+        self.assertEqual(tropical.active_product_count, 1)
+
+        # Importing again updates rather than duplicates, and the
+        # modification date
+        Product.objects.filter(pk=p.pk).update(
+            date_modified=datetime.datetime(2000, 1, 1))
+
+        rows = self.make_rows(
+            {'slug': 'banana', 'stock': 3, 'categories': 'fruit',
+             'variations': 'small:1|large:2'})
+
+        stats = CatalogImporter().run(read_jsonl(rows))
+        self.assertEqual(stats['products_created'], 0)
+        self.assertEqual(stats['products_updated'], 1)
+        self.assertEqual(stats['categories_created'], 0)
+
+        p = Product.objects.get(slug='banana')
+        self.assertEqual(p.stock, 3)
+        self.assert_(p.date_modified.year > 2000)
+        self.assertEqual(p.price, Decimal('1.50'))
+        self.assertEqual(list(p.categories.values_list('slug', flat=True)),
+                         ['fruit'])
+        self.assertEqual(ProductVariation.objects.filter(
+            product=p).count(), 2)
+
+    def test_dry_run(self):
+        """ Dry runs report rather than create missing categories. """
+        rows = self.make_rows(
+            {'slug': 'banana', 'article_number': 'B01', 'price': '1.50',
+             'categories': ['fruit/tropical']})
+
+        importer = CatalogImporter(dry_run=True)
+        importer.run(read_jsonl(rows))
+
+        self.assertEqual(importer.missing_categories,
+                         set([('fruit', 'tropical')]))
+        self.assertFalse(Category.objects.exists())
+
+    def test_export(self):
+        """ Exported rows can be imported again. """
+        c = self.make_test_category()
+        c.save()
+
+        p = self.make_test_product()
+        p.article_number = 'B01'
+        p.save()
+        p.categories.add(c)
+
+        self.make_test_producttranslation(p).save()
+        self.make_test_productvariation(p, stock=4).save()
+
+        rows = list(CatalogExporter().iter_rows())
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['slug'], 'banana')
+        self.assertEqual(rows[0]['categories'], ['test'])
+        self.assertEqual(rows[0]['variations'], [('test', 4)])
+        self.assertEqual(rows[0]['name'], 'Banana')
+
+        stream = StringIO()
+        write_csv(stream, rows)
+        stream.seek(0)
+
+        stats = CatalogImporter().run(read_csv(stream))
+        self.assertEqual(stats['errors'], 0)
+        self.assertEqual(stats['products_updated'], 1)
+        self.assertEqual(Product.objects.get(pk=p.pk).price, p.price)
@@ -0,0 +1,137 @@
+from django.template import Template, Context
+
+from basic_webshop.tests.base import WebshopTestCase
+from basic_webshop.models import Category, CategoryTranslation
+from basic_webshop.category_tree import get_category_tree
+
+
+class CategoryTreeTest(WebshopTestCase):
+    """ Test the cached category tree. """
+
+    def test_tree(self):
+        """ Test navigation and invalidation of the category tree. """
+        parent = self.make_test_category()
+        parent.active = True
+        parent.save()
+
+        child = Category(slug='child', parent=parent, active=True)
+        child.save()
+
+        ct = CategoryTranslation(parent=child, name='Child',
+                                 language_code='en')
+        ct.save()
+
+        tree = get_category_tree('en')
+
+        self.assertEqual([node.pk for node in tree.get_main_categories()],
+                         [parent.pk])
+
+        node = tree.get_by_slugs('test', 'child')
+        self.assertEqual(node.pk, child.pk)
+        self.assertEqual(node.name, 'Child')
+        self.assertEqual([n.pk for n in node.get_ancestors(include_self=True)],
+                         [parent.pk, child.pk])
+        self.assertEqual(node.get_absolute_url(),
+                         child._get_absolute_url())
+        self.assertEqual(child.get_absolute_url(),
+                         child._get_absolute_url())
+
+        # Changes should invalidate the tree
+        ct.name = 'Kid'
+        ct.save()
+
+        node = get_category_tree('en').get_node(child.pk)
+        self.assertEqual(node.name, 'Kid')
+
+        child.active = False
+        child.save()
+
+        tree = get_category_tree('en')
+        self.assertEqual(tree.get_by_slugs('test', 'child'), None)
+        self.assertEqual(tree.get_node(parent.pk).get_subcategories(), [])
+
+    def test_category_list(self):
+        """ The category list template renders from the cached tree. """
+        parent = self.make_test_category()
+        parent.active = True
+        parent.save()
+
+        child = Category(slug='child', parent=parent, active=True)
+        child.save()
+
+        CategoryTranslation(parent=child, name='Child',
+                            language_code='en').save()
+
+        template = Template(
+            '{% load category_tags %}'
+            '{% get_main_categories as categories %}'
+            '{% include "basic_webshop/include/category_list.html" %}')
+
+        # Warm up the category tree
+        get_category_tree()
+
+        self.assertNumQueries(0, lambda: template.render(Context()))
+
+        output = template.render(Context())
+        self.assertTrue(child.get_absolute_url() in output)
+        self.assertTrue('Child' in output)
+
+    def test_product_counts(self):
+        """ Category product counters follow product changes. """
+        parent = self.make_test_category()
+        parent.active = True
+        parent.save()
+
+        child = Category(slug='child', parent=parent, active=True)
+        child.save()
+
+        p1 = self.make_test_product(slug='p1')
+        p1.active = True
+        p1.save()
+        p1.categories.add(parent, child)
+
+        p2 = self.make_test_product(slug='p2')
+        p2.active = False
+        p2.save()
+        p2.categories.add(child)
+
+        def get_counts(category):
+            category = Category.objects.get(pk=category.pk)
+
+            return (category.active_product_count,
+                    category.inactive_product_count,
+                    category.in_shop_product_count)
+
+        self.assertEqual(get_counts(parent), (1, 0, 1))
+        self.assertEqual(get_counts(child), (1, 1, 1))
+
+        # Activation counts once for the parent, which already has p1
+        p2.active = True
+        p2.save()
+
+        self.assertEqual(get_counts(parent), (1, 0, 2))
+        self.assertEqual(get_counts(child), (2, 0, 2))
+        self.assertEqual(get_category_tree('en').get_node(
+            parent.pk).product_count, 2)
+
+        # Removing and deleting products
+        child.product_set.remove(p1)
+        self.assertEqual(get_counts(parent), (1, 0, 2))
+        self.assertEqual(get_counts(child), (1, 0, 1))
+
+        p2.delete()
+        self.assertEqual(get_counts(parent), (1, 0, 1))
+        self.assertEqual(get_counts(child), (0, 0, 0))
+
+        p1.categories.clear()
+        self.assertEqual(get_counts(parent), (0, 0, 0))
+
+        # Recounting takes a fixed number of queries
+        for slug in ('c1', 'c2', 'c3'):
+            Category(slug=slug, parent=child).save()
+
+        category_ids = list(Category.objects.values_list('pk', flat=True))
+        get_category_tree()
+
+        self.assertNumQueries(4,
+            lambda: Category.update_product_counts(category_ids))
@@ -1,7 +1,17 @@
+import datetime
+
 from decimal import Decimal
 
+from django.test.client import RequestFactory
+
 from basic_webshop.tests.base import WebshopTestCase
-from basic_webshop.models import Discount, Order
+from basic_webshop.models import Discount, Order, Category, Cart
+from basic_webshop.views import CartDetail
+from basic_webshop.discount_index import get_discount_index, \
+                                         get_product_categories, \
+                                         filter_available
+from basic_webshop.category_tree import get_category_tree
+from basic_webshop.vat import get_vat_rate
 
 class DiscountTest(WebshopTestCase):
     """ Test discounts. """
@@ -253,3 +263,210 @@ class DiscountTest(WebshopTestCase):
         self.assertEqual(o.discounts.all().count(), 0)
         self.assertEqual(o.get_order_discount(), Decimal('0.00'))
         self.assertEqual(o.get_price(), Decimal('10.00'))
+
+    def test_ordertotals(self):
+        """
+        Test whether the totals engine calculates discounts, shipping and
+        VAT in one go and stores them on the order.
+        """
+        # Create discount
+        discount = self.make_test_discount()
+        discount.order_percentage = 10
+        discount.save()
+
+        # Create shipping method, valid from an order price of 10
+        s1 = self.make_test_shippingmethod(order_cost=Decimal('3.00'))
+        s1.minimal_order_price = Decimal('10.0')
+        s1.save()
+
+        s2 = self.make_test_shippingmethod(order_cost=Decimal('4.00'))
+        s2.save()
+
+        # Create orderitem
+        i = self.make_test_orderitem(quantity=2, piece_price=Decimal('5.00'))
+        i.save()
+
+        o = i.order
+        totals = o.update()
+
+        # The discount brings the price below the minimum for s1
+        self.assertEqual(totals.subtotal, Decimal('10.00'))
+        self.assertEqual(totals.order_discount, Decimal('1.00'))
+        self.assertEqual(totals.shipping_method, s2)
+        self.assertEqual(totals.price, Decimal('13.00'))
+        self.assertEqual(totals.vat, (Decimal('13.00') * \
+            get_vat_rate() / 100).quantize(Decimal('0.01')))
+
+        # Stored values match the calculation
+        o = Order.objects.get(pk=o.pk)
+        self.assertEqual(o.get_order_discount(), Decimal('1.00'))
+        self.assertEqual(o.shipping_method, s2)
+        self.assertEqual(o.get_price(), totals.price)
+        self.assertEqual(o.discounts.all()[0], discount)
+        self.assertEqual(o.net_price, totals.price)
+        self.assertEqual(o.vat_amount, totals.vat)
+        self.assertEqual(o.gross_price, totals.price + totals.vat)
+
+    def test_ordertotals_parity(self):
+        """
+        Test whether the totals engine yields the same prices as the
+        original shopkit shipping and discount calculations.
+        """
+        # Create item and order discount
+        discount = self.make_test_discount()
+        discount.item_percentage = 10
+        discount.order_amount = Decimal('2.00')
+        discount.save()
+
+        s1 = self.make_test_shippingmethod(order_cost=Decimal('3.00'))
+        s1.minimal_order_price = Decimal('30.0')
+        s1.save()
+
+        s2 = self.make_test_shippingmethod(order_cost=Decimal('4.00'))
+        s2.save()
+
+        i = self.make_test_orderitem(quantity=3, piece_price=Decimal('7.50'))
+        i.save()
+
+        totals = i.order.update()
+
+        # Calculate the same order using shopkit
+        o = Order.objects.get(pk=i.order.pk)
+        o.update_shipping()
+        o.update_discount()
+
+        self.assertEqual(totals.shipping_method, o.shipping_method)
+        self.assertEqual(totals.shipping_costs + totals.item_shipping_costs,
+                         o.get_shipping_costs())
+        self.assertEqual(totals.order_discount, o.get_order_discount())
+        self.assertEqual(totals.price, o.get_price())
+
+    def test_discountindex(self):
+        """
+        Test the discount eligibility index for product, category and
+        coupon discounts.
+        """
+        parent = self.make_test_category()
+        parent.save()
+
+        child = Category(slug='child', parent=parent)
+        child.save()
+
+        p1 = self.make_test_product(price=Decimal('10.00'), slug='p1')
+        p1.save()
+        p1.categories.add(child)
+
+        p2 = self.make_test_product(price=Decimal('10.00'), slug='p2')
+        p2.save()
+
+        # Product discount
+        d1 = self.make_test_discount()
+        d1.order_amount = Decimal('1.00')
+        d1.save()
+        d1.products.add(p2)
+
+        # Category discount, applies to products in subcategories
+        d2 = self.make_test_discount()
+        d2.order_amount = Decimal('2.00')
+        d2.save()
+        d2.categories.add(parent)
+
+        # Coupon discount
+        d3 = self.make_test_discount()
+        d3.order_amount = Decimal('3.00')
+        d3.use_coupon = True
+        d3.coupon_code = 'testme'
+        d3.save()
+
+        # Expired discount
+        d4 = self.make_test_discount()
+        d4.order_amount = Decimal('4.00')
+        d4.end_date = datetime.date.today() - datetime.timedelta(days=1)
+        d4.save()
+
+        index = get_discount_index()
+        products = get_product_categories([p1.pk])
+
+        self.assertEqual(index.get_valid_ids(products=products),
+                         set([d2.pk]))
+        self.assertEqual(index.get_valid_ids(products=products,
+                                             coupon_code='testme'),
+                         set([d2.pk, d3.pk]))
+        self.assertEqual(index.get_coupon_ids('testme'), set([d3.pk]))
+        self.assertEqual(index.get_coupon_ids('wrong'), set())
+
+        # Use limits are checked in the database, not in the index
+        Discount.objects.filter(pk=d3.pk).update(use_limit=1, used=1)
+        self.assertEqual(get_discount_index().get_coupon_ids('testme'),
+                         set([d3.pk]))
+
+        discounts = Discount.objects.filter(pk__in=[d2.pk, d3.pk])
+        self.assertEqual(
+            set(filter_available(discounts).values_list('pk', flat=True)),
+            set([d2.pk]))
+
+        # Changes invalidate the index
+        d1.products.add(p1)
+        index = get_discount_index()
+        self.assertEqual(index.get_valid_ids(products=products),
+                         set([d1.pk, d2.pk]))
+
+        # Product discounts apply to orders
+        i = self.make_test_orderitem(product=p1, piece_price=Decimal('10.00'))
+        i.save()
+
+        o = i.order
+        o.update()
+
+        self.assertEqual(o.get_order_discount(), Decimal('3.00'))
+        self.assertEqual(set(o.discounts.values_list('pk', flat=True)),
+                         set([d1.pk, d2.pk]))
+
+    def test_cartdiscountqueries(self):
+        """
+        Test whether the discounts for the items on the cart page are
+        looked up in a fixed number of queries.
+        """
+        parent = self.make_test_category()
+        parent.save()
+
+        # Item discount for the category, order discount for all products
+        d1 = self.make_test_discount()
+        d1.item_percentage = 10
+        d1.save()
+        d1.categories.add(parent)
+
+        d2 = self.make_test_discount()
+        d2.order_amount = Decimal('1.00')
+        d2.save()
+
+        cart = self.make_test_cart()
+        cart.save()
+
+        for count in (3, 10):
+            for slug in range(len(cart.get_items()), count):
+                p = self.make_test_product(slug='p%d' % slug)
+                p.save()
+                p.categories.add(parent)
+
+                cart.add_item(product=p)
+
+            request = RequestFactory().get('/')
+            request._basic_webshop_cart = Cart.objects.get(pk=cart.pk)
+
+            response = CartDetail.as_view()(request)
+            items = [form.instance for form in \
+                     response.context_data['updateform'].forms]
+            self.assertEqual(len(items), count)
+
+            get_discount_index()
+            get_category_tree()
+
+            # Product ids, their categories and the discounts, regardless
+            # of the number of items
+            def load_discounts():
+                return [list(item.get_valid_discounts(item_discounts=True)) \
+                        for item in items]
+
+            self.assertNumQueries(3, load_discounts)
+            self.assertEqual(load_discounts(), [[d1]] * count)
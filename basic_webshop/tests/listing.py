@@ -0,0 +1,145 @@
+from decimal import Decimal
+
+from basic_webshop.tests.base import WebshopTestCase
+from basic_webshop.models import Category, CategoryFeaturedProduct, \
+    ProductListing, ProductImage
+
+
+class ListingTest(WebshopTestCase):
+    """ Test the denormalized product listing. """
+
+    def make_test_listed_product(self):
+        """ Create a product with a translation in a subcategory. """
+        parent = self.make_test_category()
+        parent.save()
+
+        child = Category(slug='child', parent=parent)
+        child.save()
+
+        p = self.make_test_product()
+        p.active = True
+        p.save()
+
+        p.categories.add(child)
+
+        pt = self.make_test_producttranslation(p)
+        pt.save()
+
+        return p, parent, child
+
+    def test_listing_created(self):
+        """ Products should be listed in their categories and ancestors. """
+        p, parent, child = self.make_test_listed_product()
+
+        for category in (parent, child):
+            listings = ProductListing.get_for_category(category, 'en')
+            self.assertEqual(len(listings), 1)
+
+            listing = listings[0]
+            self.assertEqual(listing.product, p)
+            self.assertEqual(listing.name, 'Banana')
+            self.assertEqual(listing.slug, 'banana')
+            self.assertEqual(listing.brand_slug, p.brand.slug)
+            self.assertEqual(listing.price, Decimal('15.00'))
+            self.assert_(listing.in_stock)
+
+        self.assertFalse(ProductListing.get_for_category(child, 'nl'))
+
+    def test_listing_updated(self):
+        """ Listings should follow changes to the product. """
+        p, parent, child = self.make_test_listed_product()
+
+        p.price = Decimal('12.50')
+        p.save()
+
+        listing = ProductListing.get_for_category(child, 'en')[0]
+        self.assertEqual(listing.price, Decimal('12.50'))
+
+        # Featured products
+        featured = CategoryFeaturedProduct(category=child, product=p,
+                                           featured_order=3)
+        featured.save()
+
+        listing = ProductListing.get_for_category(child, 'en')[0]
+        self.assert_(listing.featured)
+        self.assertEqual(listing.featured_order, 3)
+
+        featured.delete()
+
+        listing = ProductListing.get_for_category(child, 'en')[0]
+        self.assertFalse(listing.featured)
+
+        # Removing the product from its category
+        p.categories.remove(child)
+        self.assertFalse(ProductListing.get_for_category(parent, 'en'))
+
+        # Deactivating the product
+        p.categories.add(child)
+        self.assert_(ProductListing.get_for_category(parent, 'en'))
+
+        p.active = False
+        p.save()
+        self.assertFalse(ProductListing.get_for_category(parent, 'en'))
+
+    def test_listing_image(self):
+        """ Listings should hold the path of the default product image. """
+        p, parent, child = self.make_test_listed_product()
+
+        listing = ProductListing.get_for_category(child, 'en')[0]
+        self.assertEqual(listing.get_default_image(), None)
+
+        image = ProductImage(product=p, image='product_images/banana.jpg')
+        image.save()
+
+        listing = ProductListing.get_for_category(child, 'en')[0]
+        self.assertNumQueries(0, listing.get_default_image)
+        self.assertEqual(listing.get_default_image().image,
+                         'product_images/banana.jpg')
+
+        image.delete()
+
+        listing = ProductListing.get_for_category(child, 'en')[0]
+        self.assertEqual(listing.image, '')
+
+    def test_listing_diffed(self):
+        """ Listings are updated in place rather than recreated. """
+        p, parent, child = self.make_test_listed_product()
+
+        def get_listing_ids():
+            return set(ProductListing.objects.filter(
+                product=p).values_list('pk', flat=True))
+
+        listing_ids = get_listing_ids()
+        self.assertEqual(len(listing_ids), 2)
+
+        p.price = Decimal('12.50')
+        p.save()
+
+        self.assertEqual(get_listing_ids(), listing_ids)
+
+        # Only the listing for the removed category is deleted
+        other = Category(slug='other')
+        other.save()
+
+        p.categories.add(other)
+        self.assertEqual(len(get_listing_ids()), 3)
+
+        p.categories.remove(other)
+        self.assertEqual(get_listing_ids(), listing_ids)
+
+        # Saving a translation without listed changes leaves the listings
+        ProductListing.objects.filter(product=p).update(name='Stale')
+
+        pt = p.translations.get(language_code='en')
+        pt.description = 'Yellow and curved.'
+        pt.save()
+
+        listing = ProductListing.get_for_category(child, 'en')[0]
+        self.assertEqual(listing.name, 'Stale')
+
+        pt.name = 'Plantain'
+        pt.save()
+
+        listing = ProductListing.get_for_category(child, 'en')[0]
+        self.assertEqual(listing.name, 'Plantain')
+        self.assertEqual(get_listing_ids(), listing_ids)
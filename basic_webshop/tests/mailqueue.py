@@ -0,0 +1,90 @@
+from django.core import mail
+from django.core.mail import EmailMessage, EmailMultiAlternatives
+from django.core.mail.backends.locmem import EmailBackend
+
+from basic_webshop.tests.base import WebshopTestCase
+from basic_webshop.models import QueuedMessage
+
+
+class FailingEmailBackend(EmailBackend):
+    """ Email backend which fails to send anything. """
+
+    def send_messages(self, messages):
+        raise IOError('Connection refused')
+
+
+class MailQueueTest(WebshopTestCase):
+    """ Test the outbound mail queue. """
+
+    def make_test_message(self, subject='Test'):
+        return EmailMessage(subject, 'Body', 'shop@test.com',
+                            ['info@test.com', 'manager@test.com'])
+
+    def test_send_queued(self):
+        """ Queued messages should only be sent by the queue. """
+        QueuedMessage.from_message(self.make_test_message('Test 1'))
+        QueuedMessage.from_message(self.make_test_message('Test 2'))
+
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(QueuedMessage.send_queued(batch_size=1), (1, 0))
+        self.assertEqual(QueuedMessage.send_queued(), (1, 0))
+        self.assertEqual(QueuedMessage.send_queued(), (0, 0))
+
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[0].subject, 'Test 1')
+        self.assertEqual(mail.outbox[0].to,
+                         ['info@test.com', 'manager@test.com'])
+
+        self.assertFalse(QueuedMessage.get_due().exists())
+
+    def test_message_preserved(self):
+        """
+        Recipients, headers, attachments and alternatives should survive
+        the queue, and bcc recipients never end up in the To header.
+        """
+        message = EmailMultiAlternatives('Test', 'Body', 'shop@test.com',
+                                         ['info@test.com'],
+                                         bcc=['secret@test.com'],
+                                         cc=['manager@test.com'],
+                                         headers={'Reply-To': 'help@test.com'})
+        message.attach_alternative('<p>Body</p>', 'text/html')
+        message.attach('invoice.txt', 'Invoice', 'text/plain')
+
+        QueuedMessage.from_message(message)
+        self.assertEqual(QueuedMessage.send_queued(), (1, 0))
+
+        sent = mail.outbox[0]
+        self.assert_(isinstance(sent, EmailMultiAlternatives))
+        self.assertEqual(sent.to, ['info@test.com'])
+        self.assertEqual(sent.cc, ['manager@test.com'])
+        self.assertEqual(sent.bcc, ['secret@test.com'])
+        self.assertEqual(sent.extra_headers, {'Reply-To': 'help@test.com'})
+        self.assertEqual(len(sent.alternatives), 1)
+        self.assertEqual(len(sent.attachments), 1)
+
+        self.assertFalse('secret@test.com' in sent.message()['To'])
+        self.assertFalse('secret@test.com' in sent.message().as_string())
+
+    def test_retry(self):
+        """ Failed messages should be retried later. """
+        queued = QueuedMessage.from_message(self.make_test_message())
+
+        sent, failed = QueuedMessage.send_queued(
+            connection=FailingEmailBackend())
+        self.assertEqual((sent, failed), (0, 1))
+
+        queued = QueuedMessage.objects.get(pk=queued.pk)
+        self.assertFalse(queued.sent)
+        self.assertEqual(queued.attempts, 1)
+        self.assert_(queued.next_attempt)
+        self.assert_(queued.last_error)
+
+        # Not due until the backoff has passed
+        self.assertEqual(QueuedMessage.send_queued(), (0, 0))
+
+        queued.next_attempt = None
+        queued.save()
+
+        self.assertEqual(QueuedMessage.send_queued(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
@@ -1,7 +1,15 @@
 from decimal import Decimal
 
+from django.core.exceptions import ValidationError
+
 from basic_webshop.tests.base import WebshopTestCase
-from basic_webshop.models import Order, OrderItem, OrderStateChange, Cart
+from basic_webshop.models import Order, OrderItem, OrderStateChange, Cart, \
+                                  OrderNumberSequence, InvoiceNumberSequence, \
+                                  ORDER_STATE_LISTENERS
+from basic_webshop.listeners import build_transition_table, \
+                                    OrderPaidConfirm, OrderPaidEmail, \
+                                    OrderShippedEmail
+from basic_webshop.order_states import *
 
 
 class OrderTest(WebshopTestCase):
@@ -123,6 +131,38 @@ class OrderTest(WebshopTestCase):
         self.assertEqual(c.get_items()[0].product, p2)
         self.assertEqual(c.get_items()[0].variation, None)
 
+    def test_cartprefetch(self):
+        """ Test loading cart items in a fixed number of queries. """
+        c = self.make_test_cart()
+        c.save()
+
+        for slug in ('p1', 'p2', 'p3'):
+            p = self.make_test_product(slug=slug)
+            p.save()
+
+            pt = self.make_test_producttranslation(p)
+            pt.name = slug
+            pt.save()
+
+            c.add_item(product=p)
+
+        c = Cart.objects.get(pk=c.pk)
+
+        # Items, product names and brand names
+        def load_items():
+            items = c.get_prefetched_items()
+            return [unicode(item.product) for item in items]
+
+        self.assertNumQueries(3, load_items)
+        self.assertEqual(len(c.get_prefetched_items()), 3)
+
+        # Adding an item clears the prefetched items
+        p = self.make_test_product(slug='p4')
+        p.save()
+        c.add_item(product=p)
+
+        self.assertEqual(len(c.get_prefetched_items()), 4)
+
     def test_cartprice(self):
         """ Test price calculation mechanics. """
 
@@ -294,13 +334,52 @@ class OrderTest(WebshopTestCase):
         self.assertIn(OrderStateChange.get_latest(o2),
                          OrderStateChange.objects.all())
 
-        new_state = 2
+        new_state = ORDER_STATE_PENDING
         o.state = new_state
         o.save()
 
         self.assertEqual(OrderStateChange.objects.count(), 3)
         self.assertEqual(OrderStateChange.get_latest(o).state, new_state)
 
+    def test_invalid_transition(self):
+        """
+        Test whether invalid state transitions are rejected by validation,
+        while saving them directly still works.
+        """
+        o = self.make_test_order()
+        o.save()
+
+        o.state = ORDER_STATE_SHIPPED
+        self.assertRaises(ValidationError, o.clean)
+
+        o.state = ORDER_STATE_CANCELED
+        o.clean()
+        o.save()
+
+        # Canceled orders are final
+        o = Order.objects.get(pk=o.pk)
+        o.state = ORDER_STATE_PENDING
+        self.assertRaises(ValidationError, o.clean)
+
+        # Corrections are saved regardless
+        o.save()
+
+        o = Order.objects.get(pk=o.pk)
+        self.assertEqual(o.state, ORDER_STATE_PENDING)
+        o.clean()
+
+    def test_transition_table(self):
+        """ Test mapping transitions to their listeners. """
+        table = build_transition_table(ORDER_STATE_LISTENERS)
+
+        self.assertEqual(table[(ORDER_STATE_PENDING, ORDER_STATE_PAID)],
+                         [OrderPaidConfirm, OrderPaidEmail])
+        self.assertEqual(table[(ORDER_STATE_PAID, ORDER_STATE_SHIPPED)],
+                         [OrderShippedEmail])
+        self.assertEqual(table[(ORDER_STATE_PROCESSED, ORDER_STATE_SHIPPED)],
+                         [OrderShippedEmail])
+        self.assertFalse((ORDER_STATE_NEW, ORDER_STATE_PENDING) in table)
+
     def test_order_number(self):
         """ Test whether a valid order number is generated. """
         # Create order
@@ -317,6 +396,24 @@ class OrderTest(WebshopTestCase):
         # Make sure an order number exists in the first place
         self.assert_(o2.order_number)
 
+        # Numbers should be consecutive within a day
+        self.assertEqual(int(o2.order_number[-3:]),
+                         int(o.order_number[-3:]) + 1)
+        self.assertEqual(o2.order_number[:11], o.order_number[:11])
+
+    def test_order_number_sequence(self):
+        """ Test the per-day order number sequence. """
+        self.assertEqual(OrderNumberSequence.next_value('20110101'), 1)
+        self.assertEqual(OrderNumberSequence.next_value('20110101'), 2)
+        self.assertEqual(OrderNumberSequence.next_value('20110102'), 1)
+
+        # The initial value is only used for new sequences
+        initial = lambda: 42
+        self.assertEqual(
+            OrderNumberSequence.next_value('20110103', initial=initial), 42)
+        self.assertEqual(
+            OrderNumberSequence.next_value('20110103', initial=initial), 43)
+
     def test_invoice_number(self):
         """ Test whether a valid invoice number is generated. """
 
@@ -338,5 +435,22 @@ class OrderTest(WebshopTestCase):
 
         o2.confirm()
 
-        self.assertEqual(o2.invoice_number,
+        self.assertEqual(int(o2.invoice_number),
                          int(o1.invoice_number) + 1)
+
+        # Invoice numbers start with the year of the order
+        year = str(o1.date_added.year)
+        self.assert_(o1.invoice_number.startswith(year))
+        self.assert_(o2.invoice_number.startswith(year))
+
+        # Invoice numbers continue after existing ones
+        o3.invoice_number = '%s9' % year
+        o3.save()
+
+        InvoiceNumberSequence.objects.all().delete()
+
+        o4 = self.make_test_order()
+        o4.save()
+        o4.confirm()
+
+        self.assertEqual(o4.invoice_number, '%s10' % year)
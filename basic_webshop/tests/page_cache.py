@@ -0,0 +1,86 @@
+from django.test.client import RequestFactory
+from django.views.generic import View
+from django.http import HttpResponse
+from django.core.cache import cache
+
+from basic_webshop.tests.base import WebshopTestCase
+from basic_webshop.page_cache import CachedPageMixin, get_catalog_version, \
+    bump_catalog_version, get_page_cache_stats, reset_page_cache_stats, \
+    CATALOG_VERSION_KEY
+
+
+class CountingView(CachedPageMixin, View):
+    """ View counting how often it has been rendered. """
+    renders = 0
+
+    def get(self, request):
+        CountingView.renders += 1
+        return HttpResponse('render %d' % CountingView.renders)
+
+
+class PageCacheTest(WebshopTestCase):
+    """ Test the catalog page cache. """
+
+    def setUp(self):
+        super(PageCacheTest, self).setUp()
+
+        CountingView.renders = 0
+        reset_page_cache_stats()
+
+        self.view = CountingView.as_view()
+        self.factory = RequestFactory()
+
+    def test_page_cache(self):
+        """ Pages should be cached until the catalog changes. """
+        request = self.factory.get('/brands/')
+
+        self.assertEqual(self.view(request).content, 'render 1')
+        self.assertEqual(self.view(request).content, 'render 1')
+
+        # Other URLs are cached separately
+        other_request = self.factory.get('/brands/?page=2')
+        self.assertEqual(self.view(other_request).content, 'render 2')
+
+        # Requests with sessions are not served from the cache
+        session_request = self.factory.get('/brands/')
+        session_request.COOKIES['sessionid'] = 'test'
+        self.assertEqual(self.view(session_request).content, 'render 3')
+
+        stats = get_page_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+        # Saving a brand bumps the catalog version
+        version = get_catalog_version()
+
+        brand = self.make_test_brand()
+        brand.save()
+
+        self.assert_(get_catalog_version() > version)
+        self.assertEqual(self.view(request).content, 'render 4')
+
+    def test_catalog_version_bump(self):
+        """ Bumping should change the version stored in the cache. """
+        version = get_catalog_version()
+        self.assertEqual(get_catalog_version(), version)
+
+        self.assertEqual(bump_catalog_version(), version + 1)
+        self.assertEqual(get_catalog_version(), version + 1)
+
+        # Versions which expired from the cache are not reused
+        cache.delete(CATALOG_VERSION_KEY)
+        self.assert_(get_catalog_version() > 1)
+
+    def test_m2m_bump(self):
+        """ Category changes of products bump the version once. """
+        c = self.make_test_category()
+        c.save()
+
+        p = self.make_test_product()
+        p.save()
+
+        version = get_catalog_version()
+        p.categories.add(c)
+        self.assertEqual(get_catalog_version(), version + 1)
+
+        p.categories.clear()
+        self.assertEqual(get_catalog_version(), version + 2)
@@ -0,0 +1,241 @@
+import threading
+
+from multiprocessing import TimeoutError
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
+
+from docdata.models import PaymentCluster
+from docdata.signals import payment_status_changed
+
+from basic_webshop.tests.base import WebshopTestCase
+from basic_webshop.models import Order, PaymentStatusEvent
+from basic_webshop.order_states import ORDER_STATE_PENDING, \
+                                       ORDER_STATE_FAILED
+from basic_webshop.payment import PaymentGatewayClient, create_payment_cluster
+
+
+class StubProviderHandler(BaseHTTPRequestHandler):
+    """ Stands in for the Docdata payment service. """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        params = parse_qs(urlparse(self.path).query)
+
+        with server.lock:
+            server.requests.append(params)
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+
+            # Drop the connection without responding
+            if server.drop:
+                server.drop -= 1
+                server.active -= 1
+                self.close_connection = 1
+                return
+
+        # Give concurrent calls the opportunity to overlap
+        server.delay.wait(0.05 + server.slow)
+
+        command = params['command'][0]
+        if command == 'new_payment_cluster':
+            body = '<?xml version="1.0"?><response><id value="1234" />' \
+                   '<key value="abcd" /></response>'
+        else:
+            body = 'YN'
+
+        with server.lock:
+            server.active -= 1
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubProviderServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubProviderHandler)
+
+        self.lock = threading.Lock()
+        self.delay = threading.Event()
+        self.requests = []
+        self.drop = 0
+        self.slow = 0
+        self.connections = 0
+        self.active = 0
+        self.max_active = 0
+
+    def get_request(self):
+        self.connections += 1
+        return HTTPServer.get_request(self)
+
+
+class PaymentTest(WebshopTestCase):
+    """
+    Test the payment gateway client against a stub provider, and the
+    handling of payment status changes.
+    """
+
+    def setUp(self):
+        super(PaymentTest, self).setUp()
+
+        self.server = StubProviderServer()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.url = 'http://127.0.0.1:%d/ps/PaymentService' % \
+            self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keepalive(self):
+        """ Subsequent calls should reuse a single connection. """
+        client = PaymentGatewayClient(url=self.url, pool_size=1)
+
+        for x in xrange(3):
+            result = client.status_payment_cluster(
+                merchant_name='test', merchant_password='test',
+                payment_cluster_key='abcd', report_type='txt_simple2')
+            self.assertEqual(result, {'paid': True, 'closed': False})
+
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.server.connections, 1)
+
+        client.pool.close()
+
+    def test_retry(self):
+        """
+        Calls failing after being sent on a reused connection should only be
+        retried when idempotent, so payment clusters are never duplicated.
+        """
+        client = PaymentGatewayClient(url=self.url, pool_size=1)
+
+        def status():
+            return client.status_payment_cluster(
+                merchant_name='test', merchant_password='test',
+                payment_cluster_key='abcd', report_type='txt_simple')
+
+        def new_cluster():
+            return client.new_payment_cluster(
+                merchant_name='test', merchant_password='test',
+                merchant_transaction_id='cos001', price='10.00')
+
+        self.assertTrue(status())
+
+        self.server.drop = 1
+        self.assertTrue(status())
+        self.assertEqual(len(self.server.requests), 3)
+
+        self.server.drop = 1
+        self.assertRaises(Exception, new_cluster)
+        self.assertEqual(len(self.server.requests), 4)
+
+        client.pool.close()
+
+    def test_concurrency(self):
+        """ The number of concurrent calls should be limited. """
+        client = PaymentGatewayClient(url=self.url, max_concurrency=2)
+
+        def call():
+            client.status_payment_cluster(
+                merchant_name='test', merchant_password='test',
+                payment_cluster_key='abcd', report_type='txt_simple')
+
+        threads = [threading.Thread(target=call) for x in xrange(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.server.requests), 6)
+        self.assertTrue(self.server.max_active <= 2)
+
+        client.pool.close()
+
+    def test_create_payment_cluster(self):
+        """ Create a payment cluster on the thread pool. """
+        client = PaymentGatewayClient(url=self.url)
+
+        payment = create_payment_cluster(client=client,
+                                         merchant_transaction_id='cos001',
+                                         price='10.00')
+
+        self.assertTrue(payment.pk)
+        self.assertEqual(payment.cluster_id, '1234')
+        self.assertEqual(payment.cluster_key, 'abcd')
+
+        params = self.server.requests[0]
+        self.assertEqual(params['command'], ['new_payment_cluster'])
+        self.assertEqual(params['merchant_transaction_id'], ['cos001'])
+
+        # The payment URL points at the configured provider
+        self.assertTrue(payment.payment_url().startswith(self.url))
+
+        client.pool.close()
+
+    def test_create_timeout(self):
+        """
+        A retry after a timeout should pick up the payment cluster of the
+        earlier call rather than creating another one.
+        """
+        client = PaymentGatewayClient(url=self.url)
+
+        self.server.slow = 0.5
+        self.assertRaises(TimeoutError, create_payment_cluster,
+                          client=client, timeout=0.01,
+                          merchant_transaction_id='cos002', price='10.00')
+
+        payment = create_payment_cluster(client=client, timeout=5,
+                                         merchant_transaction_id='cos002',
+                                         price='10.00')
+
+        self.assertTrue(payment.pk)
+        self.assertEqual(payment.cluster_key, 'abcd')
+        self.assertEqual(len(self.server.requests), 1)
+
+        client.pool.close()
+
+    def test_status_ledger(self):
+        """ Duplicate status changes should only be processed once. """
+        order = self.make_test_order()
+        order.state = ORDER_STATE_PENDING
+        order.save()
+
+        payment = PaymentCluster(transaction_id='test001',
+                                 cluster_key='abcd', cluster_id='1234')
+        payment.save()
+
+        order.payment_cluster = payment
+        order.save()
+
+        # Closed without being paid, reported twice
+        payment.paid = False
+        payment.closed = True
+        payment.save()
+
+        for x in xrange(2):
+            payment_status_changed.send(sender=payment)
+
+        self.assertEqual(PaymentStatusEvent.objects.count(), 1)
+
+        # Handling is left to the queue worker
+        order = Order.objects.get(pk=order.pk)
+        self.assertEqual(order.state, ORDER_STATE_PENDING)
+
+        self.assertEqual(PaymentStatusEvent.process_queued(), (1, 0))
+        self.assertEqual(PaymentStatusEvent.process_queued(), (0, 0))
+
+        order = Order.objects.get(pk=order.pk)
+        self.assertEqual(order.state, ORDER_STATE_FAILED)
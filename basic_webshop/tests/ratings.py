@@ -0,0 +1,63 @@
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+
+from basic_webshop.tests.base import WebshopTestCase
+from basic_webshop.models import Product, ProductRating, ProductRatingStats
+
+
+class RatingTest(WebshopTestCase):
+    """ Test denormalized product rating statistics. """
+
+    def make_test_rating(self, product, rating, language='en'):
+        user = User.objects.create(username='user%d' % User.objects.count())
+
+        r = ProductRating(product=product, user=user, rating=rating,
+                          language=language, description='Tasty')
+        r.save()
+
+        return r
+
+    def test_rating_stats(self):
+        """ Statistics should follow ratings being saved and deleted. """
+        p = self.make_test_product()
+        p.save()
+
+        self.assertEqual(ProductRatingStats.get_for(p, 'en').count, 0)
+
+        self.make_test_rating(p, 5)
+        r = self.make_test_rating(p, 4)
+        self.make_test_rating(p, 1, language='nl')
+
+        stats = ProductRatingStats.get_for(p, 'en')
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(stats.total, 9)
+        self.assertEqual(stats.average, Decimal('4.50'))
+        self.assertEqual(stats.get_histogram(),
+                         [(0, 0), (1, 0), (2, 0), (3, 0), (4, 1), (5, 1)])
+
+        r.delete()
+
+        stats = ProductRatingStats.get_for(p, 'en')
+        self.assertEqual(stats.count, 1)
+        self.assertEqual(stats.average, Decimal('5.00'))
+
+        self.assertEqual(ProductRatingStats.get_for(p, 'nl').average,
+                         Decimal('1.00'))
+
+    def test_annotate_rating(self):
+        """ Products should be annotated with their rating statistics. """
+        p1 = self.make_test_product(slug='p1')
+        p1.save()
+
+        p2 = self.make_test_product(slug='p2')
+        p2.save()
+
+        self.make_test_rating(p1, 3)
+
+        products = Product.objects.filter(pk__in=(p1.pk, p2.pk))
+        products = Product.annotate_rating(products, 'en').order_by('pk')
+
+        self.assertEqual([(p.rating_count, p.rating_average) \
+                          for p in products],
+                         [(1, Decimal('3.00')), (0, None)])
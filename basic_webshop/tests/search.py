@@ -0,0 +1,100 @@
+from basic_webshop.tests.base import WebshopTestCase
+from basic_webshop.models import Category, CategoryTranslation, \
+    BrandTranslation, Product
+from basic_webshop.search import tokenize, IndexSearchBackend, SearchResults
+
+
+class SearchTest(WebshopTestCase):
+    """ Test the product search index. """
+
+    def test_tokenize(self):
+        """ Tokens should be lowercase and accent-folded. """
+        self.assertEqual(tokenize(u'Cr\xe8me Br\xfbl\xe9e, 2x!'),
+                         [u'creme', u'brulee', u'2x'])
+
+    def test_search(self):
+        """ Test prefix matching and ranking of search results. """
+        backend = IndexSearchBackend()
+
+        c = Category(slug='fruit')
+        c.save()
+
+        ct = CategoryTranslation(parent=c, name='Fruit', language_code='en')
+        ct.save()
+
+        p1 = self.make_test_product()
+        p1.save()
+        p1.categories.add(c)
+
+        pt1 = self.make_test_producttranslation(p1)
+        pt1.save()
+
+        p2 = self.make_test_product(slug='cheese')
+        p2.save()
+
+        pt2 = self.make_test_producttranslation(p2)
+        pt2.name = 'Cheese'
+        pt2.description = 'Goes well with a banana.'
+        pt2.save()
+
+        bt = BrandTranslation(parent=p1.brand, name=u'Ch\xe2teau',
+                              language_code='en')
+        bt.save()
+
+        # Name matches rank higher than description matches
+        self.assertEqual(backend.search('banana', 'en'), [p1.pk, p2.pk])
+        self.assertEqual(backend.search('BAN', 'en'), [p1.pk, p2.pk])
+
+        # All terms should match
+        self.assertEqual(backend.search('banana fruit', 'en'), [p1.pk])
+        self.assertEqual(backend.search('cheese chateau', 'en'), [p2.pk])
+
+        # Languages are indexed separately
+        self.assertEqual(backend.search('banana', 'nl'), [])
+
+    def test_index_updated(self):
+        """ The index should follow category and translation changes. """
+        backend = IndexSearchBackend()
+
+        c = Category(slug='fruit')
+        c.save()
+
+        ct = CategoryTranslation(parent=c, name='Fruit', language_code='en')
+        ct.save()
+
+        p = self.make_test_product()
+        p.save()
+
+        pt = self.make_test_producttranslation(p)
+        pt.save()
+
+        self.assertEqual(backend.search('fruit', 'en'), [])
+
+        p.categories.add(c)
+        self.assertEqual(backend.search('fruit', 'en'), [p.pk])
+
+        c.product_set.clear()
+        self.assertEqual(backend.search('fruit', 'en'), [])
+
+        pt.delete()
+        self.assertEqual(backend.search('banana', 'en'), [])
+
+    def test_search_results(self):
+        """ Results should only fetch the products for a slice. """
+        products = []
+        for x in xrange(5):
+            p = self.make_test_product(slug='product-%d' % x)
+            p.active = x != 2
+            p.save()
+
+            products.append(p)
+
+        product_ids = [p.pk for p in reversed(products)]
+        results = SearchResults(Product.objects.filter(active=True),
+                                product_ids, batch_size=2)
+
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[1:3], [products[3], products[1]])
+        self.assertEqual(results[0], products[4])
+        self.assertEqual(list(results), [products[4], products[3],
+                                         products[1], products[0]])
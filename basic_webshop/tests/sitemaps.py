@@ -0,0 +1,57 @@
+import gzip
+import os
+import shutil
+import tempfile
+
+from basic_webshop.tests.base import WebshopTestCase
+from basic_webshop.models import Product
+from basic_webshop.sitemaps import SitemapWriter, ProductSitemap, \
+                                   CategorySitemap
+
+
+class SitemapTest(WebshopTestCase):
+    """ Test streaming, sharded sitemaps. """
+
+    def setUp(self):
+        super(SitemapTest, self).setUp()
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sitemaps(self):
+        """ Write sitemaps in shards with an index. """
+        c = self.make_test_category()
+        c.active = True
+        c.save()
+
+        for slug in ('p1', 'p2', 'p3'):
+            p = self.make_test_product(slug=slug)
+            p.active = True
+            p.save()
+
+        # Locations match those of the objects
+        sitemap = ProductSitemap()
+        self.assertEqual([sitemap.location(item) for item in sitemap.items()],
+                         [p.get_absolute_url() for p in \
+                          Product.in_shop.order_by('pk')])
+
+        sitemap = CategorySitemap()
+        self.assertEqual([sitemap.location(node) for node in sitemap.items()],
+                         [c.get_absolute_url()])
+
+        writer = SitemapWriter(self.directory, 'http://example.com/',
+                               shard_size=2)
+        filenames = writer.write({'products': ProductSitemap})
+
+        self.assertEqual(filenames, ['sitemap-products-1.xml.gz',
+                                     'sitemap-products-2.xml.gz'])
+
+        shard = gzip.open(os.path.join(self.directory, filenames[1])).read()
+        self.assertEqual(shard.count('<url>'), 1)
+        self.assertTrue('<loc>http://example.com/' in shard)
+
+        index = open(os.path.join(self.directory, 'sitemap.xml')).read()
+        self.assertTrue(
+            '<loc>http://example.com/sitemap-products-2.xml.gz</loc>' in index)
@@ -214,3 +214,33 @@ class StockTest(WebshopTestCase):
         # Now check whether the discount has not been applied
         discount = Discount.objects.get(pk=discount.pk)
         self.assertEqual(discount.used, 1)
+
+    def test_availability(self):
+        """
+        Test bulk availability for products with and without variations.
+        """
+        p1 = self.make_test_product(slug='p1', stock=0)
+        p1.save()
+
+        p2 = self.make_test_product(slug='p2', stock=2)
+        p2.save()
+
+        p3 = self.make_test_product(slug='p3', stock=0)
+        p3.save()
+
+        v = self.make_test_productvariation(p3, stock=3)
+        v.save()
+
+        product_ids = (p1.pk, p2.pk, p3.pk)
+
+        availability = Product.get_availability(product_ids)
+        self.assertEqual(availability, {p1.pk: False, p2.pk: True, p3.pk: True})
+
+        availability = Product.get_availability(product_ids, quantity=3)
+        self.assertEqual(availability, {p1.pk: False, p2.pk: False, p3.pk: True})
+
+        # Annotated products should give the same result as plain products
+        products = Product.objects.filter(pk__in=product_ids)
+        for product in Product.annotate_stock(products):
+            self.assertEqual(product.is_available(2),
+                             Product.objects.get(pk=product.pk).is_available(2))
@@ -0,0 +1,55 @@
+from basic_webshop.tests.base import WebshopTestCase
+from basic_webshop.models import BrandImage, ThumbnailJob
+from basic_webshop.thumbnails import THUMBNAIL_SIZES
+
+
+class ThumbnailTest(WebshopTestCase):
+    """ Test queueing and rendering of thumbnails. """
+
+    def test_enqueue(self):
+        """ Saving an image should queue all configured sizes once. """
+        b = self.make_test_brand()
+        b.save()
+
+        # No logo, nothing to queue
+        self.assertEqual(ThumbnailJob.objects.count(), 0)
+
+        i = BrandImage(brand=b, image='brand_images/missing.jpg')
+        i.save()
+        i.save()
+
+        sizes = THUMBNAIL_SIZES['basic_webshop.brandimage.image']
+        jobs = ThumbnailJob.objects.filter(image='brand_images/missing.jpg')
+        self.assertEqual(jobs.count(), len(sizes))
+
+        # Missing images fail, and are retried
+        self.assertEqual(ThumbnailJob.render_queued(), (0, len(sizes)))
+
+        job = jobs[0]
+        self.assertEqual(job.attempts, 1)
+        self.assertTrue(job.last_error)
+
+    def test_exclude_failed(self):
+        """ Failed jobs are skipped in later batches of the same run. """
+        b = self.make_test_brand()
+        b.save()
+
+        for name in ('missing1.jpg', 'missing2.jpg'):
+            i = BrandImage(brand=b, image='brand_images/%s' % name)
+            i.save()
+
+        total = ThumbnailJob.objects.count()
+
+        failed_jobs = set()
+        for tried in range(1, total + 1):
+            self.assertEqual(ThumbnailJob.render_queued(batch_size=1,
+                                                        exclude=failed_jobs),
+                             (0, 1))
+            self.assertEqual(len(failed_jobs), tried)
+
+        # All jobs have been tried once
+        self.assertEqual(ThumbnailJob.render_queued(exclude=failed_jobs),
+                         (0, 0))
+        self.assertEqual(
+            set(ThumbnailJob.objects.values_list('attempts', flat=True)),
+            set([1]))
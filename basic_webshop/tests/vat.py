@@ -0,0 +1,83 @@
+from decimal import Decimal
+
+from basic_webshop.tests.base import WebshopTestCase
+from basic_webshop.models import Order, OrderItem
+from basic_webshop.vat import get_vat_rate, calculate_vat, allocate
+from basic_webshop.templatetags.vat_tags import vat_amount, \
+                                                vat_inclusive, vat_exclusive
+
+
+class VatTest(WebshopTestCase):
+    """ Test the VAT calculation and stored VAT amounts. """
+
+    def test_allocate(self):
+        """ Allocated parts add up to the amount. """
+        shares = allocate(Decimal('1.00'), [Decimal('1')] * 3)
+        self.assertEqual(shares, [Decimal('0.34'), Decimal('0.33'),
+                                  Decimal('0.33')])
+
+        self.assertEqual(allocate(Decimal('1.00'), [Decimal('0')] * 2),
+                         [Decimal('0.00')] * 2)
+
+    def test_filters(self):
+        """ Display filters calculate with decimals. """
+        rate = get_vat_rate()
+
+        self.assertEqual(vat_amount('10.00'),
+                         calculate_vat(Decimal('10.00'), rate))
+        self.assertEqual(vat_inclusive(Decimal('10.00')),
+                         Decimal('10.00') + vat_amount('10.00'))
+        self.assertEqual(vat_exclusive(vat_inclusive(Decimal('10.00'))),
+                         Decimal('10.00'))
+
+    def test_order_vat(self):
+        """ VAT is stored per item and order for mixed rates. """
+        discount = self.make_test_discount()
+        discount.order_amount = Decimal('2.00')
+        discount.save()
+
+        p1 = self.make_test_product(slug='p1')
+        p1.vat_class = 'high'
+        p1.save()
+
+        p2 = self.make_test_product(slug='p2')
+        p2.vat_class = 'low'
+        p2.save()
+
+        i1 = self.make_test_orderitem(quantity=3, product=p1,
+                                      piece_price=Decimal('3.33'))
+        i1.save()
+
+        i2 = self.make_test_orderitem(quantity=1, product=p2,
+                                      piece_price=Decimal('10.00'),
+                                      order=i1.order)
+        i2.save()
+
+        totals = i1.order.update()
+
+        high, low = get_vat_rate('high'), get_vat_rate('low')
+
+        i1 = OrderItem.objects.get(pk=i1.pk)
+        self.assertEqual(i1.vat_rate, high)
+        self.assertEqual(i1.net_price, Decimal('9.99'))
+        self.assertEqual(i1.vat_amount, calculate_vat(Decimal('9.99'), high))
+        self.assertEqual(i1.gross_price, i1.net_price + i1.vat_amount)
+
+        i2 = OrderItem.objects.get(pk=i2.pk)
+        self.assertEqual(i2.vat_amount, calculate_vat(Decimal('10.00'), low))
+
+        # The order discount is divided over the rates
+        shares = allocate(Decimal('2.00'),
+                          [Decimal('9.99'), Decimal('10.00')])
+        discount_vat = calculate_vat(shares[0], high) + \
+                       calculate_vat(shares[1], low)
+
+        o = Order.objects.get(pk=i1.order_id)
+        self.assertEqual(o.vat_amount, i1.vat_amount + i2.vat_amount - \
+                         discount_vat + totals.shipping_vat)
+        self.assertEqual(o.gross_price, o.net_price + o.vat_amount)
+
+        breakdown = list(o.get_vat_breakdown())
+        self.assertEqual(len(breakdown), 2)
+        self.assertEqual(sum(row['total_vat'] for row in breakdown),
+                         i1.vat_amount + i2.vat_amount)
@@ -0,0 +1,133 @@
+"""
+Thumbnail pre-generation.
+
+Whenever an image is saved, jobs for all configured thumbnail sizes of that
+image are queued as `ThumbnailJob` objects. The `generate_thumbnails`
+management command renders them in a pool of worker processes, so
+requests find thumbnails in sorl's key value store rather than resizing
+images inline.
+
+Sizes are configured per model and field in `SHOPKIT_THUMBNAIL_SIZES` as
+sequences of (geometry, options) tuples, matching the arguments used in
+templates and admin widgets.
+
+Code building cached structures can use `get_cached_thumbnail` to find
+rendered thumbnails without rendering missing ones inline.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+from django.conf import settings
+from django.utils import simplejson
+
+from simplesite.settings import PAGEIMAGE_SIZE
+
+
+# Size used by sorl's `AdminImageWidget`
+ADMIN_THUMBNAIL_SIZE = ('80x80', {'upscale': False})
+
+# Size of brand logos in the brand directory
+BRAND_LOGO_SIZE = getattr(settings, 'SHOPKIT_BRAND_LOGO_SIZE',
+                          ('100x50', {'upscale': False}))
+
+# Size of category highlight images, see `Category.highlight_html`
+CATEGORY_HIGHLIGHT_SIZE = getattr(settings, 'SHOPKIT_CATEGORY_HIGHLIGHT_SIZE',
+                                  ('600x300', {'upscale': False}))
+
+THUMBNAIL_SIZES = getattr(settings, 'SHOPKIT_THUMBNAIL_SIZES', {
+    'basic_webshop.productimage.image': (
+        ('120x120', {}), ('200x100', {}), ADMIN_THUMBNAIL_SIZE),
+    'basic_webshop.brandimage.image': (
+        (PAGEIMAGE_SIZE, {}), ADMIN_THUMBNAIL_SIZE),
+    'basic_webshop.brand.logo': (BRAND_LOGO_SIZE, ADMIN_THUMBNAIL_SIZE),
+    'basic_webshop.category.highlight_image': (
+        CATEGORY_HIGHLIGHT_SIZE, ADMIN_THUMBNAIL_SIZE),
+})
+
+THUMBNAIL_PROCESSES = getattr(settings, 'SHOPKIT_THUMBNAIL_PROCESSES', 2)
+
+
+def get_image_sizes(instance):
+    """
+    Return a list of (image name, geometry, options) tuples for all
+    configured sizes of the images of a model instance.
+    """
+    opts = instance._meta
+
+    sizes = []
+    for field in opts.fields:
+        key = '%s.%s.%s' % (opts.app_label, opts.object_name.lower(),
+                            field.name)
+
+        field_sizes = THUMBNAIL_SIZES.get(key)
+        if not field_sizes:
+            continue
+
+        image = getattr(instance, field.name)
+        if not image:
+            continue
+
+        for geometry, options in field_sizes:
+            sizes.append((image.name, geometry, options))
+
+    return sizes
+
+
+def encode_options(options):
+    """ Serialize thumbnail options in a stable way. """
+    return simplejson.dumps(options, sort_keys=True)
+
+
+def render_thumbnail(job):
+    """
+    Render a single thumbnail, given an (image name, geometry, options)
+    tuple. Returns `None` on success and an error message otherwise, so it
+    can be safely mapped over in a process pool.
+    """
+    from django.core.files.storage import default_storage
+    from sorl.thumbnail import get_thumbnail
+
+    name, geometry, options = job
+
+    try:
+        # sorl silently returns a dummy image for missing files
+        if not default_storage.exists(name):
+            return u'Image %s does not exist' % name
+
+        get_thumbnail(name, geometry, **dict((str(key), value) \
+            for key, value in simplejson.loads(options).iteritems()))
+
+    except Exception as e:
+        return unicode(e)
+
+    return None
+
+
+def get_cached_thumbnail(name, geometry, options):
+    """
+    Return the thumbnail of an image from sorl's key value store, or `None`
+    when it has not been rendered yet. Unlike `get_thumbnail` this never
+    renders the thumbnail, so it does not read the source image.
+    """
+    from sorl.thumbnail import default
+    from sorl.thumbnail.images import ImageFile
+
+    backend = default.backend
+
+    options = dict(options)
+    for key, value in backend.default_options.iteritems():
+        options.setdefault(key, value)
+
+    try:
+        source = ImageFile(name)
+        thumbnail = ImageFile(
+            backend._get_thumbnail_filename(source, geometry, options),
+            default.storage)
+
+        return default.kvstore.get(thumbnail)
+
+    except Exception:
+        logger.exception(u'Could not look up thumbnail for %s', name)
+
+    return None
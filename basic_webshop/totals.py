@@ -0,0 +1,259 @@
+"""
+Single-pass totals engine for orders.
+
+`OrderTotals` loads the order items, the applicable discounts (from the
+discount eligibility index) and the candidate shipping methods once,
+calculates the subtotal, item and order discounts, order and item shipping
+costs and VAT in memory and writes the results back with a minimal number of update
+queries.
+
+VAT is calculated per order item at the rate of its product's VAT class and
+stored with the net and gross amounts on the items and the order. The order
+discount lowers the VAT of each rate in proportion to the net amounts at
+that rate, and shipping is charged at the rate of `SHOPKIT_SHIPPING_VAT_CLASS`.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+from basic_webshop.discount_index import get_discount_index, \
+                                         get_product_categories, \
+                                         filter_available
+from basic_webshop.vat import SHIPPING_VAT_CLASS, ZERO, quantize, \
+                              get_vat_rate, calculate_vat, allocate
+
+
+class OrderTotals(object):
+    """ Calculates and stores the totals for an order in a single pass. """
+
+    def __init__(self, order):
+        self.order = order
+
+    def load(self):
+        """ Load items, discounts and shipping methods. """
+        from basic_webshop.models import Discount, ShippingMethod, Product
+
+        order = self.order
+
+        self.items = list(order.orderitem_set.all())
+
+        self.vat_classes = dict(Product.objects.filter(
+            pk__in=set(item.product_id for item in self.items)).values_list(
+            'pk', 'vat_class'))
+
+        # Valid discounts from the eligibility index, with use limits
+        # checked in the query fetching them
+        self.index = get_discount_index()
+        self.product_categories = get_product_categories(
+            set(item.product_id for item in self.items))
+
+        discount_ids = self.index.get_valid_ids(
+            coupon_code=order.coupon_code, products=self.product_categories)
+
+        if discount_ids:
+            self.discounts = list(filter_available(
+                Discount.objects.filter(pk__in=discount_ids)))
+        else:
+            self.discounts = []
+
+        # Shipping methods valid for the shipping country
+        if order.shipping_address_id:
+            country = order.shipping_address.country_id
+        else:
+            country = None
+
+        self.shipping_methods = list(ShippingMethod.get_valid_methods(
+            order_methods=True, country=country))
+
+    def applies_to(self, discount, product_id):
+        """
+        Whether a discount applies to a product, based on the product and
+        category restrictions of the discount.
+        """
+        entry = self.index.get_entry(discount.pk)
+
+        return entry.applies_to(product_id,
+                                self.product_categories.get(product_id, set()))
+
+    def get_item_discount(self, item):
+        """ Total discount for an order item. """
+        price = item.piece_price * item.quantity
+        discount = ZERO
+
+        for item_discount in self.item_discounts:
+            if not self.applies_to(item_discount, item.product_id):
+                continue
+
+            if item_discount.item_amount:
+                discount += item_discount.item_amount * item.quantity
+
+            if item_discount.item_percentage:
+                discount += price * item_discount.item_percentage / 100
+
+        return quantize(min(discount, price))
+
+    def calculate(self):
+        """ Calculate all totals in a single pass over the items. """
+        self.item_discounts = [discount for discount in self.discounts \
+            if discount.item_amount or discount.item_percentage]
+        order_discounts = [discount for discount in self.discounts \
+            if discount.order_amount or discount.order_percentage]
+
+        applied_discounts = set()
+
+        self.subtotal = ZERO
+        self.item_discount_total = ZERO
+        self.item_discount_amounts = {}
+
+        product_ids = set()
+        for item in self.items:
+            product_ids.add(item.product_id)
+
+            discount = self.get_item_discount(item)
+            self.item_discount_amounts[item.pk] = discount
+
+            self.subtotal += item.piece_price * item.quantity
+            self.item_discount_total += discount
+
+        for discount in self.item_discounts:
+            for product_id in product_ids:
+                if self.applies_to(discount, product_id):
+                    applied_discounts.add(discount)
+                    break
+
+        # Order discounts apply to the price after item discounts
+        remaining = self.subtotal - self.item_discount_total
+        self.order_discount = ZERO
+
+        for discount in order_discounts:
+            for product_id in product_ids:
+                if self.applies_to(discount, product_id):
+                    break
+            else:
+                continue
+
+            if discount.order_amount:
+                self.order_discount += discount.order_amount
+
+            if discount.order_percentage:
+                self.order_discount += \
+                    remaining * discount.order_percentage / 100
+
+            applied_discounts.add(discount)
+
+        self.order_discount = quantize(min(self.order_discount, remaining))
+        self.applied_discounts = list(applied_discounts)
+
+        self.price_without_shipping = remaining - self.order_discount
+
+        # Cheapest shipping method valid for this order price
+        self.shipping_method = None
+        self.shipping_costs = ZERO
+
+        for method in self.shipping_methods:
+            minimal_price = method.minimal_order_price
+            if minimal_price and self.price_without_shipping < minimal_price:
+                continue
+
+            cost = method.get_cost()
+            if not self.shipping_method or cost < self.shipping_costs:
+                self.shipping_method = method
+                self.shipping_costs = cost
+
+        # Per-item shipping costs are calculated by shopkit, on the items
+        # loaded above
+        self.item_shipping_costs = sum(
+            [item.get_shipping_costs() for item in self.items], ZERO)
+
+        self.price = self.price_without_shipping + self.shipping_costs + \
+                     self.item_shipping_costs
+
+        self.calculate_vat()
+
+        logger.debug(u'Calculated totals for %s: subtotal %s, discounts %s, '
+                     u'shipping %s, VAT %s', self.order, self.subtotal,
+                     self.item_discount_total + self.order_discount,
+                     self.shipping_costs + self.item_shipping_costs, self.vat)
+
+    def calculate_vat(self):
+        """ Calculate net, VAT and gross amounts per item and in total. """
+        self.item_amounts = {}
+
+        net_per_rate = {}
+        items_vat = ZERO
+        for item in self.items:
+            rate = get_vat_rate(self.vat_classes.get(item.product_id))
+            net = item.piece_price * item.quantity - \
+                  self.item_discount_amounts[item.pk]
+            vat = calculate_vat(net, rate)
+
+            self.item_amounts[item.pk] = {
+                'vat_rate': rate,
+                'net_price': net,
+                'vat_amount': vat,
+                'gross_price': net + vat,
+            }
+
+            net_per_rate[rate] = net_per_rate.get(rate, ZERO) + net
+            items_vat += vat
+
+        rates = sorted(net_per_rate)
+        discount_shares = allocate(self.order_discount,
+                                   [net_per_rate[rate] for rate in rates])
+        self.order_discount_vat = sum(
+            [calculate_vat(share, rate) \
+             for rate, share in zip(rates, discount_shares)], ZERO)
+
+        self.shipping_vat = calculate_vat(
+            self.shipping_costs + self.item_shipping_costs,
+            get_vat_rate(SHIPPING_VAT_CLASS))
+
+        self.vat = items_vat - self.order_discount_vat + self.shipping_vat
+        self.gross_price = self.price + self.vat
+
+    def save(self):
+        """ Write the calculated totals back to the order and its items. """
+        from basic_webshop.models import Order, OrderItem
+
+        order = self.order
+
+        # Group changed items by their values, for as few queries as
+        # possible
+        changed = {}
+        for item in self.items:
+            values = self.item_amounts[item.pk].copy()
+            values['discount'] = self.item_discount_amounts[item.pk]
+
+            if [key for key, value in values.iteritems() \
+                    if getattr(item, key) != value]:
+                changed.setdefault(tuple(sorted(values.items())),
+                                   []).append(item.pk)
+
+                for key, value in values.iteritems():
+                    setattr(item, key, value)
+
+        for values, item_ids in changed.iteritems():
+            OrderItem.objects.filter(pk__in=item_ids).update(**dict(values))
+
+        order.order_discount = self.order_discount
+        order.order_shipping_costs = self.shipping_costs
+        order.shipping_method = self.shipping_method
+        order.net_price = self.price
+        order.vat_amount = self.vat
+        order.gross_price = self.gross_price
+
+        Order.objects.filter(pk=order.pk).update(
+            order_discount=self.order_discount,
+            order_shipping_costs=self.shipping_costs,
+            shipping_method=self.shipping_method,
+            net_price=self.price,
+            vat_amount=self.vat,
+            gross_price=self.gross_price)
+
+        order.discounts = self.applied_discounts
+
+    def update(self):
+        """ Load, calculate and save the totals for the order. """
+        self.load()
+        self.calculate()
+        self.save()
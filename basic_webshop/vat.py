@@ -0,0 +1,77 @@
+"""
+VAT rates per product class and exact Decimal VAT calculation.
+
+Prices in the shop exclude VAT. Rates are configured per VAT class in
+`SHOPKIT_VAT_CLASSES`, as (class, label, percentage) tuples, and products
+refer to a class by their `vat_class` field. `OrderTotals` calculates the
+VAT once and stores net, VAT and gross amounts on order items and orders,
+so these can be summed in SQL rather than recalculated for display.
+"""
+
+from decimal import Decimal, ROUND_HALF_UP, ROUND_DOWN
+
+from django.conf import settings
+from django.utils.translation import ugettext_lazy as _
+
+
+VAT_PERCENTAGE = getattr(settings, 'SHOPKIT_VAT_PERCENTAGE', 19)
+
+VAT_CLASSES = getattr(settings, 'SHOPKIT_VAT_CLASSES', (
+    ('high', _('high rate'), VAT_PERCENTAGE),
+    ('low', _('low rate'), 6),
+    ('zero', _('exempt'), 0),
+))
+
+DEFAULT_VAT_CLASS = getattr(settings, 'SHOPKIT_DEFAULT_VAT_CLASS',
+                            VAT_CLASSES[0][0])
+
+SHIPPING_VAT_CLASS = getattr(settings, 'SHOPKIT_SHIPPING_VAT_CLASS',
+                             DEFAULT_VAT_CLASS)
+
+VAT_CLASS_CHOICES = [(vat_class, label) \
+                     for vat_class, label, rate in VAT_CLASSES]
+
+VAT_RATES = dict((vat_class, Decimal(str(rate))) \
+                 for vat_class, label, rate in VAT_CLASSES)
+
+ZERO = Decimal('0.00')
+CENTS = Decimal('0.01')
+
+
+def quantize(amount):
+    """ Round an amount to cents. """
+    return Decimal(amount).quantize(CENTS, rounding=ROUND_HALF_UP)
+
+
+def get_vat_rate(vat_class=None):
+    """ VAT percentage for a class, or for the default class. """
+    return VAT_RATES.get(vat_class, VAT_RATES[DEFAULT_VAT_CLASS])
+
+
+def calculate_vat(net, rate):
+    """ VAT for a net amount at a percentage, rounded to cents. """
+    return quantize(net * rate / 100)
+
+
+def allocate(amount, weights):
+    """
+    Divide an amount in cents proportionally to weights, handing out the
+    cents lost to rounding by largest remainder, so the parts add up to the
+    amount exactly.
+    """
+    total = sum(weights, ZERO)
+    if not total:
+        return [ZERO for weight in weights]
+
+    exact = [amount * weight / total for weight in weights]
+    shares = [share.quantize(CENTS, rounding=ROUND_DOWN) for share in exact]
+
+    remainder = int((amount - sum(shares, ZERO)) / CENTS)
+    by_remainder = sorted(xrange(len(exact)),
+                          key=lambda index: exact[index] - shares[index],
+                          reverse=True)
+
+    for index in by_remainder[:remainder]:
+        shares[index] += CENTS
+
+    return shares
@@ -1,11 +1,12 @@
 import logging
 logger = logging.getLogger('basic_webshop')
 
+from multiprocessing import TimeoutError
+
 from django.shortcuts import get_object_or_404
 
 from django.db import models
 from django.http import Http404, HttpResponseRedirect
-from django.db.models import Q
 
 from django.core.urlresolvers import reverse
 
@@ -25,63 +26,56 @@ from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
 
 from basic_webshop.models import \
-    Product, Category, Cart, CartItem, Brand, ProductRating, Order, Address
-
-from docdata.models import PaymentCluster
+    Product, Category, Cart, CartItem, Brand, ProductRating, Order, Address, \
+    ProductListing, ProductRatingStats
 
 from shopkit.core.views import InShopViewMixin
 
+from docdata.models import PaymentCluster
+
 from basic_webshop.forms import \
     RatingForm, CartAddForm, AddressUpdateForm, CartDiscountCouponForm, \
     CartItemForm, EmailForm
 
 from basic_webshop.order_states import *
 
+from basic_webshop.search import get_search_backend, SearchResults
+from basic_webshop.category_tree import get_category_tree
+from basic_webshop.brand_directory import get_brand_directory
+from basic_webshop.page_cache import CachedPageMixin
+from basic_webshop.payment import create_payment_cluster
+
 
 class BrandView(object):
     model = Brand
 
-    def get_brands_alphabetized(self, brands):
-        """ Return alphabetized version of brand list. """
+    def get_brands_alphabetized(self):
+        """ Return the cached brand directory for the current language. """
+        return get_brand_directory()
 
-        language_code = get_language()
-        brands = brands.filter(translations__language_code=\
-                                   language_code)
-        brands = brands.order_by('translations__name')
 
-        return brands
-
-
-
-class BrandList(BrandView, ListView):
+class BrandList(CachedPageMixin, BrandView, ListView):
     """ List of brands. """
     def get_context_data(self, **kwargs):
         context = super(BrandView, self).get_context_data(**kwargs)
 
-        # Order by translated name
-        brands = context['brand_list']
-
-        brands_alphabetical = self.get_brands_alphabetized(brands)
-
         context.update({
-            'brands_alphabetical': brands
+            'brands_alphabetical': self.get_brands_alphabetized()
         })
 
         return context
 
-class BrandDetail(BrandView, DetailView):
+class BrandDetail(CachedPageMixin, BrandView, DetailView):
     """ Detail view for brand. """
     def get_context_data(self, object, **kwargs):
         context = super(BrandDetail, self).get_context_data(**kwargs)
 
         brand = object
-        products = brand.product_set.all()
-
-        brands = self.get_queryset()
-        brands_alphabetical = self.get_brands_alphabetized(brands)
+        products = Product.annotate_stock(brand.product_set.all())
+        products = Product.annotate_rating(products)
 
         context.update({
-            'brands_alphabetical': brands,
+            'brands_alphabetical': self.get_brands_alphabetized(),
             'products': products,
         })
 
@@ -93,7 +87,7 @@ class BrandProducts(BrandDetail):
     template_name='basic_webshop/brand_products.html'
 
 
-class CategoryDetail(DetailView):
+class CategoryDetail(CachedPageMixin, DetailView):
     """ View with all products in category x, a list of subcategories, category
     picks, new arrivals, sale. Filtering by brand. Ordering by name, brand and
     price. """
@@ -103,13 +97,15 @@ class CategoryDetail(DetailView):
     def get_context_data(self, object, **kwargs):
         context = super(CategoryDetail, self).get_context_data(**kwargs)
 
-        products = object.get_products()
+        # Listings contain all the product data required for rendering
+        products = ProductListing.get_for_category(object)
 
         # Only get brands that are available in the current category
-        brands = Brand.objects.filter(product__in=products).distinct()
+        brands = Brand.objects.filter(pk__in=products.values('brand'))
 
-        subcategories = object.get_subcategories()
-        ancestors = object.get_ancestors(include_self=True)
+        # Navigation is rendered from the cached category tree
+        subcategories = self.category_node.get_subcategories()
+        ancestors = self.category_node.get_ancestors(include_self=True)
 
         context.update({
             'products': products,
@@ -120,23 +116,23 @@ class CategoryDetail(DetailView):
 
         return context
 
-    def get_object(self):
-        model = self.model()
-        main_categories = model.get_main_categories()
-
-        # Filter by category slug
-        category_slug = self.kwargs.get('category_slug')
-        category = get_object_or_404(main_categories, slug=category_slug)
-
-        return category
+    def get_category_slugs(self):
+        """ Slugs identifying the category, starting at the main category. """
+        return (self.kwargs.get('category_slug'), )
 
-    def render_to_response(self, context):
-        resp = super(CategoryDetail, self).render_to_response(context)
+    def get_object(self):
+        """
+        Look up the category in the cached category tree by its slugs and
+        return the matching category.
+        """
+        tree = get_category_tree()
+        self.category_node = tree.get_by_slugs(*self.get_category_slugs())
 
-        resp.set_cookie('category_pk', value=self.object.pk)
-        logger.debug('Setting category_pk cookie to %s', self.object.pk)
+        if not self.category_node:
+            raise Http404(u'No active category found for %s' % \
+                          u'/'.join(self.get_category_slugs()))
 
-        return resp
+        return get_object_or_404(self.model, pk=self.category_node.pk)
 
 
 class CategoryAspectDetail(CategoryDetail):
@@ -166,8 +162,8 @@ class CategoryAspectDetail(CategoryDetail):
         if aspect == 'new':
             products = products.order_by('-date_publish')
         elif aspect == 'picks':
-            products = products.filter(categoryfeaturedproduct__isnull=False)
-            products = products.order_by('categoryfeaturedproduct__featured_order')
+            products = products.filter(featured=True)
+            products = products.order_by('featured_order')
         elif aspect == 'sale':
             raise NotImplementedError('Sale has not been implemented yet')
 
@@ -199,7 +195,7 @@ class SubCategoryDetail(CategoryDetail):
 
         if filter_brand:
             logger.debug('Filtering by brand')
-            products = products.filter(brand__slug = filter_brand)
+            products = products.filter(brand_slug=filter_brand)
 
         # <URL>?sort_order=<name|brand|price>
         # <URL>?sort_order=bla&sort_reverse=1
@@ -210,15 +206,12 @@ class SubCategoryDetail(CategoryDetail):
         if sort_order == 'name':
             logger.debug('Ordering by name')
 
-            # Order by translated name
-            language_code = get_language()
-            products = products.filter(translations__language_code=\
-                                       language_code)
-            products = products.order_by('translations__name')
+            # Listings are per language, so this is the translated name
+            products = products.order_by('name')
         elif sort_order == 'brand':
             logger.debug('Ordering by brand')
 
-            products = products.order_by('brand')
+            products = products.order_by('brand_name')
         elif sort_order == 'price':
             logger.debug('Ordering by price')
 
@@ -244,18 +237,11 @@ class SubCategoryDetail(CategoryDetail):
 
         return context
 
+    def get_category_slugs(self):
+        """ Add the subcategory slug to the category slugs. """
+        slugs = super(SubCategoryDetail, self).get_category_slugs()
 
-    def get_object(self):
-        """
-        Get the category from the parent view and return the subcategory
-        matching the subcategory slug.
-        """
-        object = super(SubCategoryDetail, self).get_object()
-
-        subcategory_slug = self.kwargs.get('subcategory_slug', None)
-
-        return get_object_or_404(object.get_subcategories(),
-                                 slug=subcategory_slug)
+        return slugs + (self.kwargs.get('subcategory_slug', None), )
 
 
 class SubSubCategoryDetail(SubCategoryDetail):
@@ -263,20 +249,14 @@ class SubSubCategoryDetail(SubCategoryDetail):
     Same as SubCategoryDetail but a level lower
     """
 
-    def get_object(self):
-        """
-        Get the category from the parent view and return the subcategory
-        matching the subcategory slug.
-        """
-        object = super(SubSubCategoryDetail, self).get_object()
-
-        subsubcategory_slug = self.kwargs.get('subsubcategory_slug', None)
+    def get_category_slugs(self):
+        """ Add the subsubcategory slug to the category slugs. """
+        slugs = super(SubSubCategoryDetail, self).get_category_slugs()
 
-        return get_object_or_404(object.get_subcategories(),
-                                 slug=subsubcategory_slug)
+        return slugs + (self.kwargs.get('subsubcategory_slug', None), )
 
 
-class ProductDetail(InShopViewMixin, DetailView):
+class ProductDetail(CachedPageMixin, InShopViewMixin, DetailView):
     """ List details for a product. """
 
     model = Product
@@ -288,8 +268,8 @@ class ProductDetail(InShopViewMixin, DetailView):
 
     def get_context_data(self, object, **kwargs):
         """
-        Add an eventual category and subcategory to the request when the
-        `category` and `subcategory` COOKIES-parameters has been specified.
+        Add an eventual category to the request when the `category`
+        GET-parameter has been specified.
         """
 
         context = super(ProductDetail, self).get_context_data(**kwargs)
@@ -382,13 +362,15 @@ class ProductDetail(InShopViewMixin, DetailView):
         else:
             cartaddform = CartAddForm(product, cart, prefix='cartadd')
 
-        category_pk = self.request.COOKIES.get('category_pk', None)
+        # Category links pass the category as a GET parameter rather than
+        # a cookie, so pages can be cached per URL
+        category_pk = self.request.GET.get('category', None)
         if category_pk:
             try:
                 category = Category.in_shop.get(product=product, pk=category_pk)
-            except Category.DoesNotExist:
+            except (Category.DoesNotExist, ValueError):
                 category = None
-                logger.debug('Category for pk %d does not match product %s',
+                logger.debug('Category for pk %s does not match product %s',
                              category_pk, product)
 
         else:
@@ -403,7 +385,16 @@ class ProductDetail(InShopViewMixin, DetailView):
                 category = None
                 logger.warning(u'No categories defined for %s', object)
 
-        ancestors = category.get_ancestors(include_self=True)
+        if category:
+            category_node = get_category_tree().get_node(category.pk)
+
+            if category_node:
+                ancestors = category_node.get_ancestors(include_self=True)
+            else:
+                # Category added after the tree was cached
+                ancestors = category.get_ancestors(include_self=True)
+        else:
+            ancestors = []
 
         # Voterange is used to render the rating result
         voterange = xrange(1, 6)
@@ -415,7 +406,8 @@ class ProductDetail(InShopViewMixin, DetailView):
         ratings = ratings.filter(language=language_code)
 
         # Average rating and total ratings count
-        average_rating = ratings.aggregate(models.Avg('rating')).get('rating__avg', None)
+        rating_stats = ProductRatingStats.get_for(product, language_code)
+        average_rating = rating_stats.average
 
         from django.contrib.auth.forms import AuthenticationForm
 
@@ -425,6 +417,7 @@ class ProductDetail(InShopViewMixin, DetailView):
         context.update({
             'ratings': ratings,
             'average_rating': average_rating,
+            'rating_stats': rating_stats,
             'voterange': range(1, 6),
             'ratingform': ratingform,
             'cartaddform': cartaddform,
@@ -485,10 +478,17 @@ class CartDetail(DetailView):
                         messages.add_message(self.request, messages.ERROR,
                             field_errors[field][0])
 
-        cartitems = cart.get_items()
+        cartitems = cart.get_items().select_related(*CartItem.related_fields)
         updateform = cartformset_class(queryset=cartitems,
                                        prefix='updateform')
 
+        CartItem.prefetch_related_names(
+            [form.instance for form in updateform.forms])
+
+        # Share the discounts loaded for the cart among its items
+        for form in updateform.forms:
+            form.instance.cart = cart
+
         # Coupon code form
         if self.request.method == 'POST' and \
             'coupon_submit' in self.request.POST:
@@ -567,14 +567,12 @@ class OrderCreate(ProtectedView):
         assert cart.pk, 'Cart not persistent'
         assert cart.customer, 'No customer for Cart'
         assert cart.customer.get_address(), 'No address for customer'
-        assert cart.get_items(), 'No items in Cart'
 
         order = Order.from_cart(cart)
 
         # Don't assume transactions here - clean up after ourselves manually
         try:
             order.update()
-            order.save()
 
             # Double-check whether stock is available
             order.check_stock()
@@ -614,22 +612,24 @@ class ProductSearch(ListView):
 
         query = self.request.GET.get('q', None)
         if query:
-            product_list = context['product_list']
-            # Filter active products
-            product_list = product_list.filter(active=True)
-
             query_list = query.strip().split()
             context['query_list'] = query_list
 
             language_code = get_language()
-            
-            """ forloop filters each of search terms, so it's a pure and-filter """
-            for element in query_list:
-                product_list = product_list.filter(Q(Q(translations__language_code = language_code) & Q(translations__name__icontains=element) | \
-                                               Q(brand__translations__language_code = language_code) & Q(brand__translations__name__icontains=element)) | \
-                                               Q(Q(categories__translations__language_code = language_code) & Q(categories__translations__name__icontains=element)))
 
-            context['product_list'] = product_list.distinct()
+            # Ranked product ids, best match first
+            search_backend = get_search_backend()
+            product_ids = search_backend.search(query, language_code)
+
+            # Filter active products
+            product_list = context['product_list'].filter(active=True)
+            product_list = Product.annotate_stock(product_list)
+            product_list = Product.annotate_rating(product_list,
+                                                   language_code)
+
+            # Products are only fetched for the page being displayed
+            context['product_list'] = SearchResults(product_list,
+                                                    product_ids)
             context['query'] = query
 
         return context
@@ -675,9 +675,11 @@ class OrderShipping(OrderViewMixin, UpdateView):
         # and hence neglects any kind of saving. huhuh
         # Shipping
         self.order.shipping_address_id = form.instance.pk
+        Order.objects.filter(pk=self.order.pk).update(
+            shipping_address=form.instance.pk)
 
+        # Stores the recalculated totals
         self.order.update()
-        self.order.save()
 
         assert form.instance.pk == Order.objects.get(pk=self.order.pk).shipping_address.pk
 
@@ -692,7 +694,18 @@ class OrderCheckout(OrderViewMixin, DetailView):
         assert self.object
         assert self.object.pk
 
-        payment = self.create_payment()
+        try:
+            payment = self.create_payment()
+        except TimeoutError:
+            logger.warning(u'Payment provider timed out for order %s',
+                           self.object)
+
+            messages.add_message(self.request, messages.ERROR,
+                _('The payment provider did not respond in time. '
+                  'Please try again.'))
+
+            return HttpResponseRedirect(self.object.get_absolute_url())
+
         assert payment
         assert payment.pk
 
@@ -711,6 +724,16 @@ class OrderCheckout(OrderViewMixin, DetailView):
 
             return payment_cluster
 
+        # A cluster created for an earlier attempt which wasn't linked
+        existing = PaymentCluster.objects.filter(
+            transaction_id=order.order_number)
+        if existing:
+            payment = existing[0]
+            logger.info(u'Found unlinked payment cluster %s, using this one',
+                        payment)
+
+            return self.link_payment(payment)
+
         assert order.customer
         customer = order.customer
 
@@ -736,10 +759,16 @@ class OrderCheckout(OrderViewMixin, DetailView):
             "description" : unicode(order),
             "days_pay_period": 14
         }
-        payment = PaymentCluster()
-        payment.create_cluster(**data)
+        # The remote call runs on the payment thread pool
+        payment = create_payment_cluster(**data)
 
         logger.debug(u'Created new payment cluster %s, saving', payment)
+
+        return self.link_payment(payment)
+
+    def link_payment(self, payment):
+        """ Link a payment cluster to the order, which is now pending. """
+        order = self.object
         order.payment_cluster = payment
 
         # Make sure we update the order state to (payment) pending